@@ -1,5 +1,11 @@
+from __future__ import print_function
 
+import bisect
+import collections
 import gc
+import sys
+import time
+from threading import Condition, Thread
 import numpy
 import theano
 from Dataset import Dataset
@@ -9,14 +15,32 @@ from Util import NumbersDict
 
 class CachedDataset(Dataset):
 
-  def __init__(self, cache_byte_size=0, **kwargs):
+  def __init__(self, cache_byte_size=0, prefetch_byte_size=0, **kwargs):
+    """
+    :param int cache_byte_size: 2/3 of it is used to cache the seqs from the start, the rest for the loaded seqs
+    :param int prefetch_byte_size: if > 0, a background thread loads the seqs following the last load_seqs()
+      up to this many bytes ahead, and a full cache evicts the least recently used seqs
+      instead of being cleared completely.
+    """
     super(CachedDataset, self).__init__(**kwargs)
     self.cache_byte_size_total_limit = cache_byte_size
     if cache_byte_size < 0:
       self.cache_byte_size_limit_at_start = 1
     else:
-      self.cache_byte_size_limit_at_start = cache_byte_size * 2 / 3
-      self.cache_byte_size_total_limit = max(cache_byte_size / 3, 1)
+      self.cache_byte_size_limit_at_start = cache_byte_size * 2 // 3
+      self.cache_byte_size_total_limit = max(cache_byte_size // 3, 1)
+    self.prefetch_byte_size = prefetch_byte_size
+    self._prefetch_cond = Condition(lock=self.lock)
+    self._prefetch_thread = None
+    self._prefetch_quit = False
+    self._prefetch_start = None; " :type: int|None "  # sorted seq idx, where the prefetch thread continues
+    self._prefetch_end = None; " :type: int|None "
+    self._last_load_range = (0, 0)  # sorted seq idx (start,end) of the last load_seqs() of the user
+    self._seq_order_generation = 0  # increased by init_seq_order(), such that we can drop outdated prefetched data
+    self._prefetched_data = {}; " :type: dict[int,object] "  # sorted seq idx -> data, see _read_seqs_data()
+    self._lru_ranges = collections.OrderedDict(); " :type: dict[(int,int),None] "  # loaded (i,i+1), oldest first
+    self.stall_time = 0.0  # seconds which load_seqs() blocked the caller in the current epoch
+    self.stall_time_per_epoch = {}; " :type: dict[int,float] "
     self.num_seqs_cached_at_start = 0
     self.cached_bytes_at_start = 0
     self.max_ctc_length = 0
@@ -28,6 +52,7 @@ class CachedDataset(Dataset):
     self._seq_lengths = []; """ :type: list[(int,int)] """  # uses real seq idx
     self.tags = []; """ :type: list[str] """  # uses real seq idx
     self.tag_idx = {}; ":type: dict[str,int] "  # map of tag -> real-seq-idx
+    self._predefined_seq_order = None  # type: None|list[int]|numpy.ndarray  # see init_seq_order_by_index()
     self.targets = {}
     self.target_keys = []
 
@@ -38,12 +63,15 @@ class CachedDataset(Dataset):
     temp_cache_size_bytes = \
       max(0, self.cache_byte_size_total_limit) - self.cached_bytes_at_start
     self.definite_cache_leftover = temp_cache_size_bytes if self.num_seqs_cached_at_start == self.num_seqs else 0
-    self.cache_num_frames_free = temp_cache_size_bytes / self.nbytes
+    self.cache_num_frames_free = temp_cache_size_bytes // self.nbytes
+    if self.prefetch_byte_size > 0 and self.cache_byte_size_total_limit > 0:
+      # The prefetched seqs come on top of the cache.
+      self.cache_num_frames_free += self.prefetch_byte_size // self.nbytes
 
-    print >> log.v4, "cached %i seqs" % self.num_seqs_cached_at_start, \
-                     "%s GB" % (self.cached_bytes_at_start / float(1024 * 1024 * 1024)), \
-                     ("(fully loaded, %s GB left over)" if self.definite_cache_leftover else "(%s GB free)") % \
-                     max(temp_cache_size_bytes / float(1024 * 1024 * 1024), 0)
+    print("cached %i seqs" % self.num_seqs_cached_at_start,
+          "%s GB" % (self.cached_bytes_at_start / float(1024 * 1024 * 1024)),
+          ("(fully loaded, %s GB left over)" if self.definite_cache_leftover else "(%s GB free)") %
+          max(temp_cache_size_bytes / float(1024 * 1024 * 1024), 0), file=log.v4)
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -52,10 +80,47 @@ class CachedDataset(Dataset):
     Initialize lists:
       self.seq_index  # sorted seq idx
     """
+    with self.lock:  # the prefetch thread must not load anything while we reorder
+      self._prefetch_start = self._prefetch_end = None
+      self._seq_order_generation += 1
+      self._prefetched_data.clear()
+      if self.epoch is not None and epoch != self.epoch:
+        self.stall_time_per_epoch[self.epoch] = self.stall_time
+        if self.prefetch_byte_size > 0:
+          print("%s: stall time in epoch %i: %.3f sec" % (self, self.epoch, self.stall_time), file=log.v4)
+        self.stall_time = 0.0
+      return self._init_seq_order(epoch=epoch, seq_list=seq_list)
+
+  def init_seq_order_by_index(self, epoch=None, seq_order=None):
+    """
+    :param int|None epoch:
+    :param list[int]|numpy.ndarray seq_order: indices into self.tags
+    :rtype: bool
+    """
+    # Go through init_seq_order() such that derived classes can still do their bookkeeping there.
+    self._predefined_seq_order = seq_order
+    try:
+      return self.init_seq_order(epoch=epoch)
+    finally:
+      self._predefined_seq_order = None
+
+  def get_all_tags(self):
+    """
+    :rtype: list[str]
+    """
+    return self.tags
+
+  def _init_seq_order(self, epoch=None, seq_list=None):
+    """
+    :type epoch: int|None
+    :param list[str] | None seq_list: In case we want to set a predefined order.
+    """
     old_index_map = self._index_map[:]
     self._index_map = range(self.num_seqs)
     super(CachedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
-    if seq_list:
+    if self._predefined_seq_order is not None:  # via init_seq_order_by_index()
+      seq_index = numpy.asarray(self._predefined_seq_order).tolist()
+    elif seq_list:
       seq_index = [self.tag_idx[tag] for tag in seq_list]
     else:
       seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, lambda s: self._seq_lengths[s][0])
@@ -65,13 +130,14 @@ class CachedDataset(Dataset):
 
     if epoch is not None:
       # Give some hint to the user in case he is wondering why the cache is reloading.
-      print >> log.v4, "Reinitialize dataset seq order for epoch %i." % epoch
+      print("Reinitialize dataset seq order for epoch %i." % epoch, file=log.v4)
 
     if self.num_seqs_cached_at_start != len(seq_index):
       self._seq_index = seq_index
       self._seq_index_inv = dict(zip(seq_index,range(len(seq_index))))
       self._init_seq_starts()
       self._init_alloc_intervals()
+      self._lru_ranges.clear()
       self._init_start_cache()
     else:
       self._index_map = [ self._seq_index_inv[i] for i in seq_index ]
@@ -79,6 +145,13 @@ class CachedDataset(Dataset):
         return False
     return True
 
+  def is_fully_cached(self):
+    """
+    :rtype: bool
+    """
+    # With a negative cache_byte_size, the cache is unlimited, i.e. nothing gets evicted.
+    return self.cache_byte_size_total_limit <= 0 or self.num_seqs_cached_at_start == self.num_seqs
+
   def batch_set_generator_cache_whole_epoch(self):
     return True
 
@@ -134,10 +207,30 @@ class CachedDataset(Dataset):
     """
     assert start >= 0
     assert start <= end
+    if self.prefetch_byte_size > 0 and with_cache:
+      start_time = time.time()
+      with self.lock:  # waits for the prefetch thread if it is currently loading
+        self._last_load_range = (start, end)
+        self._lru_touch(start, end)
+        self._load_seqs_maybe_with_cache(start, end, with_cache=True)
+        self._request_prefetch(end)
+      self.stall_time += time.time() - start_time
+      return
+    self._load_seqs_maybe_with_cache(start, end, with_cache=with_cache)
+
+  def _load_seqs_maybe_with_cache(self, start, end, with_cache):
+    """
+    :param int start: start sorted seq idx
+    :param int end: end sorted seq idx
+    :param bool with_cache: handle cache
+    """
     if self.is_cached(start, end): return
 
     if self.cache_byte_size_total_limit > 0 and with_cache:  # If the cache is enabled.
-      self._load_seqs_with_cache(start, end)
+      if self.prefetch_byte_size > 0:
+        self._load_seqs_with_lru_cache(start, end)
+      else:
+        self._load_seqs_with_cache(start, end)
       return
 
     super(CachedDataset, self).load_seqs(start, end)
@@ -145,6 +238,142 @@ class CachedDataset(Dataset):
   def _load_seqs(self, start, end):
     raise NotImplementedError
 
+  def _read_seqs_data(self, seq_idxs):
+    """
+    Reads the data of the given seqs (e.g. from files), without touching the cache,
+    such that the prefetch thread can do the I/O without holding self.lock.
+    The result is put into self._prefetched_data and _load_seqs() should take the data from there.
+    The data must be really read already (e.g. no lazy memmap views).
+
+    :param list[int] seq_idxs: sorted seq idxs
+    :return: sorted seq idx -> data, or None if not supported. then the prefetch thread loads under the lock
+    :rtype: dict[int,object]|None
+    """
+    return None
+
+  def _load_seqs_with_lru_cache(self, start, end):
+    """
+    Loads the missing seqs of (start,end) and only evicts as many seqs as needed,
+    the least recently used first.
+
+    :param int start: start sorted seq idx
+    :param int end: end sorted seq idx
+    """
+    num_needed_cache_frames = sum([
+      self.get_seq_length_2d(i)[0] for i in range(start, end) if not self.is_cached(i, i + 1)])
+    if self.cache_num_frames_free < num_needed_cache_frames:
+      self.cache_num_frames_free += self._lru_evict(
+        num_needed_cache_frames - self.cache_num_frames_free, keep_ranges=[(start, end), self._last_load_range])
+    self.cache_num_frames_free -= num_needed_cache_frames
+    self.load_seqs(start, end, with_cache=False)
+    # One entry per seq, such that we never keep more than needed because of an overlap with keep_ranges.
+    for i in range(max(start, self.num_seqs_cached_at_start), end):  # the seqs cached at start stay anyway
+      self._lru_ranges[(i, i + 1)] = None
+
+  def _lru_touch(self, start, end):
+    """
+    Marks all loaded ranges overlapping with (start,end) as most recently used.
+
+    :param int start: start sorted seq idx
+    :param int end: end sorted seq idx
+    """
+    for key in [key for key in self._lru_ranges if key[0] < end and start < key[1]]:
+      del self._lru_ranges[key]
+      self._lru_ranges[key] = None
+
+  def _lru_evict(self, nframes, keep_ranges):
+    """
+    :param int nframes: how much frames to delete at least, if possible
+    :param list[(int,int)] keep_ranges: sorted seq idx ranges which must not be deleted
+    :return: number of frames deleted
+    :rtype: int
+    """
+    deleted = 0
+    for key in list(self._lru_ranges.keys()):
+      if deleted >= nframes:
+        break
+      if any([key[0] < e and s < key[1] for (s, e) in keep_ranges]):
+        continue
+      del self._lru_ranges[key]
+      deleted += sum([self._seq_lengths[self._seq_index[i]][0]
+                      for i in self.remove_alloc_interval(*key)])
+    return deleted
+
+  def _request_prefetch(self, start):
+    """
+    Lets the prefetch thread load the seqs from start on, up to self.prefetch_byte_size.
+    Called with self.lock held.
+
+    :param int start: sorted seq idx
+    """
+    end = start
+    num_bytes = 0
+    while end < self.num_seqs:
+      num_bytes += self.get_seq_length_2d(end)[0] * self.nbytes
+      if num_bytes > self.prefetch_byte_size:
+        break
+      end += 1
+    if end <= start:
+      return
+    self._prefetch_start, self._prefetch_end = start, end
+    if not self._prefetch_thread:
+      # The thread and the exit hook only keep a weak reference, such that the dataset can still be freed.
+      import atexit
+      import weakref
+      self_ref = weakref.ref(self)
+      self._prefetch_thread = Thread(
+        name="%r prefetch" % self, target=_prefetch_thread_main, args=(self_ref, self._prefetch_cond))
+      self._prefetch_thread.daemon = True
+      self._prefetch_thread.start()
+      atexit.register(_stop_prefetch_thread_at_exit, self_ref, self._prefetch_thread)
+    self._prefetch_cond.notify_all()
+
+  def _stop_prefetch_thread(self):
+    with self.lock:
+      self._prefetch_quit = True
+      self._prefetch_cond.notify_all()
+    self._prefetch_thread.join()
+
+  def _prefetch_step(self):
+    """
+    Called by the prefetch thread. Loads the next few seqs of the current prefetch request, if there is one.
+
+    :return: False if the thread should quit
+    :rtype: bool
+    """
+    with self.lock:
+      if self._prefetch_quit:
+        return False
+      if self._prefetch_start is None:
+        return True
+      request = (self._prefetch_start, self._prefetch_end)
+      start, end = request
+      # Load in small steps, so that we release the lock regularly for the user of the dataset.
+      while start < end and self.is_cached(start, start + 1):
+        start += 1
+      step_end = start
+      while step_end < end and step_end - start < 10 and not self.is_cached(step_end, step_end + 1):
+        step_end += 1
+      generation = self._seq_order_generation
+    # The file I/O happens without the lock, such that the user is not blocked by it.
+    data = self._read_seqs_data(list(range(start, step_end))) if start < step_end else None
+    with self.lock:
+      if generation != self._seq_order_generation:
+        return True  # new seq order, the data is outdated
+      new_request = (self._prefetch_start, self._prefetch_end)
+      if new_request != request:
+        if new_request[0] is None:
+          return True
+        # The user moved on in the meantime. Only use what is still requested.
+        start, step_end = max(start, new_request[0]), min(step_end, new_request[1])
+      if start < step_end:
+        self._prefetched_data.update(data or {})
+        self._load_seqs_maybe_with_cache(start, step_end, with_cache=True)
+      self._prefetched_data.clear()  # e.g. if the user loaded them in the meantime
+      if new_request == request:
+        self._prefetch_start = step_end if step_end < end else None
+    return True
+
   def _load_seqs_with_cache(self, start, end, clear=True):
     if not clear:
       # only remove as many frames as required
@@ -219,28 +448,27 @@ class CachedDataset(Dataset):
       x = self.sliding_window(x)
     self.alloc_intervals[idi][2][o:o + l] = x
 
+  def _alloc_interval_search(self, ids):
+    """
+    :param int ids: sorted seq idx
+    :return: index in self.alloc_intervals of the last interval with start <= ids, or -1.
+      self.alloc_intervals is sorted by (start,end), so this is a binary search.
+      The search key never reaches the data array in the tuple comparison, because end < sys.maxsize.
+    :rtype: int
+    """
+    return bisect.bisect_right(self.alloc_intervals, (ids, sys.maxsize)) - 1
+
   def alloc_interval_index(self, ids):
     """
     :param int ids: sorted seq idx
     :return index in self.alloc_intervals
     :rtype: int
     """
-    s = 0
-    e = len(self.alloc_intervals)
-    # Binary search.
-    while s < e:
-      i = (s + e) / 2
+    i = self._alloc_interval_search(ids)
+    if i >= 0:
       alloc_start, alloc_end, _ = self.alloc_intervals[i]
       if alloc_start <= ids < alloc_end:
         return i
-      elif alloc_start <= ids and ids >= alloc_end:
-        if s == i: return -1
-        s = i
-      elif alloc_start > ids:
-        if e == i: return -1
-        e = i
-      else:
-        assert False
     return -1
 
   def _insert_alloc_interval(self, pos, value):
@@ -252,7 +480,8 @@ class CachedDataset(Dataset):
     """
     ci = self.alloc_intervals[pos][1]
     ni = self.alloc_intervals[pos + 1][0]
-    xc = self.alloc_intervals[pos][2]
+    # Without the extra frames at the end, e.g. the dummy frame of the empty initial interval.
+    xc = self.alloc_intervals[pos][2][:self._seq_start[ci][0] - self._seq_start[self.alloc_intervals[pos][0]][0]]
     xn = self.alloc_intervals[pos + 1][2]
     if value[0] == ci and value[1] == ni:
       self.alloc_intervals.insert(pos,
@@ -261,7 +490,7 @@ class CachedDataset(Dataset):
          numpy.concatenate(
            [xc,
             numpy.zeros(
-              [self._seq_start[ni][0]] + self.get_data_shape("data"),
+              [self._seq_start[ni][0] - self._seq_start[ci][0]] + self.get_data_shape("data"),
               dtype=self.get_data_dtype("data")),
             xn])))
       del self.alloc_intervals[pos + 1]
@@ -276,7 +505,7 @@ class CachedDataset(Dataset):
     elif value[1] == ni:
       self.alloc_intervals.insert(pos + 1, (value[0],
                                             self.alloc_intervals[pos + 1][1],
-                                            numpy.concatenate([numpy.zeros([self._seq_start[ni][0] - self._seq_start[value[0]][0]] + self.get_data_shape("data"), dtype=self.get_data_dtype("data")), xc])))
+                                            numpy.concatenate([numpy.zeros([self._seq_start[ni][0] - self._seq_start[value[0]][0]] + self.get_data_shape("data"), dtype=self.get_data_dtype("data")), xn])))
       del self.alloc_intervals[pos + 2]
       return 0
     else:
@@ -323,12 +552,16 @@ class CachedDataset(Dataset):
     if end is None: end = start + 1
     if start == end: return
     assert start < end
-    i = 0
+    # All intervals (or gaps in insert mode) before the one preceding the first interval with start >= start
+    # do not overlap with (start,end), so we can skip them.
+    i = max(bisect.bisect_left(self.alloc_intervals, (start, -1)) - 1, 0)
     selection = []; """ :type: list[int] """
     modify = self._insert_alloc_interval if invert else self._remove_alloc_interval
     while i < len(self.alloc_intervals) - invert:
       ni = self.alloc_intervals[i + invert][1 - invert]  # insert mode: start idx of next alloc
       ci = self.alloc_intervals[i][invert]               # insert mode: end idx of cur alloc
+      if ci > end:  # this and all following are behind (start,end)
+        break
       flag = ((ci <= start < ni), (ci < end <= ni), (ci < start and ni <= start) or (ci >= end and ni > end))
       if not flag[0] and not flag[1]:
         if not flag[2]:
@@ -391,23 +624,11 @@ class CachedDataset(Dataset):
     """
     if start == end: return True  # Empty.
     assert start < end
-    s = 0
-    e = len(self.alloc_intervals)
-    # Binary search.
-    while s < e:
-      i = (s + e) / 2
-      alloc_start, alloc_end, _ = self.alloc_intervals[i]
-      if alloc_start <= start < alloc_end:
-        return alloc_start < end <= alloc_end
-      elif alloc_start <= start and start >= alloc_end:
-        if s == i: return False
-        s = i
-      elif alloc_start > start:
-        if e == i: return False
-        e = i
-      else:
-        assert False
-    return False
+    i = self._alloc_interval_search(start)
+    if i < 0:
+      return False
+    alloc_start, alloc_end, _ = self.alloc_intervals[i]
+    return alloc_start <= start < alloc_end and end <= alloc_end
 
   def get_seq_length_2d(self, sorted_seq_idx):
     """
@@ -429,6 +650,17 @@ class CachedDataset(Dataset):
     #d.update({k: output_len for k in self.get_target_list()})
     return NumbersDict(d)
 
+  def get_seq_length_array(self):
+    """
+    :rtype: dict[str,numpy.ndarray]
+    """
+    seq_lengths = numpy.asarray(self._seq_lengths)  # (num real seqs,1+num targets)
+    if seq_lengths.ndim != 2 or self.num_seqs == 0:
+      return None
+    real_seq_idxs = numpy.asarray(self._seq_index)[numpy.asarray(self._index_map[:self.num_seqs])]
+    seq_lengths = seq_lengths[real_seq_idxs]
+    return {k: seq_lengths[:, i] for (i, k) in enumerate(["data"] + list(self.target_keys)[:seq_lengths.shape[1] - 1])}
+
   def get_seq_start(self, sorted_seq_idx):
     """
     :type sorted_seq_idx: int
@@ -445,9 +677,14 @@ class CachedDataset(Dataset):
   def get_input_data(self, sorted_seq_idx):
     #sorted_seq_idx = self._index_map[sorted_seq_idx]
     seq_idx = self._index_map[sorted_seq_idx]
-    idi = self.alloc_interval_index(seq_idx)
+    if self._prefetch_thread:
+      with self.lock:  # the prefetch thread might modify self.alloc_intervals
+        idi = self.alloc_interval_index(seq_idx)
+        alloc_start_seq, alloc_end_seq, alloc_data = self.alloc_intervals[idi]
+    else:  # hot path, no locking needed
+      idi = self.alloc_interval_index(seq_idx)
+      alloc_start_seq, alloc_end_seq, alloc_data = self.alloc_intervals[idi]
     assert idi >= 0, "failed to get data for seq %i" % sorted_seq_idx
-    alloc_start_seq, alloc_end_seq, alloc_data = self.alloc_intervals[idi]
     o = self.get_seq_start(seq_idx)[0] - self.get_seq_start(alloc_start_seq)[0]
     assert o >= 0
     l = self.get_seq_length_2d(sorted_seq_idx)[0]
@@ -479,3 +716,41 @@ class CachedDataset(Dataset):
   def get_tag(self, sorted_seq_idx):
     raise NotImplementedError
 
+
+
+def _prefetch_thread_main(dataset_ref, cond):
+  """
+  Main loop of the prefetch thread of :class:`CachedDataset`.
+  While idle, it does not keep a reference to the dataset, and it quits when the dataset is gone.
+
+  :param weakref.ref dataset_ref: -> CachedDataset
+  :param threading.Condition cond: the _prefetch_cond of the dataset
+  """
+  from Util import interrupt_main
+  try:
+    import better_exchook
+    better_exchook.install()
+    while True:
+      dataset = dataset_ref()
+      if dataset is None or not dataset._prefetch_step():
+        return
+      with cond:
+        idle = dataset._prefetch_start is None and not dataset._prefetch_quit
+        del dataset
+        if idle:
+          cond.wait(1.0)  # wake up regularly to check whether the dataset still exists
+  except Exception:
+    sys.excepthook(*sys.exc_info())
+    interrupt_main()
+
+
+def _stop_prefetch_thread_at_exit(dataset_ref, thread):
+  """
+  :param weakref.ref dataset_ref: -> CachedDataset
+  :param threading.Thread thread: the prefetch thread
+  """
+  dataset = dataset_ref()
+  if dataset is not None:
+    dataset._stop_prefetch_thread()
+  else:
+    thread.join()  # it quits soon, as the dataset is gone, but it must not run during interpreter shutdown
@@ -98,6 +98,7 @@ class Dataset(object):
     self.context_window = context_window
     self.shuffle_frames_of_nseqs = shuffle_frames_of_nseqs
     self.epoch = None
+    self.init_dataset_opts = None  # type: dict[str]|None  # set by init_dataset(), to create it again e.g. in a sub proc
 
   def __repr__(self):
     return "<%s %r>" % (self.__class__.__name__, self.name)
@@ -159,6 +160,17 @@ class Dataset(object):
     d.update({k: output_len for k in self.get_target_list()})
     return NumbersDict(d)
 
+  def get_seq_length_array(self):
+    """
+    Like self.get_seq_length() for all seqs of the current epoch at once.
+    This is used by self._generate_batches() for the vectorized batch generation.
+    Only implement this if the lengths are known in advance and cheap to get.
+
+    :return: data-key -> seq lengths, shape (num_seqs,), in the sorted seq order, or None if not supported
+    :rtype: dict[str,numpy.ndarray]|None
+    """
+    return None
+
   def get_num_timesteps(self):
     assert self._num_timesteps > 0
     return self._num_timesteps
@@ -278,6 +290,27 @@ class Dataset(object):
     self.rnd_seq_drop = Random(epoch or 1)
     return False
 
+  def init_seq_order_by_index(self, epoch=None, seq_order=None):
+    """
+    Like init_seq_order() with a predefined order, but the order is given by indices into get_all_tags().
+    This default implementation just maps them to the seq tags.
+    Derived classes can override this to use the indices directly, which avoids the tag lookup.
+
+    :param int|None epoch:
+    :param list[int]|numpy.ndarray seq_order: indices into get_all_tags()
+    :rtype: bool
+    :returns whether the order changed (True is always safe to return)
+    """
+    all_tags = self.get_all_tags()
+    return self.init_seq_order(epoch=epoch, seq_list=[all_tags[i] for i in seq_order])
+
+  def get_all_tags(self):
+    """
+    :return: all the seq tags of the dataset, in the original order (not the order of the epoch)
+    :rtype: list[str]
+    """
+    raise NotImplementedError
+
   def _base_init(self):
     # We expect that the following attributes are already set elsewhere, by a derived class.
     assert self.num_inputs > 0
@@ -594,13 +627,22 @@ class Dataset(object):
       end += ctx_lr[1]
     return start, end
 
-  def _generate_batches(self, recurrent_net, batch_size, max_seqs=-1, seq_drop=0.0, max_seq_length=sys.maxsize, used_data_keys=None):
+  def _generate_batches(self, recurrent_net, batch_size, max_seqs=-1, seq_drop=0.0, max_seq_length=sys.maxsize,
+                        used_data_keys=None, bucket_boundaries=None, sort_window=None):
     """
     :param bool recurrent_net: If True, the batch might have a batch seq dimension > 1.
       Otherwise, the batch seq dimension is always 1 and multiple seqs will be concatenated.
     :param int batch_size: Max number of frames in one batch.
     :param int max_seqs: Max number of seqs per batch.
     :param set(str)|None used_data_keys:
+    :param list[int]|None bucket_boundaries: if set, build the batches within length buckets,
+      see self._generate_bucketed_batches().
+      This needs the recurrent case without chunking, and a fully cached dataset with known seq lengths
+      (self.is_fully_cached() and self.get_seq_length_array(), e.g. HDFDataset with cache_byte_size=-1),
+      because the seqs of one batch are not consecutive.
+      Otherwise we raise an exception, see self._get_seq_lengths_for_non_consecutive_batches().
+    :param int|None sort_window: if set, sort the seqs by length within consecutive windows of this many seqs,
+      see self._generate_length_sorted_batches(). Same requirements as for bucket_boundaries.
     """
     if batch_size == 0: batch_size = sys.maxsize
     assert batch_size > 0
@@ -613,8 +655,32 @@ class Dataset(object):
       if chunk_size != 0:
         print("Non-recurrent network, chunk size %i:%i ignored" % (chunk_size, chunk_step), file=log.v4)
         chunk_size = 0
-    batch = Batch()
     ctx_lr = self._get_context_window_left_right()
+    if bucket_boundaries:
+      seq_lengths = self._get_seq_lengths_for_non_consecutive_batches(
+        "bucket_boundaries", recurrent_net=recurrent_net, chunk_size=chunk_size, ctx_lr=ctx_lr)
+      for batch in self._generate_bucketed_batches(
+            seq_lengths=seq_lengths, batch_size=batch_size, max_seqs=max_seqs,
+            seq_drop=seq_drop, max_seq_length=max_seq_length, bucket_boundaries=bucket_boundaries):
+        yield batch
+      return
+    if sort_window:
+      seq_lengths = self._get_seq_lengths_for_non_consecutive_batches(
+        "sort_window", recurrent_net=recurrent_net, chunk_size=chunk_size, ctx_lr=ctx_lr)
+      for batch in self._generate_length_sorted_batches(
+            seq_lengths=seq_lengths, batch_size=batch_size, max_seqs=max_seqs,
+            seq_drop=seq_drop, max_seq_length=max_seq_length, sort_window=sort_window):
+        yield batch
+      return
+    if recurrent_net and chunk_size == 0 and not ctx_lr:
+      seq_lengths = self.get_seq_length_array()
+      if seq_lengths is not None:
+        for batch in self._generate_batches_from_seq_lengths(
+              seq_lengths=seq_lengths, batch_size=batch_size, max_seqs=max_seqs,
+              seq_drop=seq_drop, max_seq_length=max_seq_length):
+          yield batch
+        return
+    batch = Batch()
     for seq_idx, t_start, t_end in self.iterate_seqs(chunk_size=chunk_size, chunk_step=chunk_step, used_data_keys=used_data_keys):
       if ctx_lr:
         t_start -= ctx_lr[0]
@@ -648,6 +714,194 @@ class Dataset(object):
     if batch.get_all_slices_num_frames() > 0:
       yield batch
 
+  def _get_seq_lengths_for_non_consecutive_batches(self, option, recurrent_net, chunk_size, ctx_lr):
+    """
+    bucket_boundaries and sort_window build batches of non-consecutive seqs from all the seq lengths.
+    The seqs of such a batch are loaded via Batch.get_seq_ranges(),
+    thus the dataset must not evict seqs in between, i.e. it must be fully cached.
+
+    :param str option: "bucket_boundaries" or "sort_window", for the error message
+    :param bool recurrent_net:
+    :param int chunk_size:
+    :param (int,int)|None ctx_lr: see self._get_context_window_left_right()
+    :return: via self.get_seq_length_array()
+    :rtype: dict[str,numpy.ndarray]
+    """
+    if not recurrent_net:
+      raise Exception("%s: %s needs a recurrent network" % (self, option))
+    if chunk_size != 0 or ctx_lr:
+      raise Exception("%s: %s is not supported with chunking or a context window" % (self, option))
+    if not self.is_fully_cached():
+      raise Exception("%s: %s needs a fully cached dataset (e.g. HDFDataset with cache_byte_size=-1)" % (
+        self, option))
+    seq_lengths = self.get_seq_length_array()
+    if seq_lengths is None:
+      raise Exception("%s: %s needs all the seq lengths in advance" % (self, option))
+    return seq_lengths
+
+  def _generate_batches_from_seq_lengths(self, seq_lengths, batch_size, max_seqs, seq_drop, max_seq_length):
+    """
+    Vectorized variant of self._generate_batches() for the recurrent case without chunking.
+    All the seq lengths are known in advance, thus we can do the filtering (max_seq_length, seq_drop)
+    and the search for the batch boundaries in numpy, and only create the Batch objects when they are requested.
+    This results in exactly the same batches.
+
+    :param dict[str,numpy.ndarray] seq_lengths: via self.get_seq_length_array()
+    :param int batch_size: max number of frames in one batch (max seq len * num seqs)
+    :param int|float max_seqs: max number of seqs per batch
+    :param float seq_drop:
+    :param int max_seq_length:
+    :return: generator which yields Batch
+    """
+    seq_idxs, keys, lengths, max_lengths = self._filter_seq_lengths(
+      seq_lengths=seq_lengths, batch_size=batch_size, seq_drop=seq_drop, max_seq_length=max_seq_length)
+    for start, end in self._find_batch_boundaries(max_lengths=max_lengths, batch_size=batch_size, max_seqs=max_seqs):
+      batch = Batch()
+      batch.add_sequences_as_slices(seq_idxs=seq_idxs[start:end], keys=keys, lengths=lengths[start:end])
+      yield batch
+
+  def _generate_bucketed_batches(self, seq_lengths, batch_size, max_seqs, seq_drop, max_seq_length,
+                                 bucket_boundaries):
+    """
+    Like self._generate_batches_from_seq_lengths() but the seqs are grouped into buckets by their length first,
+    and every batch only contains seqs of one bucket. This reduces the amount of padding.
+    The order of the batches is shuffled (across the buckets), depending on the epoch.
+    Note that the seqs of one batch are not consecutive anymore,
+    thus this needs a fully cached dataset, see self._generate_batches() and Batch.get_seq_ranges().
+
+    :param dict[str,numpy.ndarray] seq_lengths: via self.get_seq_length_array()
+    :param int batch_size: max number of frames in one batch (max seq len * num seqs)
+    :param int|float max_seqs: max number of seqs per batch
+    :param float seq_drop:
+    :param int max_seq_length:
+    :param list[int] bucket_boundaries: bucket i has the seqs with boundaries[i-1] < max seq len <= boundaries[i]
+    :return: generator which yields Batch
+    """
+    seq_idxs, keys, lengths, max_lengths = self._filter_seq_lengths(
+      seq_lengths=seq_lengths, batch_size=batch_size, seq_drop=seq_drop, max_seq_length=max_seq_length)
+    bucket_boundaries = sorted(bucket_boundaries)
+    bucket_idxs = numpy.searchsorted(bucket_boundaries, max_lengths, side="left")
+    batches = []  # type: list[(numpy.ndarray,numpy.ndarray)]  # seq idxs, lengths
+    for bucket_idx in range(len(bucket_boundaries) + 1):
+      mask = bucket_idxs == bucket_idx
+      bucket_seq_idxs, bucket_lengths = seq_idxs[mask], lengths[mask]
+      for start, end in self._find_batch_boundaries(
+            max_lengths=max_lengths[mask], batch_size=batch_size, max_seqs=max_seqs):
+        batches.append((bucket_seq_idxs[start:end], bucket_lengths[start:end]))
+    Random(self.epoch or 1).shuffle(batches)
+    for batch_seq_idxs, batch_lengths in batches:
+      batch = Batch()
+      batch.add_sequences_as_slices(seq_idxs=batch_seq_idxs, keys=keys, lengths=batch_lengths)
+      yield batch
+
+  def _generate_length_sorted_batches(self, seq_lengths, batch_size, max_seqs, seq_drop, max_seq_length,
+                                      sort_window):
+    """
+    Like self._generate_batches_from_seq_lengths() but within consecutive windows of the seq idx
+    (window k covers the seq idx range [k * sort_window, (k + 1) * sort_window)),
+    the seqs are sorted by their length before we build the batches.
+    This is mostly for inference (forwarding, search), where it reduces the amount of padding,
+    while the batches still come in the order of the windows.
+    Thus the caller can restore the original order by buffering the outputs of one window,
+    see TFEngine.SeqOrderReassembler.
+    Same requirements as self._generate_bucketed_batches().
+
+    :param dict[str,numpy.ndarray] seq_lengths: via self.get_seq_length_array()
+    :param int batch_size: max number of frames in one batch (max seq len * num seqs)
+    :param int|float max_seqs: max number of seqs per batch
+    :param float seq_drop:
+    :param int max_seq_length:
+    :param int sort_window: number of seqs
+    :return: generator which yields Batch
+    """
+    assert sort_window > 0
+    seq_idxs, keys, lengths, max_lengths = self._filter_seq_lengths(
+      seq_lengths=seq_lengths, batch_size=batch_size, seq_drop=seq_drop, max_seq_length=max_seq_length)
+    if not len(seq_idxs):
+      return
+    # seq_idxs is sorted, thus we can find the windows via searchsorted.
+    window_bounds = numpy.searchsorted(seq_idxs, numpy.arange(0, seq_idxs[-1] + sort_window + 1, sort_window))
+    for window_start, window_end in zip(window_bounds[:-1], window_bounds[1:]):
+      if window_start == window_end:
+        continue
+      window = slice(window_start, window_end)
+      order = numpy.argsort(max_lengths[window], kind="mergesort")  # stable
+      window_seq_idxs, window_lengths = seq_idxs[window][order], lengths[window][order]
+      for start, end in self._find_batch_boundaries(
+            max_lengths=max_lengths[window][order], batch_size=batch_size, max_seqs=max_seqs):
+        batch = Batch()
+        batch.add_sequences_as_slices(
+          seq_idxs=window_seq_idxs[start:end], keys=keys, lengths=window_lengths[start:end])
+        yield batch
+
+  def _filter_seq_lengths(self, seq_lengths, batch_size, seq_drop, max_seq_length):
+    """
+    Applies max_seq_length and seq_drop, like in the per-seq loop in self._generate_batches().
+
+    :param dict[str,numpy.ndarray] seq_lengths: via self.get_seq_length_array()
+    :param int batch_size: only for the warning about too long seqs
+    :param float seq_drop:
+    :param int max_seq_length:
+    :return: seq idxs (num_seqs,), keys, lengths (num_seqs,num_keys), max lengths (num_seqs,) of the remaining seqs
+    :rtype: (numpy.ndarray,list[str],numpy.ndarray,numpy.ndarray)
+    """
+    keys = sorted(seq_lengths.keys())
+    lengths = numpy.stack([numpy.asarray(seq_lengths[k], dtype="int64") for k in keys], axis=1)  # (num_seqs,num_keys)
+    max_lengths = lengths.max(axis=1)  # (num_seqs,), like NumbersDict.max_value()
+    seq_idxs = numpy.arange(lengths.shape[0])
+    if max_seq_length < 0:
+      mask = lengths[:, keys.index("classes")] <= -max_seq_length
+    elif max_seq_length > 0:
+      mask = max_lengths <= max_seq_length
+    else:
+      mask = numpy.ones_like(max_lengths, dtype="bool")
+    for seq_idx in seq_idxs[mask & (max_lengths > batch_size)]:
+      print("warning: sequence length (%i) larger than limit (%i)" % (max_lengths[seq_idx], batch_size), file=log.v4)
+    if seq_drop > 0:
+      # Same random numbers as in the per-seq loop.
+      rnd = numpy.array([self.rnd_seq_drop.random() for _ in range(numpy.count_nonzero(mask))])
+      mask[mask] = rnd >= seq_drop
+    return seq_idxs[mask], keys, lengths[mask], max_lengths[mask]
+
+  @staticmethod
+  def _find_batch_boundaries(max_lengths, batch_size, max_seqs):
+    """
+    A batch with seqs [start, end) is closed as soon as one more seq would exceed
+    batch_size (max seq len * num seqs) or max_seqs. See Batch.try_sequence_as_slice().
+
+    :param numpy.ndarray max_lengths: (num_seqs,)
+    :param int batch_size:
+    :param int|float max_seqs:
+    :return: generator which yields (start, end)
+    """
+    num_seqs = max_lengths.shape[0]
+    start = 0
+    window = 64
+    while start < num_seqs:
+      # We don't know the batch length in advance, thus we search in a growing window.
+      while True:
+        end = min(start + window, num_seqs)
+        num_frames = numpy.maximum.accumulate(max_lengths[start:end]) * numpy.arange(1, end - start + 1)
+        exceeded = (num_frames > batch_size) | (numpy.arange(1, end - start + 1) > max_seqs)
+        exceeded[0] = False  # the first seq is always added
+        if exceeded.any():
+          end = start + int(numpy.argmax(exceeded))
+          break
+        if end == num_seqs:
+          break
+        window *= 2
+      window = max(64, 2 * (end - start))
+      yield start, end
+      start = end
+
+  def is_fully_cached(self):
+    """
+    :return: whether all seqs stay in memory once they are loaded, i.e. self.load_seqs() never evicts seqs.
+      Then the seqs can be loaded in any order, e.g. for batches with non-consecutive seqs.
+    :rtype: bool
+    """
+    return False
+
   def batch_set_generator_cache_whole_epoch(self):
     """
     The BatchSetGenerator can cache the list of batches which we generated across epochs.
@@ -670,26 +924,42 @@ class Dataset(object):
                        seq_drop=0.0,
                        max_seq_length=sys.maxsize,
                        shuffle_batches=False,
-                       used_data_keys=None):
+                       used_data_keys=None,
+                       bucket_boundaries=None,
+                       sort_window=None,
+                       shard_index=0, num_shards=1):
     """
     :type recurrent_net: bool
     :type batch_size: int
     :type max_seqs: int
     :type shuffle_batches: bool
     :param set(str)|None used_data_keys:
+    :param list[int]|None bucket_boundaries: see self._generate_batches()
+    :param int|None sort_window: see self._generate_batches()
+    :param int shard_index: with num_shards > 1, we only yield every num_shards-th batch, starting with this one
+    :param int num_shards: e.g. for multiple processes which each take a part of the dataset
     :rtype: BatchSetGenerator
     """
+    generator = self._generate_batches(
+      recurrent_net=recurrent_net,
+      batch_size=batch_size,
+      max_seqs=max_seqs,
+      seq_drop=seq_drop,
+      max_seq_length=max_seq_length,
+      used_data_keys=used_data_keys,
+      bucket_boundaries=bucket_boundaries,
+      sort_window=sort_window)
+    if num_shards > 1:
+      assert 0 <= shard_index < num_shards
+      from itertools import islice
+      generator = islice(generator, shard_index, None, num_shards)
     return BatchSetGenerator(
       dataset=self,
-      generator=self._generate_batches(
-        recurrent_net=recurrent_net,
-        batch_size=batch_size,
-        max_seqs=max_seqs,
-        seq_drop=seq_drop,
-        max_seq_length=max_seq_length,
-        used_data_keys=used_data_keys),
+      generator=generator,
       shuffle_batches=shuffle_batches,
-      cache_whole_epoch=self.batch_set_generator_cache_whole_epoch())
+      cache_whole_epoch=self.batch_set_generator_cache_whole_epoch(),
+      batches_in_seq_order=not (bucket_boundaries or sort_window),
+      num_shards=num_shards)
 
   @classmethod
   def index_shape_for_batches(cls, batches, data_key="data"):
@@ -773,6 +1043,7 @@ def init_dataset(kwargs):
       assert config
       return init_dataset(config.opt_typed_value(kwargs[len("config:"):]))
     return init_dataset_via_str(config_str=kwargs)
+  opts = kwargs
   kwargs = kwargs.copy()
   assert "class" in kwargs
   clazz_name = kwargs.pop("class")
@@ -785,9 +1056,13 @@ def init_dataset(kwargs):
   if files:
     from HDFDataset import HDFDataset, NextGenHDFDataset
     assert isinstance(obj, (HDFDataset, NextGenHDFDataset))
-    for f in files:
-      obj.add_file(f)
+    if isinstance(obj, HDFDataset):
+      obj.add_files(files)
+    else:
+      for f in files:
+        obj.add_file(f)
   obj.initialize()
+  obj.init_dataset_opts = opts.copy()
   return obj
 
 
@@ -823,10 +1098,10 @@ def init_dataset_via_str(config_str, config=None, cache_byte_size=None, **kwargs
   else:
     data = cls(**kwargs)
   if isinstance(data, HDFDataset):
-    for f in config_str.split(","):
-      if f:
-        assert os.path.exists(f)
-        data.add_file(f)
+    files = [f for f in config_str.split(",") if f]
+    for f in files:
+      assert os.path.exists(f)
+    data.add_files(files)
   data.initialize()
   return data
 
@@ -207,6 +207,7 @@ class Engine:
     self.start_epoch, self.start_batch = self.get_train_start_epoch_batch(config)
     self.batch_size = config.int('batch_size', 1)
     self.shuffle_batches = config.bool('shuffle_batches', True)
+    self.bucket_boundaries = config.int_list('bucket_boundaries', None)
     self.update_batch_size = config.int('update_batch_size', 0)
     self.model_filename = config.value('model', None)
     self.save_model_epoch_interval = config.int('save_interval', 1)
@@ -481,7 +482,8 @@ class Engine:
                                                                        max_seq_length=int(self.max_seq_length),
                                                                        seq_drop=self.seq_drop,
                                                                        shuffle_batches=self.shuffle_batches,
-                                                                       used_data_keys=self.network.get_used_data_keys())
+                                                                       used_data_keys=self.network.get_used_data_keys(),
+                                                                       bucket_boundaries=self.bucket_boundaries)
     else:
       self.dataset_batches['train'].reset()
     train_batches = self.dataset_batches['train']
@@ -495,6 +497,7 @@ class Engine:
                               report_prefix=("pre" if self.is_pretrain_epoch() else "") + "train epoch %s" % self.epoch,
                               epoch=self.epoch)
     trainer.join()
+    print("%s padding ratio: %.3f" % (self.get_epoch_str(), train_batches.get_padding_ratio()), file=log.v4)
     if not trainer.finalized:
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
         self.save_model(self.get_epoch_model_filename() + ".crash_%i" % trainer.device_crash_batch, self.epoch - 1)
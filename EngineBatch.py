@@ -1,5 +1,6 @@
 
 import random
+import numpy
 from Util import NumbersDict
 
 
@@ -42,10 +43,258 @@ class BatchSeqCopyPart:
     return "<BatchSeqCopyPart %s>" % " ".join(["%s=%r" % (k, getattr(self, k)) for k in keys])
 
 
+class _ReadOnlyNumbersDict(NumbersDict):
+  """
+  NumbersDict of a :class:`_ReadOnlyBatchSeqCopyPart`, which raises on any in-place modification.
+  The arithmetic ops still work and return a normal NumbersDict.
+  """
+
+  def _read_only(self, *args):
+    raise TypeError("%r is read-only, it belongs to a BatchSeqCopyPart created by BatchSeqCopyParts" % self)
+
+  __setitem__ = __delitem__ = pop = _read_only
+  __iadd__ = __isub__ = __imul__ = __idiv__ = __ifloordiv__ = _read_only
+
+
+class _ReadOnlyBatchSeqCopyPart(BatchSeqCopyPart):
+  """
+  The BatchSeqCopyPart which :class:`BatchSeqCopyParts` returns.
+  It is created on access, i.e. a modification would get lost silently, thus we forbid it.
+  Use :func:`BatchSeqCopyParts.append` and the other methods of BatchSeqCopyParts for modifications.
+  """
+
+  def __init__(self, **kwargs):
+    BatchSeqCopyPart.__init__(self, **kwargs)
+    for name in BatchSeqCopyParts.NumbersDictFields:
+      self.__dict__[name] = _ReadOnlyNumbersDict(getattr(self, name))
+    self.__dict__["_read_only"] = True
+
+  def __setattr__(self, key, value):
+    if self.__dict__.get("_read_only"):
+      raise AttributeError("%r is read-only, it was created by BatchSeqCopyParts" % self)
+    self.__dict__[key] = value
+
+  def __delattr__(self, key):
+    raise AttributeError("%r is read-only, it was created by BatchSeqCopyParts" % self)
+
+
+class BatchSeqCopyParts:
+  """
+  The list of BatchSeqCopyPart of a Batch, stored as a struct of arrays,
+  i.e. as a single numpy record array with one entry per part.
+  This is much more compact than a list of BatchSeqCopyPart, which has three NumbersDict per part,
+  which matters because the BatchSetGenerator can cache the batches of a whole epoch.
+  The BatchSeqCopyPart objects are only created on access, e.g. via iteration or indexing,
+  and they are read-only, as modifications of them would not be stored.
+
+  The NumbersDict values (seq_start_frame, seq_end_frame, batch_frame_offset) are stored per data key
+  in the columns for self.keys, together with a mask whether the key is set,
+  and the optional broadcast value, together with a flag whether it is set.
+  Parts added via append() are collected in a list first and get packed into the array on the next read access.
+  """
+
+  NumbersDictFields = ("seq_start_frame", "seq_end_frame", "batch_frame_offset")
+  _dtypes = {}  # type: dict[int,numpy.dtype]  # num keys -> dtype
+
+  def __init__(self):
+    self.keys = []  # type: list[str]  # data keys, columns of the NumbersDict fields
+    self._parts = None  # type: numpy.ndarray|None
+    self._pending = []  # type: list[tuple]  # via append(), not yet in self._parts
+
+  @classmethod
+  def _get_dtype(cls, num_keys):
+    """
+    :param int num_keys:
+    :rtype: numpy.dtype
+    """
+    if num_keys not in cls._dtypes:
+      # Share the dtype, as it is a big object.
+      fields = [("seq_idx", "int64"), ("batch_slice", "int32")]
+      for name in cls.NumbersDictFields:
+        fields += [
+          (name, "int64", (num_keys,)), (name + "_has", "bool", (num_keys,)),
+          (name + "_value", "int64"), (name + "_has_value", "bool")]
+      cls._dtypes[num_keys] = numpy.dtype(fields)
+    return cls._dtypes[num_keys]
+
+  @property
+  def parts(self):
+    """
+    :return: record array, shape (num_parts,)
+    :rtype: numpy.ndarray
+    """
+    self.pack()
+    if self._parts is None:
+      self._parts = numpy.zeros((0,), dtype=self._get_dtype(len(self.keys)))
+    return self._parts
+
+  def pack(self):
+    """
+    Moves the parts added via append() into the record array.
+    """
+    if not self._pending:
+      return
+    keys = set()
+    for row in self._pending:
+      for (d, _) in row[2:]:
+        keys.update(d.keys())
+    new_keys = sorted(keys.difference(self.keys))
+    old_keys = self.keys
+    self.keys = old_keys + new_keys
+    rows = []
+    for row in self._pending:
+      packed = list(row[:2])
+      for (d, value) in row[2:]:
+        packed += [[d.get(key, 0) for key in self.keys], [key in d for key in self.keys], value or 0, value is not None]
+      rows.append(tuple(packed))
+    self._pending = []
+    parts = numpy.array(rows, dtype=self._get_dtype(len(self.keys)))
+    if self._parts is not None and len(self._parts) > 0:
+      old_parts = self._parts
+      self._parts = numpy.zeros((len(old_parts),), dtype=parts.dtype)
+      for name in parts.dtype.names:
+        if name in self.NumbersDictFields or name.endswith("_has"):
+          self._parts[name][:, :len(old_keys)] = old_parts[name]
+        else:
+          self._parts[name] = old_parts[name]
+      parts = numpy.concatenate([self._parts, parts])
+    self._parts = parts
+
+  def __len__(self):
+    return (len(self._parts) if self._parts is not None else 0) + len(self._pending)
+
+  def __getitem__(self, item):
+    """
+    :param int item:
+    :return: read-only
+    :rtype: BatchSeqCopyPart
+    """
+    return self._get_part(self.parts[item])
+
+  def __iter__(self):
+    parts = self.parts
+    for i in range(len(parts)):
+      yield self._get_part(parts[i])
+
+  def __repr__(self):
+    return repr(list(self))
+
+  def _get_part(self, part):
+    """
+    :param numpy.void part:
+    :rtype: BatchSeqCopyPart
+    """
+    d = {}
+    for name in self.NumbersDictFields:
+      values, has = part[name].tolist(), part[name + "_has"].tolist()
+      d[name] = NumbersDict(
+        numbers_dict={key: value for (key, value, h) in zip(self.keys, values, has) if h},
+        broadcast_value=int(part[name + "_value"]) if part[name + "_has_value"] else None)
+    return _ReadOnlyBatchSeqCopyPart(seq_idx=int(part["seq_idx"]), batch_slice=int(part["batch_slice"]), **d)
+
+  def append(self, seq_idx, seq_start_frame, seq_end_frame, batch_slice, batch_frame_offset):
+    """
+    Adds one part. Same args as for BatchSeqCopyPart.
+
+    :param int seq_idx:
+    :param NumbersDict|int seq_start_frame:
+    :param NumbersDict|int seq_end_frame:
+    :param int batch_slice:
+    :param NumbersDict|int batch_frame_offset:
+    """
+    row = [seq_idx, batch_slice]
+    for v in (seq_start_frame, seq_end_frame, batch_frame_offset):
+      if isinstance(v, NumbersDict):
+        assert v.has_values()
+        row.append((dict(v.dict), v.value))  # copy, the caller might modify it
+      else:
+        row.append(({}, v))
+    self._pending.append(tuple(row))
+
+  def set_sequences_as_slices(self, seq_idxs, keys, lengths):
+    """
+    Like BatchSeqCopyPart(seq_idx=seq_idx, seq_start_frame=0 (for all keys), seq_end_frame=length,
+    batch_slice=i, batch_frame_offset=0) for all the seqs.
+
+    :param numpy.ndarray seq_idxs: (num_seqs,)
+    :param list[str] keys:
+    :param numpy.ndarray lengths: (num_seqs,num_keys)
+    """
+    assert len(self) == 0
+    self.keys = list(keys)
+    self._parts = numpy.zeros((len(seq_idxs),), dtype=self._get_dtype(len(self.keys)))
+    self._parts["seq_idx"] = seq_idxs
+    self._parts["batch_slice"] = numpy.arange(len(seq_idxs))
+    self._parts["seq_start_frame_has"] = True
+    self._parts["seq_end_frame"] = lengths
+    self._parts["seq_end_frame_has"] = True
+    self._parts["batch_frame_offset_has_value"] = True
+
+  def get_seq_idxs(self):
+    """
+    :rtype: numpy.ndarray
+    """
+    return self.parts["seq_idx"]
+
+  def get_batch_slices(self):
+    """
+    :rtype: numpy.ndarray
+    """
+    return self.parts["batch_slice"]
+
+  def get_key_frames(self, key):
+    """
+    Like part.seq_start_frame.get(key), part.seq_end_frame.get(key), part.batch_frame_offset.get(key)
+    for all parts at once, without creating the BatchSeqCopyPart objects.
+    Where a NumbersDict has no value for the key, this is 0.
+
+    :param str key: data key
+    :return: seq_start_frame, seq_end_frame, batch_frame_offset, each int64 (num_parts,),
+      and bool (num_parts,) whether part.frame_length.get(key) is not None
+    :rtype: (numpy.ndarray,numpy.ndarray,numpy.ndarray,numpy.ndarray)
+    """
+    parts = self.parts
+    values, defined = [], []
+    for name in self.NumbersDictFields:
+      if key in self.keys:
+        key_idx = self.keys.index(key)
+        has = parts[name + "_has"][:, key_idx]
+        values.append(numpy.where(has, parts[name][:, key_idx], parts[name + "_value"]))
+        defined.append(has | parts[name + "_has_value"])
+      else:
+        values.append(parts[name + "_value"])
+        defined.append(parts[name + "_has_value"])
+    return values[0], values[1], values[2], defined[0] | defined[1]
+
+  def get_total_frame_length(self):
+    """
+    :return: sum of part.frame_length
+    :rtype: NumbersDict
+    """
+    parts = self.parts
+    if (parts["seq_start_frame_has"].all() and parts["seq_end_frame_has"].all() and
+          not parts["seq_start_frame_has_value"].any() and not parts["seq_end_frame_has_value"].any()):
+      # Common case, all parts have all the keys and no broadcast value.
+      lengths = (parts["seq_end_frame"] - parts["seq_start_frame"]).sum(axis=0).tolist()
+      return NumbersDict(dict(zip(self.keys, lengths)))
+    if len(parts) == 0:
+      return NumbersDict(0)
+    res = NumbersDict()
+    for key_idx, key in enumerate(self.keys):
+      if not (parts["seq_start_frame_has"][:, key_idx] | parts["seq_end_frame_has"][:, key_idx]).any():
+        continue  # e.g. only in batch_frame_offset
+      start, end, _, defined = self.get_key_frames(key)
+      res[key] = int((end - start)[defined].sum())
+    has_value = parts["seq_start_frame_has_value"] | parts["seq_end_frame_has_value"]
+    if has_value.any():
+      res.value = int((parts["seq_end_frame_value"] - parts["seq_start_frame_value"])[has_value].sum())
+    return res
+
+
 class Batch:
   """
   A batch can consists of several sequences (= segments).
-  This is basically just a list of BatchSeqCopyPart.
+  This is basically just a list of BatchSeqCopyPart, see BatchSeqCopyParts.
   """
 
   def __init__(self):
@@ -53,7 +302,7 @@ class Batch:
     self.num_slices = 0
     # original data_shape = [0, 0], format (time,batch/slice)
     #          data_shape = [max_num_frames_per_slice, num_slices]
-    self.seqs = []  # type: list[BatchSeqCopyPart]
+    self.seqs = BatchSeqCopyParts()
 
   def __repr__(self):
     return "<Batch start_seq:%r, #seqs:%i>" % (self.start_seq, len(self.seqs))
@@ -75,11 +324,25 @@ class Batch:
     :param NumbersDict length: number of (time) frames
     """
     self.max_num_frames_per_slice, self.num_slices = self.try_sequence_as_slice(length)
-    self.seqs += [BatchSeqCopyPart(seq_idx=seq_idx,
-                                   seq_start_frame=seq_start_frame,
-                                   seq_end_frame=seq_start_frame + length,
-                                   batch_slice=self.num_slices - 1,
-                                   batch_frame_offset=0)]
+    self.seqs.append(seq_idx=seq_idx,
+                     seq_start_frame=seq_start_frame,
+                     seq_end_frame=seq_start_frame + length,
+                     batch_slice=self.num_slices - 1,
+                     batch_frame_offset=0)
+
+  def add_sequences_as_slices(self, seq_idxs, keys, lengths):
+    """
+    Like add_sequence_as_slice() with seq_start_frame=0 for many seqs at once, on an empty batch.
+
+    :param numpy.ndarray seq_idxs: (num_seqs,)
+    :param list[str] keys: data keys
+    :param numpy.ndarray lengths: (num_seqs,num_keys)
+    """
+    assert not self.seqs
+    self.max_num_frames_per_slice = NumbersDict.max(
+      [self.max_num_frames_per_slice, NumbersDict(dict(zip(keys, lengths.max(axis=0).tolist())))])
+    self.num_slices = len(seq_idxs)
+    self.seqs.set_sequences_as_slices(seq_idxs=seq_idxs, keys=keys, lengths=lengths)
 
   def add_frames(self, seq_idx, seq_start_frame, length, frame_dim_corresponds=True):
     """
@@ -97,11 +360,11 @@ class Batch:
       self.max_num_frames_per_slice = NumbersDict(self.max_num_frames_per_slice.max_value())
     self.max_num_frames_per_slice += length
     self.num_slices = max(self.num_slices, 1)
-    self.seqs += [BatchSeqCopyPart(seq_idx=seq_idx,
-                                   seq_start_frame=seq_start_frame,
-                                   seq_end_frame=seq_start_frame + length,
-                                   batch_slice=0,
-                                   batch_frame_offset=batch_frame_offset)]
+    self.seqs.append(seq_idx=seq_idx,
+                     seq_start_frame=seq_start_frame,
+                     seq_end_frame=seq_start_frame + length,
+                     batch_slice=0,
+                     batch_frame_offset=batch_frame_offset)
 
   def init_with_one_full_sequence(self, seq_idx, dataset):
     """
@@ -120,25 +383,39 @@ class Batch:
     return self.max_num_frames_per_slice.max_value() * self.num_slices
 
   def get_total_num_frames(self):
-    return sum([s.frame_length for s in self.seqs])
+    return self.seqs.get_total_frame_length()
 
   @property
   def start_seq(self):
     if not self.seqs:
       return None
-    return min([s.seq_idx for s in self.seqs])
+    return int(self.seqs.get_seq_idxs().min())
 
   @property
   def end_seq(self):
     if not self.seqs:
       return None
-    return max([s.seq_idx for s in self.seqs]) + 1
+    return int(self.seqs.get_seq_idxs().max()) + 1
 
   def get_num_seqs(self):
     if not self.seqs:
       return 0
     return self.end_seq - self.start_seq
 
+  def get_seq_ranges(self):
+    """
+    :return: sorted seq idx ranges (start,end) which cover exactly the seqs of this batch, e.g. for load_seqs().
+      Usually this is just [(self.start_seq, self.end_seq)], but the seqs are not consecutive
+      e.g. with bucket_boundaries, see Dataset._generate_batches().
+    :rtype: list[(int,int)]
+    """
+    if not self.seqs:
+      return []
+    seq_idxs = numpy.unique(self.seqs.get_seq_idxs())
+    splits = (numpy.flatnonzero(numpy.diff(seq_idxs) > 1) + 1).tolist()
+    return [(int(seq_idxs[start]), int(seq_idxs[end - 1]) + 1)
+            for (start, end) in zip([0] + splits, splits + [len(seq_idxs)])]
+
 
 class BatchSetGenerator:
   """
@@ -149,14 +426,20 @@ class BatchSetGenerator:
   you call self.advance() explicitly to go forward to next batches.
   """
 
-  def __init__(self, dataset, generator, shuffle_batches=True, cache_whole_epoch=True):
+  def __init__(self, dataset, generator, shuffle_batches=True, cache_whole_epoch=True,
+               batches_in_seq_order=True, num_shards=1):
     """
     :type dataset: Dataset.Dataset
     :type generator: iter[Batch]
+    :param bool batches_in_seq_order: False e.g. for bucketed batches, which jump around in the seq order.
+      Then completed_frac() counts the advanced seqs instead of using the seq idx.
+    :param int num_shards: if the generator yields only every num_shards-th batch, for completed_frac()
     """
     self.dataset = dataset
     self.generator = generator
     self.shuffle_batches = shuffle_batches
+    self.batches_in_seq_order = batches_in_seq_order
+    self.num_shards = num_shards
     # In some cases, it might be faster to cache the list of batches.
     self.cache_whole_epoch = cache_whole_epoch
     self.cache = []  # type: list[Batch]
@@ -172,6 +455,10 @@ class BatchSetGenerator:
     self.reached_end = False
     self.last_batch = None  # type: Batch
     self.current_batch_idx = 0
+    # For get_padding_ratio(). Data key "data", over all batches we advanced so far.
+    self.num_frames_with_padding = 0
+    self.num_frames_without_padding = 0
+    self.num_seqs_advanced = 0  # seqs in the batches we advanced so far. chunks of one seq count separately
 
   def reset(self):
     """
@@ -189,6 +476,7 @@ class BatchSetGenerator:
       self.reached_end = True
       return False
     else:
+      batch.seqs.pack()  # the batch is complete now
       self.buffer += [batch]
       if self.cache_whole_epoch and not self.cache_active:
         self.cache += [batch]
@@ -217,6 +505,10 @@ class BatchSetGenerator:
     assert n > 0
     self._read_next_up_to_n(n)
     assert n <= len(self.buffer)
+    for batch in self.buffer[:n]:
+      self.num_frames_with_padding += batch.max_num_frames_per_slice.get("data", 0) * batch.num_slices
+      self.num_frames_without_padding += batch.get_total_num_frames().get("data", 0)
+      self.num_seqs_advanced += len(batch.seqs)
     self.last_batch = self.buffer[n - 1]
     self.buffer = self.buffer[n:]
     self.current_batch_idx += n
@@ -230,11 +522,24 @@ class BatchSetGenerator:
       return self.dataset.generic_complete_frac(self.current_batch_idx, len(self.cache))
     if not self.last_batch:
       return self.dataset.generic_complete_frac(0, None)
+    if not self.batches_in_seq_order:
+      # The start seq of the last batch is meaningless here.
+      # Such batches are never chunked, thus each seq is counted once.
+      return self.dataset.get_complete_frac(max(self.num_seqs_advanced * self.num_shards - 1, 0))
     # We cannot use the batch idx because we don't know the number
     # of batches in advance. Thus, we use the seq idx instead.
     # It's good enough.
     return self.dataset.get_complete_frac(self.last_batch.start_seq)
 
+  def get_padding_ratio(self):
+    """
+    :return: fraction of padding frames (data key "data") in the batches we advanced so far in this epoch
+    :rtype: float
+    """
+    if not self.num_frames_with_padding:
+      return 0.0
+    return 1.0 - float(self.num_frames_without_padding) / self.num_frames_with_padding
+
   def has_more(self):
     """
     :rtype: bool
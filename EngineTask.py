@@ -725,15 +725,15 @@ class HDFForwardTaskThread(TaskThread):
       tt = 0
       feats = []
       self.num_seqs += batch.get_num_seqs()
-      for seq_idx in range(batch.start_seq, batch.end_seq):
+      for seq in batch.seqs:  # the seqs of a batch are not necessarily consecutive, e.g. with bucket_boundaries
+        seq_idx = seq.seq_idx
         if self.network.recurrent:
-          seqfeats = features[:, seq_idx - batch.start_seq]
-          if batch.end_seq - batch.start_seq > 1:
+          seqfeats = features[:, seq.batch_slice]
+          if len(batch.seqs) > 1:
             seqfeats = seqfeats[~numpy.all(seqfeats == 0,axis=1)]
           if seqfeats.shape[0] == 0:
-            seqfeats = features[:, seq_idx - batch.start_seq]
+            seqfeats = features[:, seq.batch_slice]
         else:
-          seq = batch.seqs[seq_idx - batch.start_seq]
           seqfeats = features[
                        seq.batch_frame_offset["data"]:seq.batch_frame_offset["data"] + seq.frame_length["data"],
                        seq.batch_slice]
@@ -22,39 +22,45 @@ def assign_dev_data(device, dataset, batches, load_seqs=True):
   offset_slice = 0
 
   for batch in batches:
-    if load_seqs: dataset.load_seqs(batch.start_seq, batch.end_seq)
+    if load_seqs:
+      for start, end in batch.get_seq_ranges():  # not just (start_seq, end_seq), the seqs might have gaps
+        dataset.load_seqs(start, end)
     device.num_frames += batch.get_total_num_frames()
+    # Plain int lists per key, such that we don't need to create a BatchSeqCopyPart per part.
+    seq_idxs = batch.seqs.get_seq_idxs().tolist()
+    batch_slices = batch.seqs.get_batch_slices().tolist()
+    key_frames = {k: [x.tolist() for x in batch.seqs.get_key_frames(k)] for k in device.used_data_keys}
+    # Only copy ctc targets if chunking is inactive to avoid out of range access.
+    # CTC is not compatible with chunking anyway.
+    chunking_active = dataset.chunk_size > 0
     with dataset.lock:
-      for seq in batch.seqs:
-        o = seq.batch_frame_offset
-        q = seq.batch_slice + offset_slice
-        l = seq.frame_length
+      for i, seq_idx in enumerate(seq_idxs):
+        q = batch_slices[i] + offset_slice
         # input-data, input-index will also be set in this loop. That is data-key "data".
         # targets are usually data-key "classes".
         for k in device.used_data_keys:
+          start, end, o, defined = [x[i] for x in key_frames[k]]
           # device.used_data_keys are set by the train-net, but we will also get here during forward-only,
           # e.g. via SprintInterface, where we don't have e.g. the "classes" data.
-          # In that case, l.get(k) should be None. In some earlier code, l.get(k) could also be 0 in that case.
-          if l.get(k) in [0, None]:
+          # In that case, the frame length should be None. In some earlier code, it could also be 0 in that case.
+          if not defined or end - start == 0:
             continue
-          data = dataset.get_data_slice(seq.seq_idx, k, seq.seq_start_frame[k], seq.seq_end_frame[k])
+          data = dataset.get_data_slice(seq_idx, k, start, end)
           ls = data.shape[0]
           if "[sparse:" in k:
-            assert o[k] == 0, "sparse non-recurrent batching + chunking not implemented"
+            assert o == 0, "sparse non-recurrent batching + chunking not implemented"
             _device_maybe_enlarge_data(device, k, ls)
           else:
-            if ls != l[k]:
+            if ls != end - start:
+              seq = batch.seqs[i]
               raise Exception("got shape[0]: %i, expected: %i, start/end: %r/%r, seq_idx: %i, seq len: %r" % (
-                ls, l[k], seq.seq_start_frame, seq.seq_end_frame, seq.seq_idx, dataset.get_seq_length(seq.seq_idx)))
-          device.output_index[k][o[k]:o[k] + ls, q] = numpy.ones((ls,), dtype='int8')
-          device.targets[k][o[k]:o[k] + ls, q] = data
-        # Only copy ctc targets if chunking is inactive to avoid out of range access.
-        # CTC is not compatible with chunking anyway.
-        chunking_active = dataset.chunk_size > 0
+                ls, end - start, seq.seq_start_frame, seq.seq_end_frame, seq_idx, dataset.get_seq_length(seq_idx)))
+          device.output_index[k][o:o + ls, q] = numpy.ones((ls,), dtype='int8')
+          device.targets[k][o:o + ls, q] = data
         if dataset.has_ctc_targets() and not chunking_active:
-          device.ctc_targets[q] = dataset.get_ctc_targets(seq.seq_idx)
+          device.ctc_targets[q] = dataset.get_ctc_targets(seq_idx)
 
-        device.tags[q] = dataset.get_tag(seq.seq_idx)
+        device.tags[q] = dataset.get_tag(seq_idx)
     # Note on multiple batches for the non-recurrent case:
     # We could either concatenate all into a single slice, or do multiple slices.
     # We do multiple slices here.
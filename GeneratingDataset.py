@@ -573,6 +573,13 @@ class StaticDataset(GeneratingDataset):
                       features=data["data"],
                       targets={target: data[target] for target in self.target_list})
 
+  def get_seq_length_array(self):
+    """
+    :rtype: dict[str,numpy.ndarray]
+    """
+    return {key: numpy.array([data[key].shape[0] for data in self.data])
+            for key in ["data"] + self.target_list}
+
   def get_target_list(self):
     return self.target_list
 
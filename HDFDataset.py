@@ -1,13 +1,19 @@
+from __future__ import print_function
+
 import collections
-import gc
+import functools
 import h5py
 import numpy
+import os
 import random
+import threading
+import time
 import theano
 from CachedDataset import CachedDataset
 from CachedDataset2 import CachedDataset2
 from Dataset import Dataset, DatasetSeq
 from Log import log
+from Util import hms_fraction
 
 # Common attribute names for HDF dataset, which should be used in order to be proceed with HDFDataset class.
 attr_seqLengths = 'seqLengths'
@@ -16,16 +22,150 @@ attr_numLabels = 'numLabels'
 attr_times = 'times'
 attr_ctcIndexTranscription = 'ctcIndexTranscription'
 
+# Bump this when the content of read_hdf_file_meta() changes, to invalidate old sidecar index files.
+_hdf_file_meta_version = 1
+
+
+def _get_target_num_outputs(fin, key):
+  """
+  The attrib 'targets/size' of a target is either just the dim,
+  or (dim, ndim), which is what tools/hdf_dump.py stores (it stores Dataset.num_outputs).
+
+  :param h5py.File fin:
+  :param str key: target key
+  :return: (dim, ndim)
+  :rtype: list[int]
+  """
+  size = fin['targets/size'].attrs[key]
+  if numpy.isscalar(size):
+    return [size, len(fin['targets/data'][key].shape)]
+  return size.tolist()
+
+
+def read_hdf_file_meta(filename):
+  """
+  Reads everything which HDFDataset.add_file() needs from a HDF file, i.e. all but the actual data.
+  This is a module-level function so that it can be used in a multiprocessing pool.
+
+  :param str filename:
+  :rtype: dict[str]
+  """
+  fin = h5py.File(filename, "r")
+  meta = {"target_labels": None, "labels": None, "times": None, "ctc_targets": None, "max_ctc_length": None}
+  if 'targets' in fin:
+    meta["target_labels"] = { k : [ item.decode("utf8").split('\0')[0] for item in fin["targets/labels"][k][...].tolist() ] for k in fin['targets/labels'] }
+  elif 'labels' in fin:
+    meta["labels"] = [ item.decode("utf8").split('\0')[0] for item in fin["labels"][...].tolist() ]
+  meta["tags"] = [ item.decode("utf8").split('\0')[0] for item in fin["seqTags"][...].tolist() ]
+  if 'times' in fin:
+    meta["times"] = fin[attr_times][...].tolist()
+  seq_lengths = numpy.array(fin[attr_seqLengths][...], dtype="int64")
+  if 'targets' in fin:
+    meta["target_keys"] = sorted(fin['targets/labels'].keys())
+  else:
+    meta["target_keys"] = ['classes']
+  if len(seq_lengths.shape) == 1:
+    seq_lengths = numpy.tile(seq_lengths[:, None], (1, len(meta["target_keys"]) + 1))
+  meta["seq_lengths"] = seq_lengths
+  if 'maxCTCIndexTranscriptionLength' in fin.attrs:
+    meta["max_ctc_length"] = int(fin.attrs['maxCTCIndexTranscriptionLength'])
+  if len(fin['inputs'].shape) == 1:  # sparse
+    num_inputs = [fin.attrs[attr_inputPattSize], 1]
+  else:
+    num_inputs = [fin['inputs'].shape[1], len(fin['inputs'].shape)] #fin.attrs[attr_inputPattSize]
+  meta["num_inputs"] = num_inputs
+  if 'targets/size' in fin:
+    num_outputs = {k: _get_target_num_outputs(fin, k) for k in fin['targets/size'].attrs}
+  else:
+    num_outputs = { 'classes' : fin.attrs[attr_numLabels] }
+  num_outputs["data"] = num_inputs
+  meta["num_outputs"] = num_outputs
+  if attr_ctcIndexTranscription in fin:
+    meta["ctc_targets"] = fin[attr_ctcIndexTranscription][...]
+  meta["target_dims"] = {}  # name -> (dim, dtype)
+  if 'targets' in fin:
+    for name in fin['targets/data']:
+      tdim = 1 if len(fin['targets/data'][name].shape) == 1 else fin['targets/data'][name].shape[1]
+      meta["target_dims"][name] = (tdim, str(fin['targets/data'][name].dtype) if tdim > 1 else 'int32')
+  else:
+    meta["target_dims"]['classes'] = (1, 'int32')
+  meta["input_dtype"] = str(fin['inputs'].dtype)
+  fin.close()
+  return meta
+
+
+def get_hdf_file_meta(filename, index_cache_dir=None):
+  """
+  Like read_hdf_file_meta(), but if index_cache_dir is given, it uses a sidecar index file there,
+  which is keyed by the size and the mtime of the HDF file, and which is (re)created if needed.
+
+  :param str filename:
+  :param str|None index_cache_dir:
+  :rtype: dict[str]
+  """
+  if not index_cache_dir:
+    return read_hdf_file_meta(filename)
+  import hashlib
+  import pickle
+  filename = os.path.abspath(filename)
+  stat = os.stat(filename)
+  key = (_hdf_file_meta_version, stat.st_size, int(stat.st_mtime))
+  index_filename = "%s/%s.%s.index.pickle" % (
+    index_cache_dir, os.path.basename(filename), hashlib.md5(filename.encode("utf8")).hexdigest()[:8])
+  if os.path.exists(index_filename):
+    try:
+      with open(index_filename, "rb") as f:
+        cached_key, meta = pickle.load(f)
+      if cached_key == key:
+        return meta
+    except Exception as exc:
+      print("HDF dataset: ignoring broken index file %s: %r" % (index_filename, exc), file=log.v3)
+  meta = read_hdf_file_meta(filename)
+  if not os.path.exists(index_cache_dir):
+    try:
+      os.makedirs(index_cache_dir)
+    except OSError:  # maybe created in parallel
+      pass
+  # Write to a temp file first so that parallel readers never see a partial index.
+  tmp_filename = "%s.tmp%i" % (index_filename, os.getpid())
+  with open(tmp_filename, "wb") as f:
+    pickle.dump((key, meta), f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.rename(tmp_filename, index_filename)
+  return meta
+
+
 class HDFDataset(CachedDataset):
 
-  def __init__(self, *args, **kwargs):
-    super(HDFDataset, self).__init__(*args, **kwargs)
+  def __init__(self, use_mmap=False, index_cache_dir=None, num_meta_workers=1, **kwargs):
+    """
+    :param bool use_mmap: keep one h5py handle open per file and read uncompressed datasets
+      with contiguous layout via numpy.memmap, instead of reopening every file in each _load_seqs()
+    :param str|None index_cache_dir: if given, the per-file meta data (tags, seq lengths, dims)
+      is stored there as sidecar index files, such that a restart does not need to scan the HDF files again
+    :param int num_meta_workers: default for add_files(). with >1, the meta data is read in a
+      multiprocessing pool. note that this forks, which can be a problem if TF/CUDA is already initialized
+    """
+    super(HDFDataset, self).__init__(**kwargs)
+    self.use_mmap = use_mmap
+    self.index_cache_dir = index_cache_dir
+    self.num_meta_workers = num_meta_workers
     self.files = []; """ :type: list[str] """
     self.file_start = [0]
-    self.file_seq_start = []; """ :type: list[list[int]] """
-    self.file_index = []; """ :type: list[int] """
+    self.file_seq_start = []; """ :type: list[numpy.ndarray] """
+    self.file_index = numpy.zeros((0,), dtype="int32"); """ :type: numpy.ndarray """  # real seq idx -> file idx
     self.data_dtype = {}; ":type: dict[str,str]"
     self.data_sparse = {}; ":type: dict[str,bool]"
+    self._seq_lengths = numpy.zeros((0, 0), dtype="int64")  # real seq idx -> lengths, int64, (num_seqs,1+num_targets)
+    self._seq_file_offsets = numpy.zeros((0, 0), dtype="int64")  # real seq idx -> frame offset in its file
+    self._pending_index_parts = []; """ :type: list[(numpy.ndarray,numpy.ndarray,numpy.ndarray)] """
+    self._open_files = {}; """ :type: dict[int,h5py.File] """  # file idx -> handle, only with use_mmap
+    self._open_files_lock = threading.Lock()  # for self._open_files, self._file_readers and self.bytes_read
+    self._file_readers = {}; """ :type: dict[(int,str),numpy.ndarray|h5py.Dataset] """
+    self.startup_time = 0.0  # seconds spent in add_file() and in building the index
+    self.bytes_read = 0  # bytes read from the files in the current epoch
+    self.bytes_read_per_epoch = {}; """ :type: dict[int,int] """
+    self._target_dims = {}; """ :type: dict[str,int] """
+    self._legacy_classes_target = False  # file without 'targets' group. its 'classes' buffer is zero-filled
 
   def add_file(self, filename):
     """
@@ -37,86 +177,255 @@ class HDFDataset(CachedDataset):
     Use load_seqs() to load the actual data.
     :type filename: str
     """
-    fin = h5py.File(filename, "r")
-    if 'targets' in fin:
-      self.labels = { k : [ item.decode("utf8").split('\0')[0] for item in fin["targets/labels"][k][...].tolist() ] for k in fin['targets/labels'] }
+    start_time = time.time()
+    self._add_file_meta(filename, get_hdf_file_meta(filename, index_cache_dir=self.index_cache_dir))
+    self.startup_time += time.time() - start_time
+
+  def add_files(self, filenames, num_workers=None):
+    """
+    Like add_file() for every file, but reads the per-file meta data
+    (tags, seq lengths, dims, CTC transcriptions) in a pool of worker processes.
+    With index_cache_dir, files with an up-to-date sidecar index are not scanned at all.
+
+    :param list[str] filenames:
+    :param int|None num_workers: number of worker processes. by default self.num_meta_workers.
+      with 1, no pool is used
+    """
+    start_time = time.time()
+    if num_workers is None:
+      num_workers = self.num_meta_workers
+    num_workers = max(min(num_workers, len(filenames)), 1)
+    read_meta = functools.partial(get_hdf_file_meta, index_cache_dir=self.index_cache_dir)
+    if num_workers > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(num_workers)
+      try:
+        metas = pool.map(read_meta, filenames)
+      finally:
+        pool.terminate()
+    else:
+      metas = map(read_meta, filenames)
+    for filename, meta in zip(filenames, metas):
+      self._add_file_meta(filename, meta)
+    self.startup_time += time.time() - start_time
+    print("HDF dataset scanned %i files with %i workers in %.3f sec" % (
+      len(filenames), num_workers, time.time() - start_time), file=log.v4)
+
+  def _add_file_meta(self, filename, meta):
+    """
+    :param str filename:
+    :param dict[str] meta: from get_hdf_file_meta()
+    """
+    if meta["target_labels"] is not None:
+      self.labels = meta["target_labels"]
+    self._legacy_classes_target = meta["target_labels"] is None
     if not self.labels:
-      labels = [ item.split('\0')[0] for item in fin["labels"][...].tolist() ]; """ :type: list[str] """
+      labels = meta["labels"]; """ :type: list[str] """
       self.labels = { 'classes' : labels }
       assert len(self.labels['classes']) == len(labels), "expected " + str(len(self.labels['classes'])) + " got " + str(len(labels))
-    tags = [ item.decode("utf8").split('\0')[0] for item in fin["seqTags"][...].tolist() ]; """ :type: list[str] """
+    tags = meta["tags"]; """ :type: list[str] """
     self.files.append(filename)
-    if 'times' in fin:
-      self.timestamps.extend(fin[attr_times][...].tolist())
-    seq_lengths = fin[attr_seqLengths][...]
-    if 'targets' in fin:
-      self.target_keys = sorted(fin['targets/labels'].keys())
-    else:
-      self.target_keys = ['classes']
-
-    if len(seq_lengths.shape) == 1:
-      seq_lengths = numpy.array(zip(*[seq_lengths.tolist() for i in range(len(self.target_keys)+1)]))
-
-    seq_start = [numpy.zeros((seq_lengths.shape[1],),'int64')]
+    if meta["times"] is not None:
+      self.timestamps.extend(meta["times"])
+    seq_lengths = meta["seq_lengths"]
+    self.target_keys = meta["target_keys"]
+
+    # seq_start[i] is the frame offset of seq i inside this file, seq_start[-1] the total.
+    seq_start = numpy.zeros((seq_lengths.shape[0] + 1, seq_lengths.shape[1]), dtype="int64")
+    numpy.cumsum(seq_lengths, axis=0, out=seq_start[1:])
     if not self._seq_start:
       self._seq_start = [numpy.zeros((seq_lengths.shape[1],),'int64')]
-    for l in seq_lengths:
-      self._seq_lengths.append(numpy.array(l))
-      seq_start.append(seq_start[-1] + l)
     self.tags += tags
     self.file_seq_start.append(seq_start)
-    nseqs = len(seq_start) - 1
-    for i in range(nseqs):
-      self.tag_idx[tags[i]] = i + self._num_seqs
+    nseqs = seq_lengths.shape[0]
+    self.tag_idx.update(zip(tags, range(self._num_seqs, self._num_seqs + nseqs)))
     self._num_seqs += nseqs
-    self.file_index.extend([len(self.files) - 1] * nseqs)
+    self._pending_index_parts.append(
+      (seq_lengths, seq_start[:-1], numpy.full((nseqs,), len(self.files) - 1, dtype="int32"), meta["ctc_targets"]))
     self.file_start.append(self.file_start[-1] + nseqs)
-    self._num_timesteps = sum([s[0] for s in self._seq_lengths])
-    self._num_codesteps = [ sum([s[i] for s in self._seq_lengths]) for i in range(1,len(self._seq_lengths[0])) ]
-    if 'maxCTCIndexTranscriptionLength' in fin.attrs:
-      self.max_ctc_length = max(self.max_ctc_length, fin.attrs['maxCTCIndexTranscriptionLength'])
-    if len(fin['inputs'].shape) == 1:  # sparse
-      num_inputs = [fin.attrs[attr_inputPattSize], 1]
-    else:
-      num_inputs = [fin['inputs'].shape[1], len(fin['inputs'].shape)] #fin.attrs[attr_inputPattSize]
+    self._num_timesteps += int(seq_start[-1][0])
+    if not self._num_codesteps:
+      self._num_codesteps = [0] * (seq_lengths.shape[1] - 1)
+    self._num_codesteps = [n + int(seq_start[-1][i + 1]) for i, n in enumerate(self._num_codesteps)]
+    if meta["max_ctc_length"] is not None:
+      self.max_ctc_length = max(self.max_ctc_length, meta["max_ctc_length"])
+    num_inputs = meta["num_inputs"]
     if self.num_inputs == 0:
       self.num_inputs = num_inputs[0]
     assert self.num_inputs == num_inputs[0], "wrong input dimension in file %s (expected %s got %s)" % (
                                              filename, self.num_inputs, num_inputs[0])
-    if 'targets/size' in fin:
-      num_outputs = { k : [fin['targets/size'].attrs[k], len(fin['targets/data'][k].shape)] for k in fin['targets/size'].attrs }
-    else:
-      num_outputs = { 'classes' : fin.attrs[attr_numLabels] }
-    num_outputs["data"] = num_inputs
+    num_outputs = meta["num_outputs"]
     if not self.num_outputs:
       self.num_outputs = num_outputs
     assert self.num_outputs == num_outputs, "wrong dimensions in file %s (expected %s got %s)" % (
                                             filename, self.num_outputs, num_outputs)
-    if 'ctcIndexTranscription' in fin:
-      if self.ctc_targets is None:
-        self.ctc_targets = fin['ctcIndexTranscription'][...]
-      else:
-        tmp = fin['ctcIndexTranscription'][...]
-        pad_width = self.max_ctc_length - tmp.shape[1]
-        tmp = numpy.pad(tmp, ((0,0),(0,pad_width)), 'constant', constant_values=-1)
-        pad_width = self.max_ctc_length - self.ctc_targets.shape[1]
-        self.ctc_targets = numpy.pad(self.ctc_targets, ((0,0),(0,pad_width)), 'constant', constant_values=-1)
-        self.ctc_targets = numpy.concatenate((self.ctc_targets, tmp))
+    for name, (tdim, dtype) in meta["target_dims"].items():
+      self.data_dtype[name] = dtype
+      self._target_dims[name] = tdim
+    self.data_dtype["data"] = meta["input_dtype"]
+    assert len(self.target_keys) == seq_lengths.shape[1] - 1
+
+  def _build_index(self):
+    """
+    Merges the per-file index parts collected by add_file() into the contiguous arrays
+      self._seq_lengths, self._seq_file_offsets, self.file_index, self.ctc_targets
+    and allocates the target buffers. This is done only once for all added files,
+    so adding many files stays linear in the number of seqs.
+    """
+    if not self._pending_index_parts:
+      return
+    start_time = time.time()
+    seq_lengths, seq_offsets, file_index, ctc_targets = zip(*self._pending_index_parts)
+    if self._seq_lengths.size > 0:
+      seq_lengths = (self._seq_lengths,) + seq_lengths
+      seq_offsets = (self._seq_file_offsets,) + seq_offsets
+      file_index = (self.file_index,) + file_index
+    self._seq_lengths = numpy.concatenate(seq_lengths, axis=0)
+    self._seq_file_offsets = numpy.concatenate(seq_offsets, axis=0)
+    self.file_index = numpy.concatenate(file_index, axis=0)
+    ctc_targets = [x for x in ctc_targets if x is not None]
+    if ctc_targets:
+      if self.ctc_targets is not None:
+        ctc_targets.insert(0, self.ctc_targets)
+      # Pad all transcriptions with -1 to the common max length in one go.
+      width = max([self.max_ctc_length] + [x.shape[1] for x in ctc_targets])
+      merged = numpy.full((sum([x.shape[0] for x in ctc_targets]), width), -1, dtype=ctc_targets[0].dtype)
+      offset = 0
+      for x in ctc_targets:
+        merged[offset:offset + x.shape[0], :x.shape[1]] = x
+        offset += x.shape[0]
+      self.ctc_targets = merged
       self.num_running_chars = numpy.sum(self.ctc_targets != -1)
-    if 'targets' in fin:
-      for name in fin['targets/data']:
-        tdim = 1 if len(fin['targets/data'][name].shape) == 1 else fin['targets/data'][name].shape[1]
-        self.data_dtype[name] = str(fin['targets/data'][name].dtype) if tdim > 1 else 'int32'
-        if self.data_dtype[name] == 'int32':
-          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],), dtype=theano.config.floatX) - 1
-        else:
-          self.targets[name] = numpy.zeros((self._num_codesteps[self.target_keys.index(name)],tdim), dtype=theano.config.floatX) - 1
-    else:
-      self.targets = { 'classes' : numpy.zeros((self._num_timesteps,), dtype=theano.config.floatX)  }
-      self.data_dtype['classes'] = 'int32'
-    self.data_dtype["data"] = fin['inputs'].dtype
-    assert len(self.target_keys) == len(self._seq_lengths[0]) - 1
-    fin.close()
+    self._pending_index_parts = []
+    assert self._seq_lengths.shape[0] == self._num_seqs
+    for name, tdim in self._target_dims.items():
+      num_frames = self._num_codesteps[self.target_keys.index(name)]
+      # Legacy files (without 'targets' group) never fill 'classes', and it always was zeros there.
+      fill_value = 0 if (self._legacy_classes_target and name == 'classes') else -1
+      if self.data_dtype[name] == 'int32':
+        self.targets[name] = numpy.full((num_frames,), fill_value, dtype=theano.config.floatX)
+      else:
+        self.targets[name] = numpy.full((num_frames, tdim), fill_value, dtype=theano.config.floatX)
+    self.startup_time += time.time() - start_time
+
+  def initialize(self):
+    self._build_index()
+    super(HDFDataset, self).initialize()
+    print("HDF dataset startup time: %.3f sec for %i files" % (self.startup_time, len(self.files)), file=log.v4)
+
+  def init_seq_order(self, epoch=None, seq_list=None):
+    """
+    :type epoch: int|None
+    :param list[str] | None seq_list: In case we want to set a predefined order.
+    """
+    self._build_index()
+    if self.epoch is not None and epoch != self.epoch:
+      with self._open_files_lock:
+        self.bytes_read_per_epoch[self.epoch], self.bytes_read = self.bytes_read, 0
+      print("HDF dataset read %i bytes in epoch %i" % (self.bytes_read_per_epoch[self.epoch], self.epoch), file=log.v4)
+    return super(HDFDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+
+  def _get_file(self, file_idx):
+    """
+    :param int file_idx: index in self.files
+    :return: h5py file handle. with use_mmap, it stays open, otherwise the caller must close it
+    :rtype: h5py.File
+    """
+    with self._open_files_lock:  # the prefetch thread reads without self.lock
+      if file_idx in self._open_files:
+        return self._open_files[file_idx]
+      fin = h5py.File(self.files[file_idx], "r")
+      if self.use_mmap:
+        self._open_files[file_idx] = fin
+      return fin
+
+  def _get_file_reader(self, file_idx, fin, name):
+    """
+    :param int file_idx: index in self.files
+    :param h5py.File fin: from self._get_file()
+    :param str name: HDF dataset name, e.g. "inputs" or "targets/data/classes"
+    :return: something which can be sliced along the time axis.
+      with use_mmap, this is a read-only numpy.memmap if the HDF dataset is uncompressed and
+      has contiguous layout, otherwise the h5py dataset
+    :rtype: numpy.ndarray|h5py.Dataset
+    """
+    if not self.use_mmap:
+      return fin[name]
+    key = (file_idx, name)
+    with self._open_files_lock:  # the prefetch thread reads without self.lock
+      if key not in self._file_readers:
+        ds = fin[name]
+        reader = ds
+        offset = ds.id.get_offset() if ds.chunks is None and ds.compression is None else None
+        if offset is not None and ds.dtype.kind in "biuf" and ds.size > 0:
+          reader = numpy.memmap(self.files[file_idx], mode="r", dtype=ds.dtype, shape=ds.shape, offset=offset)
+        self._file_readers[key] = reader
+      return self._file_readers[key]
+
+  def _read_file_slice(self, reader, start, end):
+    """
+    :param numpy.ndarray|h5py.Dataset reader: from self._get_file_reader()
+    :param int start: frame
+    :param int end: frame, exclusive
+    :return: reader[start:end]. for a memmap this is a view, i.e. there is no extra copy
+    :rtype: numpy.ndarray
+    """
+    data = reader[start:end]
+    with self._open_files_lock:  # the prefetch thread reads without self.lock
+      self.bytes_read += data.nbytes
+    return data
+
+  def close_files(self):
+    """
+    Closes all file handles which were kept open because of use_mmap.
+    """
+    with self._open_files_lock:
+      self._file_readers.clear()
+      for fin in self._open_files.values():
+        fin.close()
+      self._open_files.clear()
+
+  def _read_seqs_data(self, seq_idxs, copy=True):
+    """
+    Reads the inputs and targets of the given seqs from the files.
+    This does not touch the cache, see CachedDataset._read_seqs_data().
+
+    :param list[int] seq_idxs: sorted seq idxs
+    :param bool copy: with use_mmap, we get views into the memmap, i.e. nothing is really read yet.
+      copy=True enforces the read. _load_seqs() does not need this, as it copies the data anyway
+    :return: sorted seq idx -> (inputs, target key -> targets)
+    :rtype: dict[int,(numpy.ndarray,dict[str,numpy.ndarray])]
+    """
+    file_info = [ [] for l in range(len(self.files)) ]; """ :type: list[list[int]] """
+    # file_info[i] is (sorted seq idx from selection, real seq idx)
+    with self.lock:  # the prefetch thread calls this without the lock, and init_seq_order() changes _seq_index
+      seq_idxs = [(idc, self._seq_index[idc]) for idc in seq_idxs]
+    for idc, ids in seq_idxs:
+      file_info[self.file_index[ids]].append((idc,ids))
+    res = {}
+    for i in range(len(self.files)):
+      if len(file_info[i]) == 0:
+        continue
+      print("loading file", self.files[i], file=log.v4)
+      fin = self._get_file(i)
+      target_names = list(fin['targets/data']) if 'targets' in fin else []
+      for idc, ids in file_info[i]:
+        p = self._seq_file_offsets[ids]
+        l = self._seq_lengths[ids]
+        targets = {}
+        for k in target_names:
+          ldx = self.target_keys.index(k) + 1
+          reader = self._get_file_reader(i, fin, 'targets/data/' + k)
+          targets[k] = self._read_file_slice(reader, p[ldx], p[ldx] + l[ldx])
+        reader = self._get_file_reader(i, fin, 'inputs')
+        inputs = self._read_file_slice(reader, p[0], p[0] + l[0])
+        if copy and isinstance(reader, numpy.memmap):
+          inputs = numpy.array(inputs)
+          targets = {k: numpy.array(v) for (k, v) in targets.items()}
+        res[idc] = (inputs, targets)
+      if not self.use_mmap:
+        fin.close()
+    return res
 
   def _load_seqs(self, start, end):
     """
@@ -133,27 +442,15 @@ class HDFDataset(CachedDataset):
     assert end <= self.num_seqs
     selection = self.insert_alloc_interval(start, end)
     assert len(selection) <= end - start, "DEBUG: more sequences requested (" + str(len(selection)) + ") as required (" + str(end-start) + ")"
-    file_info = [ [] for l in range(len(self.files)) ]; """ :type: list[list[int]] """
-    # file_info[i] is (sorted seq idx from selection, real seq idx)
+    data = {idc: self._prefetched_data.pop(idc) for idc in selection if idc in self._prefetched_data}
+    data.update(self._read_seqs_data([idc for idc in selection if idc not in data], copy=False))
     for idc in selection:
-      ids = self._seq_index[idc]
-      file_info[self.file_index[ids]].append((idc,ids))
-    for i in range(len(self.files)):
-      if len(file_info[i]) == 0:
-        continue
-      print >> log.v4, "loading file", self.files[i]
-      fin = h5py.File(self.files[i], 'r')
-      for idc, ids in file_info[i]:
-        s = ids - self.file_start[i]
-        p = self.file_seq_start[i][s]
-        l = self._seq_lengths[ids]
-        if 'targets' in fin:
-          for k in fin['targets/data']:
-            ldx = self.target_keys.index(k) + 1
-            self.targets[k][self.get_seq_start(idc)[ldx]:self.get_seq_start(idc)[ldx] + l[ldx]] = fin['targets/data/' + k][p[ldx] : p[ldx] + l[ldx]] #[...]
-        self._set_alloc_intervals_data(idc, data=fin['inputs'][p[0] : p[0] + l[0]][...])
-      fin.close()
-    gc.collect()
+      inputs, targets = data[idc]
+      for k, x in targets.items():
+        ldx = self.target_keys.index(k) + 1
+        t_start = self.get_seq_start(idc)[ldx]
+        self.targets[k][t_start:t_start + x.shape[0]] = x
+      self._set_alloc_intervals_data(idc, data=inputs)
     assert self.is_cached(start, end)
 
   def get_tag(self, sorted_seq_idx):
@@ -175,6 +472,261 @@ class HDFDataset(CachedDataset):
                       "sequences: %i" % self.num_seqs,
                       "frames: %i" % self.get_num_timesteps()])
 
+
+class BufferedHDFWriter(object):
+  """
+  Writes seqs into a HDF file in the format which :class:`HDFDataset` reads,
+  i.e. "inputs", "seqLengths", "seqTags" and the attribs numTimesteps, numSeqs, etc.
+  The frames are accumulated in memory and written in large blocks,
+  the HDF datasets are chunked and grow geometrically, and the attribs and seq tags are written once at the end.
+  This avoids the HDF metadata updates per seq, which are otherwise the main cost for large corpora.
+  With background=True, the writing happens in a thread, such that it overlaps with the caller,
+  e.g. the next session run in :func:`TFEngine.Engine.forward_to_hdf`.
+  """
+
+  def __init__(self, filename, dim, input_patt_size, num_labels, labels=None,
+               block_num_frames=100000, chunk_num_frames=10000, compression=None, background=True,
+               with_seq_idx=False):
+    """
+    :param str filename: output HDF file
+    :param int dim: feature dim of the written "inputs"
+    :param int input_patt_size: the attrib inputPattSize
+    :param int num_labels: the attrib numLabels
+    :param list[str]|None labels:
+    :param int block_num_frames: num of frames which we accumulate until we write them
+    :param int chunk_num_frames: HDF chunk size in frames
+    :param str|None compression: HDF compression of "inputs", e.g. "gzip" or "lzf"
+    :param bool background: write in a background thread
+    :param bool with_seq_idx: insert_batch() gets the seq idx, and we write it as "seqIdx".
+      e.g. for the shards of a sharded forwarding, such that :func:`merge_hdf_files` can restore the seq order
+    """
+    from Util import hdf5_strings
+    self.filename = filename
+    self.dim = dim
+    self.block_num_frames = block_num_frames
+    self.file = h5py.File(filename, "w")
+    self.file.attrs['numTimesteps'] = 0
+    self.file.attrs['inputPattSize'] = input_patt_size
+    self.file.attrs['numDims'] = 1
+    self.file.attrs['numLabels'] = num_labels
+    self.file.attrs['numSeqs'] = 0
+    if labels:
+      hdf5_strings(self.file, 'labels', labels)
+    else:
+      self.file.create_dataset('labels', (0,), dtype="S5")
+    self._chunk_num_frames = chunk_num_frames
+    self._compression = compression
+    self._inputs = None  # type: h5py.Dataset  # created with the first block, when we know the dtype
+    self._seq_lengths = self.file.create_dataset(
+      "seqLengths", (0, 2), dtype='i', maxshape=(None, 2), chunks=(max(chunk_num_frames // 100, 1), 2))
+    self.num_timesteps = 0  # written to the file
+    self.num_seqs = 0  # written to the file
+    self.tags = []  # type: list[str]
+    self.seq_idxs = [] if with_seq_idx else None  # type: list[int]|None
+    self._block = []  # type: list[numpy.ndarray]
+    self._block_num_frames = 0
+    self._block_seq_lengths = []  # type: list[int]
+    self.write_time = 0.0
+    self._thread = None
+    self._queue = None
+    self._exc_info = None
+    if background:
+      from threading import Thread
+      try:
+        # noinspection PyCompatibility
+        from Queue import Queue
+      except ImportError:
+        # noinspection PyCompatibility
+        from queue import Queue
+      self._queue = Queue(maxsize=10)  # num of batches. the caller blocks if we cannot keep up with writing
+      self._thread = Thread(target=self._thread_main, name="BufferedHDFWriter %s" % filename)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _thread_main(self):
+    import sys
+    import better_exchook
+    better_exchook.install()
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+      if self._exc_info:
+        continue  # still consume the queue, such that the caller does not block
+      try:
+        self._insert_batch(*item)
+      except Exception:
+        self._exc_info = sys.exc_info()
+
+  def _check_exception(self):
+    if self._exc_info:
+      import sys
+      exc_info, self._exc_info = self._exc_info, None
+      sys.excepthook(*exc_info)  # the original traceback would get lost otherwise
+      raise exc_info[1]
+
+  def insert_batch(self, inputs, seq_len, seq_tag, seq_idx=None):
+    """
+    :param numpy.ndarray inputs: shape=(n_batch,time,dim), batch-major, padded
+    :param list[int]|numpy.ndarray seq_len: len n_batch
+    :param list[str] seq_tag: len n_batch
+    :param list[int]|numpy.ndarray|None seq_idx: len n_batch. only with with_seq_idx
+    """
+    assert inputs.ndim == 3 and inputs.shape[2] == self.dim
+    assert len(seq_len) == len(seq_tag) == inputs.shape[0]
+    assert (seq_idx is not None) == (self.seq_idxs is not None)
+    if self._thread:
+      self._check_exception()
+      self._queue.put((inputs, seq_len, seq_tag, seq_idx))
+    else:
+      self._insert_batch(inputs, seq_len, seq_tag, seq_idx)
+
+  def _insert_batch(self, inputs, seq_len, seq_tag, seq_idx):
+    """
+    :param numpy.ndarray inputs: shape=(n_batch,time,dim)
+    :param list[int]|numpy.ndarray seq_len:
+    :param list[str] seq_tag:
+    :param list[int]|numpy.ndarray|None seq_idx:
+    """
+    for i in range(inputs.shape[0]):
+      self._block.append(inputs[i, :seq_len[i]])
+      self._block_num_frames += int(seq_len[i])
+      self._block_seq_lengths.append(int(seq_len[i]))
+      self.tags.append(seq_tag[i])
+      if seq_idx is not None:
+        self.seq_idxs.append(int(seq_idx[i]))
+    if self._block_num_frames >= self.block_num_frames:
+      self._write_block()
+
+  @staticmethod
+  def _grow(dataset, min_size):
+    """
+    :param h5py.Dataset dataset:
+    :param int min_size: needed size of axis 0
+    """
+    if dataset.shape[0] >= min_size:
+      return
+    dataset.resize(max(min_size, dataset.shape[0] * 2), axis=0)
+
+  def _write_block(self):
+    """
+    Writes the accumulated frames and seq lengths into the file.
+    """
+    if not self._block_seq_lengths:
+      return
+    start_time = time.time()
+    block = numpy.concatenate(self._block, axis=0) if self._block_num_frames else None
+    if self._inputs is None:
+      dtype = block.dtype if block is not None else self._block[0].dtype
+      self._inputs = self.file.create_dataset(
+        'inputs', (0, self.dim), dtype=dtype, maxshape=(None, self.dim),
+        chunks=(self._chunk_num_frames, self.dim), compression=self._compression)
+    if block is not None:
+      self._grow(self._inputs, self.num_timesteps + block.shape[0])
+      self._inputs[self.num_timesteps:self.num_timesteps + block.shape[0]] = block
+      self.num_timesteps += block.shape[0]
+    num_seqs = len(self._block_seq_lengths)
+    self._grow(self._seq_lengths, self.num_seqs + num_seqs)
+    seq_lengths = numpy.array(self._block_seq_lengths, dtype="int32")
+    self._seq_lengths[self.num_seqs:self.num_seqs + num_seqs] = numpy.stack([seq_lengths, seq_lengths], axis=1)
+    self.num_seqs += num_seqs
+    self._block = []
+    self._block_num_frames = 0
+    self._block_seq_lengths = []
+    self.write_time += time.time() - start_time
+
+  def close(self):
+    """
+    Writes the remaining frames, the seq tags and the attribs, and closes the file.
+    """
+    if self._thread:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+      self._check_exception()
+    self._write_block()
+    if self._inputs is None:
+      self._inputs = self.file.create_dataset('inputs', (0, self.dim), dtype="float32", maxshape=(None, self.dim))
+    # Trim the geometric over-allocation.
+    self._inputs.resize(self.num_timesteps, axis=0)
+    self._seq_lengths.resize(self.num_seqs, axis=0)
+    self.file.attrs['numTimesteps'] = self.num_timesteps
+    self.file.attrs['numSeqs'] = self.num_seqs
+    max_tag_len = max([len(d) for d in self.tags] or [0])
+    self.file.create_dataset(
+      'seqTags', data=numpy.array(self.tags, dtype="S%i" % (max_tag_len + 1)).reshape((len(self.tags),)))
+    if self.seq_idxs is not None:
+      self.file.create_dataset('seqIdx', data=numpy.array(self.seq_idxs, dtype="int64").reshape((len(self.tags),)))
+    self.file.close()
+    print("BufferedHDFWriter: wrote %i seqs, %i frames to %r, write time %s" % (
+      self.num_seqs, self.num_timesteps, self.filename, hms_fraction(self.write_time)), file=log.v4)
+
+
+def merge_hdf_files(filenames, output_file, block_num_frames=1000000):
+  """
+  Merges HDF files as written by :class:`BufferedHDFWriter` (e.g. the shards of a sharded forwarding)
+  into one file in the same format, i.e. which can be read by :class:`HDFDataset`.
+  If all files have the "seqIdx" (see BufferedHDFWriter with_seq_idx), the seqs are sorted by it,
+  otherwise the seqs are just concatenated in the order of the files.
+
+  :param list[str] filenames:
+  :param str output_file:
+  :param int block_num_frames: we copy the inputs in blocks of up to this size
+  """
+  start_time = time.time()
+  fins = [h5py.File(fn, "r") for fn in filenames]
+  assert fins
+  num_timesteps = [fin["inputs"].shape[0] for fin in fins]
+  num_seqs = [fin["seqLengths"].shape[0] for fin in fins]
+  dims = set([fin["inputs"].shape[1:] for fin in fins])
+  assert len(dims) == 1, "different dims %r in %r" % (dims, filenames)
+  # All seqs, as (file idx, seq idx in file, frame offset in file, num frames), in the order of the output.
+  seqs = []
+  for file_idx, fin in enumerate(fins):
+    seq_lens = fin["seqLengths"][...][:, 0].tolist()
+    offsets = numpy.cumsum([0] + seq_lens[:-1]).tolist()
+    seqs += [(file_idx, i, offsets[i], seq_lens[i]) for i in range(num_seqs[file_idx])]
+  if all(["seqIdx" in fin for fin in fins]):
+    seq_sort_keys = sum([fin["seqIdx"][...].tolist() for fin in fins], [])
+    seqs = [seq for (_, seq) in sorted(zip(seq_sort_keys, seqs))]
+  tags = [[tag.decode("utf8") if isinstance(tag, bytes) else tag for tag in fin["seqTags"][...].tolist()] for fin in fins]
+  fout = h5py.File(output_file, "w")
+  for key, value in fins[0].attrs.items():
+    fout.attrs[key] = value
+  fout.attrs['numTimesteps'] = sum(num_timesteps)
+  fout.attrs['numSeqs'] = sum(num_seqs)
+  fins[0].copy("labels", fout)
+  inputs = fout.create_dataset(
+    "inputs", (sum(num_timesteps),) + fins[0]["inputs"].shape[1:], dtype=fins[0]["inputs"].dtype,
+    maxshape=(None,) + fins[0]["inputs"].shape[1:],
+    chunks=fins[0]["inputs"].chunks, compression=fins[0]["inputs"].compression)
+  # Copy runs of seqs which are consecutive in the same input file at once.
+  offset = 0
+  i = 0
+  while i < len(seqs):
+    file_idx, _, start, num_frames = seqs[i]
+    j = i + 1
+    while (j < len(seqs) and seqs[j][0] == file_idx and seqs[j][1] == seqs[j - 1][1] + 1
+           and num_frames + seqs[j][3] <= block_num_frames):
+      num_frames += seqs[j][3]
+      j += 1
+    inputs[offset:offset + num_frames] = fins[file_idx]["inputs"][start:start + num_frames]
+    offset += num_frames
+    i = j
+  seq_lens = numpy.array([num_frames for (_, _, _, num_frames) in seqs], dtype="int32").reshape((len(seqs),))
+  fout.create_dataset("seqLengths", data=numpy.stack([seq_lens, seq_lens], axis=1))
+  seq_tags = [tags[file_idx][i] for (file_idx, i, _, _) in seqs]
+  max_tag_len = max([len(tag) for tag in seq_tags] or [0])
+  fout.create_dataset(
+    'seqTags', data=numpy.array(seq_tags, dtype="S%i" % (max_tag_len + 1)).reshape((len(seq_tags),)))
+  for fin in fins:
+    fin.close()
+  fout.close()
+  print("Merged %i HDF files with %i seqs, %i frames into %r, took %s" % (
+    len(filenames), sum(num_seqs), sum(num_timesteps), output_file, hms_fraction(time.time() - start_time)),
+    file=log.v4)
+
+
 # ------------------------------------------------------------------------------
 
 class StreamParser(object):
@@ -2,12 +2,13 @@
 from __future__ import print_function
 
 import os
+import re
 import sys
 from Dataset import DatasetSeq
 from CachedDataset2 import CachedDataset2
 import gzip
 import xml.etree.ElementTree as etree
-from Util import parse_orthography, parse_orthography_into_symbols, load_json, BackendEngine, unicode
+from Util import parse_orthography_into_symbols, load_json, BackendEngine, unicode
 from Log import log
 import numpy
 import time
@@ -15,6 +16,7 @@ from random import Random
 
 
 class LmDataset(CachedDataset2):
+  orth_encode_batch_size = 100  # num of orths which we encode at once, see OrthSymbolsEncoder
 
   def __init__(self,
                corpus_file,
@@ -34,9 +36,12 @@ class LmDataset(CachedDataset2):
                error_on_invalid_seq=True,
                add_delayed_seq_data=False,
                delayed_seq_data_start_symbol="[START]",
+               streaming=False,
+               index_cache_dir=None,
                **kwargs):
     """
-    :param str|()->str corpus_file: Bliss XML or line-based txt. optionally can be gzip.
+    :param str|list[str]|()->str corpus_file: Bliss XML or line-based txt. optionally can be gzip.
+      can also be a list of such files (shards), which are concatenated.
     :param dict|None phone_info: if you want to get phone seqs, dict with lexicon_file etc. see PhoneSeqGenerator
     :param str|()->str|None orth_symbols_file: list of orthography symbols, if you want to get orth symbol seqs
     :param str|()->str|None orth_symbols_map_file: list of orth symbols, each line: "symbol index"
@@ -55,6 +60,10 @@ class LmDataset(CachedDataset2):
       delayed_seq_data_start_symbol + original_sequence[:-1]
     :param str delayed_seq_data_start_symbol: used for add_delayed_seq_data
     :param int partition_epoch: whether to partition the epochs into multiple parts. like epoch_split
+    :param bool streaming: do not load the corpus into memory, but only a byte-offset line index,
+      and read the lines lazily via mmap. only for uncompressed line-based txt files. see :class:`MmapTxtLines`
+    :param str|None index_cache_dir: for streaming, stores the line index of each corpus file there,
+      such that a restart does not need to scan the corpus again
     """
     super(LmDataset, self).__init__(**kwargs)
 
@@ -148,13 +157,25 @@ class LmDataset(CachedDataset2):
     self.delayed_seq_data_start_symbol = delayed_seq_data_start_symbol
     if add_delayed_seq_data:
       self.num_outputs["delayed"] = self.num_outputs["data"]
-
-    if _is_bliss(corpus_file):
-      iter_f = _iter_bliss
+    self.orth_encoder = None
+    if self.orth_symbols:
+      self.orth_encoder = OrthSymbolsEncoder(
+        orth_symbols_map=self.orth_symbols_map, orth_replace_map=self.orth_replace_map,
+        parse_orth_opts=self.parse_orth_opts, unknown_symbol=self.unknown_symbol,
+        auto_replace_unknown_symbol=self.auto_replace_unknown_symbol, dtype=self.dtype)
+    self._encoded_orths = {}  # orth idx in seq order -> result of OrthSymbolsEncoder.encode_batch()
+
+    if isinstance(corpus_file, (str, unicode)):
+      corpus_file = [corpus_file]
+    if streaming:
+      self.orths = MmapTxtLines(corpus_file, index_cache_dir=index_cache_dir)
     else:
-      iter_f = _iter_txt
-    self.orths = []
-    iter_f(corpus_file, self.orths.append)
+      self.orths = []
+      for corpus_file_ in corpus_file:
+        if _is_bliss(corpus_file_):
+          _iter_bliss(corpus_file_, self.orths.append)
+        else:
+          _iter_txt(corpus_file_, self.orths.append)
     # It's only estimated because we might filter some out or so.
     self._estimated_num_seqs = len(self.orths) // self.partition_epoch
     print("  done, loaded %i sequences" % len(self.orths), file=log.v4)
@@ -172,12 +193,17 @@ class LmDataset(CachedDataset2):
     self.orths_epoch = self.orths[
                        len(self.orths) * (epoch % self.partition_epoch) // self.partition_epoch:
                        len(self.orths) * ((epoch % self.partition_epoch) + 1) // self.partition_epoch]
+    if isinstance(self.orths_epoch, MmapTxtLines):
+      get_seq_len = self.orths_epoch.get_byte_len  # does not need to read the line
+    else:
+      get_seq_len = lambda i: len(self.orths_epoch[i])
     self.seq_order = self.get_seq_order_for_epoch(
-      epoch=epoch, num_seqs=len(self.orths_epoch), get_seq_len=lambda i: len(self.orths_epoch[i]))
+      epoch=epoch, num_seqs=len(self.orths_epoch), get_seq_len=get_seq_len)
     self.next_orth_idx = 0
     self.next_seq_idx = 0
     self.num_skipped = 0
     self.num_unknown = 0
+    self._encoded_orths = {}
     if self.seq_gen:
       self.seq_gen.random_seed(epoch)
     return True
@@ -200,6 +226,26 @@ class LmDataset(CachedDataset2):
     if not self.log_auto_replace_unknown_symbols:
       print("LmDataset: will stop logging about auto-replace with unknown symbol now", file=log.v4)
 
+  def _get_encoded_orth(self, orth_idx):
+    """
+    Encodes the orths in seq order in batches of orth_encode_batch_size via self.orth_encoder.
+
+    :param int orth_idx: in seq order
+    :return: id seq, or the missing orth symbol, see OrthSymbolsEncoder.encode_batch()
+    :rtype: numpy.ndarray|str
+    """
+    if orth_idx not in self._encoded_orths:
+      orth_idxs = range(orth_idx, min(orth_idx + self.orth_encode_batch_size, len(self.orths_epoch)))
+      orths = [self.orths_epoch[self.seq_order[i]] for i in orth_idxs]
+      self._encoded_orths = dict(zip(orth_idxs, self.orth_encoder.encode_batch(orths)))
+      for orth_sym in self.orth_encoder.auto_replaced_symbols:
+        if self.log_auto_replace_unknown_symbols:
+          print("LmDataset: unknown orth symbol %r, adding to orth_replace_map as %r" % (
+            orth_sym, self.unknown_symbol), file=log.v3)
+          self._reduce_log_auto_replace_unknown_symbols()
+      del self.orth_encoder.auto_replaced_symbols[:]
+    return self._encoded_orths.pop(orth_idx)
+
   def _collect_single_seq(self, seq_idx):
     """
     :type seq_idx: int
@@ -215,7 +261,7 @@ class LmDataset(CachedDataset2):
       assert self.next_seq_idx == seq_idx, "We expect that we iterate through all seqs."
       orth = self.orths_epoch[self.seq_order[self.next_orth_idx]]
       self.next_orth_idx += 1
-      if orth == "</s>": continue  # special sentence end symbol. empty seq, ignore.
+      if not orth or orth == "</s>": continue  # special sentence end symbol. empty seq, ignore.
 
       if self.seq_gen:
         try:
@@ -231,41 +277,17 @@ class LmDataset(CachedDataset2):
         data = self.seq_gen.seq_to_class_idxs(phones, dtype=self.dtype)
 
       elif self.orth_symbols:
-        orth_syms = parse_orthography(orth, **self.parse_orth_opts)
-        while True:
-          orth_syms = sum([self.orth_replace_map.get(s, [s]) for s in orth_syms], [])
-          i = 0
-          while i < len(orth_syms) - 1:
-            if orth_syms[i:i+2] == [" ", " "]:
-              orth_syms[i:i+2] = [" "]  # collapse two spaces
-            else:
-              i += 1
-          if self.auto_replace_unknown_symbol:
-            try:
-              map(self.orth_symbols_map.__getitem__, orth_syms)
-            except KeyError as e:
-              orth_sym = e.message
-              if self.log_auto_replace_unknown_symbols:
-                print("LmDataset: unknown orth symbol %r, adding to orth_replace_map as %r" % (orth_sym, self.unknown_symbol), file=log.v3)
-                self._reduce_log_auto_replace_unknown_symbols()
-              self.orth_replace_map[orth_sym] = [self.unknown_symbol] if self.unknown_symbol is not None else []
-              continue  # try this seq again with updated orth_replace_map
-          break
-        self.num_unknown += orth_syms.count(self.unknown_symbol)
-        if self.word_based:
-          orth_debug_str = repr(orth_syms)
-        else:
-          orth_debug_str = repr("".join(orth_syms))
-        try:
-          data = numpy.array(map(self.orth_symbols_map.__getitem__, orth_syms), dtype=self.dtype)
-        except KeyError as e:
+        data = self._get_encoded_orth(self.next_orth_idx - 1)
+        if not isinstance(data, numpy.ndarray):  # missing orth symbol
           if self.log_skipped_seqs:
-            print("LmDataset: skipping sequence %s because of missing orth symbol: %s" % (orth_debug_str, e), file=log.v4)
+            print("LmDataset: skipping sequence %r because of missing orth symbol: %r" % (orth, data), file=log.v4)
             self._reduce_log_skipped_seqs()
           if self.error_on_invalid_seq:
-            raise Exception("LmDataset: invalid seq %s, missing orth symbol %s" % (orth_debug_str, e))
+            raise Exception("LmDataset: invalid seq %r, missing orth symbol %r" % (orth, data))
           self.num_skipped += 1
           continue  # try another seq
+        if self.unknown_symbol in self.orth_symbols_map:
+          self.num_unknown += numpy.count_nonzero(data == self.orth_symbols_map[self.unknown_symbol])
 
       else:
         assert False
@@ -283,6 +305,205 @@ class LmDataset(CachedDataset2):
       return DatasetSeq(seq_idx=seq_idx, features=data, targets=targets)
 
 
+class OrthSymbolsEncoder(object):
+  """
+  Converts orthographies into orth symbol id seqs, for :class:`LmDataset`.
+  This does the same as parse_orthography(), then applying the orth_replace_map, collapsing double spaces,
+  and mapping via the orth_symbols_map, but it precompiles all of that into lookup tables:
+  Every input symbol (e.g. a char) gets an internal index, which maps to the range of its replacement
+  output symbol ids in a flat table. Single chars are looked up via their unicode code point,
+  so char-based orthographies without special symbols are encoded without any per-symbol Python code.
+  A whole batch of orthographies is expanded, space-collapsed and split via numpy at once.
+  """
+
+  _special_symbol_re = re.compile(r"(\[[^\[\]]*\])")
+
+  def __init__(self, orth_symbols_map, orth_replace_map=None, parse_orth_opts=None,
+               unknown_symbol="[UNKNOWN]", auto_replace_unknown_symbol=False, dtype="int32"):
+    """
+    :param dict[str,int] orth_symbols_map: symbol -> id
+    :param dict[str,list[str]]|None orth_replace_map: symbol -> replacement symbols.
+      with auto_replace_unknown_symbol, we add the unknown symbols to it.
+      note that the replacement is only applied once, i.e. it is not applied again on the replacement symbols.
+    :param dict[str]|None parse_orth_opts: kwargs for parse_orthography()
+    :param str|None unknown_symbol:
+    :param bool auto_replace_unknown_symbol: map all unknown symbols to unknown_symbol (or remove them if None)
+    :param str dtype: of the resulting id seqs
+    """
+    self.orth_symbols_map = orth_symbols_map
+    self.orth_replace_map = orth_replace_map if orth_replace_map is not None else {}
+    opts = dict(parse_orth_opts or {})
+    self.prefix = list(opts.pop("prefix", ()))
+    self.postfix = list(opts.pop("postfix", ("[END]",)))
+    self.remove_chars = opts.pop("remove_chars", "(){}")
+    self.collapse_spaces = opts.pop("collapse_spaces", True)
+    self.final_strip = opts.pop("final_strip", True)
+    self.parse_into_symbols_opts = opts  # remaining kwargs for parse_orthography_into_symbols()
+    self.word_based = opts.get("word_based", False)
+    self.unknown_symbol = unknown_symbol
+    self.auto_replace_unknown_symbol = auto_replace_unknown_symbol
+    self.auto_replaced_symbols = []  # list[str], for logging. the user of this class can pop them
+    self.dtype = dtype
+    self._space_id = orth_symbols_map.get(" ")
+    self._unknown_id = orth_symbols_map.get(unknown_symbol) if unknown_symbol is not None else None
+    # Can only use the code point table if unicode strings are not UTF-16 internally (narrow Python 2 builds).
+    self._use_char_table = not self.word_based and sys.maxunicode > 0xffff
+    self._sym_idxs = {}  # input symbol -> internal idx
+    self._exp_start = []  # internal idx -> start in the flat output tables
+    self._exp_len = []  # internal idx -> num of output symbols
+    self._exp_ids = []  # output symbol ids, -1 if not in orth_symbols_map
+    self._exp_syms = []  # output symbols
+    self._tables = None  # numpy versions of the above, created on demand
+    self._char_table = numpy.full((128,), -1, dtype="int32")  # code point -> internal idx
+    self._prefix_idxs = numpy.array([self._get_sym_idx(s) for s in self.prefix], dtype="int32")
+    self._postfix_idxs = numpy.array([self._get_sym_idx(s) for s in self.postfix], dtype="int32")
+
+  def _get_sym_idx(self, sym):
+    """
+    :param str sym: input symbol
+    :return: internal idx. registers the symbol if it is new
+    :rtype: int
+    """
+    idx = self._sym_idxs.get(sym)
+    if idx is not None:
+      return idx
+    idx = len(self._exp_start)
+    out_syms = self.orth_replace_map.get(sym, [sym])
+    self._exp_start.append(len(self._exp_ids))
+    self._exp_len.append(len(out_syms))
+    for out_sym in out_syms:
+      self._exp_ids.append(self.orth_symbols_map.get(out_sym, -1))
+      self._exp_syms.append(out_sym)
+    self._sym_idxs[sym] = idx
+    self._tables = None
+    return idx
+
+  def _get_tables(self):
+    """
+    :return: exp_start, exp_len, exp_ids, exp_is_space
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    if self._tables is None:
+      self._tables = (
+        numpy.array(self._exp_start, dtype="int64"),
+        numpy.array(self._exp_len, dtype="int64"),
+        numpy.array(self._exp_ids, dtype="int64"),
+        numpy.array([s == " " for s in self._exp_syms], dtype="bool"))
+    return self._tables
+
+  def _lookup_chars(self, code_points):
+    """
+    :param numpy.ndarray code_points: uint32
+    :return: internal idxs
+    :rtype: numpy.ndarray
+    """
+    if len(code_points) == 0:
+      return numpy.zeros((0,), dtype="int32")
+    max_code_point = int(code_points.max())
+    if max_code_point >= len(self._char_table):
+      table = numpy.full((max(max_code_point + 1, len(self._char_table) * 2),), -1, dtype="int32")
+      table[:len(self._char_table)] = self._char_table
+      self._char_table = table
+    idxs = self._char_table[code_points]
+    if (idxs < 0).any():
+      for code_point in numpy.unique(code_points[idxs < 0]):
+        self._char_table[code_point] = self._get_sym_idx(u"%c" % code_point)
+      idxs = self._char_table[code_points]
+    return idxs
+
+  def _get_input_sym_idxs(self, orth):
+    """
+    :param str orth:
+    :return: internal idxs of the input symbols, including prefix and postfix
+    :rtype: numpy.ndarray
+    """
+    # Same preprocessing as in parse_orthography().
+    for c in self.remove_chars:
+      orth = orth.replace(c, "")
+    if self.collapse_spaces:
+      orth = " ".join(orth.split())
+    if self.final_strip:
+      orth = orth.strip()
+    if self._use_char_table and isinstance(orth, unicode):
+      # Split off the special symbols, e.g. "a [NOISE] b" -> ["a ", "[NOISE]", " b"].
+      parts = self._special_symbol_re.split(orth) if "[" in orth else [orth]
+      if not any(["[" in part for part in parts[::2]]):  # otherwise nested or not closed
+        idxs = [self._prefix_idxs]
+        for i, part in enumerate(parts):
+          if i % 2 == 0:
+            idxs.append(self._lookup_chars(numpy.frombuffer(part.encode("utf-32-le"), dtype="uint32")))
+          else:
+            special_sym, = parse_orthography_into_symbols(part, **self.parse_into_symbols_opts)
+            idxs.append(numpy.array([self._get_sym_idx(special_sym)], dtype="int32"))
+        idxs.append(self._postfix_idxs)
+        return numpy.concatenate(idxs)
+    syms = parse_orthography_into_symbols(orth, **self.parse_into_symbols_opts)
+    idxs = numpy.array([self._get_sym_idx(s) for s in syms], dtype="int32")
+    return numpy.concatenate([self._prefix_idxs, idxs, self._postfix_idxs])
+
+  @staticmethod
+  def _collapse_mask(is_space, seq_idxs):
+    """
+    :param numpy.ndarray is_space: bool, per position
+    :param numpy.ndarray seq_idxs: per position
+    :return: bool mask of the positions to keep, i.e. without the second of two spaces within a seq
+    :rtype: numpy.ndarray
+    """
+    keep = numpy.ones(is_space.shape, dtype="bool")
+    keep[1:] = ~(is_space[1:] & is_space[:-1] & (seq_idxs[1:] == seq_idxs[:-1]))
+    return keep
+
+  def _handle_unknown_symbols(self, out_syms):
+    """
+    :param list[str] out_syms: output symbols which are not in orth_symbols_map
+    """
+    for sym in out_syms:
+      if sym in self.orth_replace_map:
+        continue
+      self.orth_replace_map[sym] = [self.unknown_symbol] if self.unknown_symbol is not None else []
+      self.auto_replaced_symbols.append(sym)
+
+  def encode_batch(self, orths):
+    """
+    :param list[str] orths:
+    :return: per orth, either the id seq, or if it contains a symbol which is not in orth_symbols_map
+      (even after auto-replacement), that symbol, i.e. the seq should be skipped then
+    :rtype: list[numpy.ndarray|str]
+    """
+    if not orths:
+      return []
+    in_idxs = [self._get_input_sym_idxs(orth) for orth in orths]
+    exp_start, exp_len, exp_ids, exp_is_space = self._get_tables()
+    flat_in_idxs = numpy.concatenate(in_idxs)
+    num_out = exp_len[flat_in_idxs]
+    # Position in the flat output tables for every output symbol, i.e. all the expanded ranges concatenated.
+    num_out_cumsum = numpy.cumsum(num_out)
+    out_pos = numpy.arange(num_out_cumsum[-1] if len(num_out) else 0, dtype="int64")
+    out_pos += numpy.repeat(exp_start[flat_in_idxs] - (num_out_cumsum - num_out), num_out)
+    seq_idxs = numpy.repeat(numpy.repeat(numpy.arange(len(orths)), [len(x) for x in in_idxs]), num_out)
+    keep = self._collapse_mask(exp_is_space[out_pos], seq_idxs)
+    out_pos, seq_idxs = out_pos[keep], seq_idxs[keep]
+    ids = exp_ids[out_pos]
+    unknown = ids < 0
+    if unknown.any() and self.auto_replace_unknown_symbol:
+      self._handle_unknown_symbols([self._exp_syms[p] for p in numpy.unique(out_pos[unknown])])
+      if self._unknown_id is not None:
+        ids[unknown] = self._unknown_id
+      elif self.unknown_symbol is None:
+        ids, seq_idxs = ids[~unknown], seq_idxs[~unknown]
+        out_pos = out_pos[~unknown]
+      if self._space_id is not None:
+        keep = self._collapse_mask(ids == self._space_id, seq_idxs)
+        ids, seq_idxs, out_pos = ids[keep], seq_idxs[keep], out_pos[keep]
+      unknown = ids < 0
+    missing_syms = {}  # seq idx -> first unknown output symbol
+    for p in numpy.flatnonzero(unknown)[::-1]:
+      missing_syms[int(seq_idxs[p])] = self._exp_syms[out_pos[p]]
+    ids = ids.astype(self.dtype)
+    seq_ends = numpy.searchsorted(seq_idxs, numpy.arange(1, len(orths)))
+    return [missing_syms.get(i, seq) for (i, seq) in enumerate(numpy.split(ids, seq_ends))]
+
+
 def _is_bliss(filename):
   try:
     corpus_file = open(filename, 'rb')
@@ -342,6 +563,159 @@ def _iter_txt(filename, callback):
     callback(l)
 
 
+_txt_line_index_version = 2
+
+# The bytes which str.strip() removes, i.e. a line only with these is skipped by _iter_txt().
+# Non-ASCII whitespace (e.g. U+00A0) is not covered.
+_txt_whitespace_bytes = numpy.zeros((256,), dtype="bool")
+_txt_whitespace_bytes[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+
+
+def read_txt_line_index(filename, chunk_size=2 ** 24):
+  """
+  Scans the txt file in chunks for newlines.
+
+  :param str filename: uncompressed line-based txt file
+  :param int chunk_size: in bytes
+  :return: (byte offsets, byte lengths) of all the non-empty lines (without the newline), both int64.
+    like in _iter_txt(), lines with only whitespace count as empty
+  :rtype: (numpy.ndarray, numpy.ndarray)
+  """
+  newline_positions = []
+  num_content_bytes = []  # number of non-whitespace bytes in the file up to the newline
+  pos = 0
+  num_content_total = 0
+  with open(filename, "rb") as f:
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      chunk = numpy.frombuffer(chunk, dtype="uint8")
+      newlines = numpy.flatnonzero(chunk == ord("\n"))
+      content_cumsum = numpy.cumsum(~_txt_whitespace_bytes[chunk], dtype="int64")
+      newline_positions.append(newlines + pos)
+      num_content_bytes.append(content_cumsum[newlines] + num_content_total)
+      pos += len(chunk)
+      num_content_total += int(content_cumsum[-1])
+  ends = numpy.concatenate(newline_positions + [[pos]]).astype("int64")  # the last line might not end with "\n"
+  starts = numpy.concatenate([[0], ends[:-1] + 1]).astype("int64")
+  num_content_bytes = numpy.concatenate(num_content_bytes + [[num_content_total]]).astype("int64")
+  mask = numpy.diff(numpy.concatenate([[0], num_content_bytes])) > 0
+  return starts[mask], (ends - starts)[mask]
+
+
+def get_txt_line_index(filename, index_cache_dir=None):
+  """
+  Like read_txt_line_index(), but if index_cache_dir is given, it uses a sidecar index file there,
+  which is keyed by the size and the mtime of the txt file, and which is (re)created if needed.
+
+  :param str filename:
+  :param str|None index_cache_dir:
+  :rtype: (numpy.ndarray, numpy.ndarray)
+  """
+  if not index_cache_dir:
+    return read_txt_line_index(filename)
+  import hashlib
+  import pickle
+  filename = os.path.abspath(filename)
+  stat = os.stat(filename)
+  key = (_txt_line_index_version, stat.st_size, int(stat.st_mtime))
+  index_filename = "%s/%s.%s.line-index.pickle" % (
+    index_cache_dir, os.path.basename(filename), hashlib.md5(filename.encode("utf8")).hexdigest()[:8])
+  if os.path.exists(index_filename):
+    try:
+      with open(index_filename, "rb") as f:
+        cached_key, index = pickle.load(f)
+      if cached_key == key:
+        return index
+    except Exception as exc:
+      print("LmDataset: ignoring broken index file %s: %r" % (index_filename, exc), file=log.v3)
+  index = read_txt_line_index(filename)
+  if not os.path.exists(index_cache_dir):
+    try:
+      os.makedirs(index_cache_dir)
+    except OSError:  # maybe created in parallel
+      pass
+  # Write to a temp file first so that parallel readers never see a partial index.
+  tmp_filename = "%s.tmp%i" % (index_filename, os.getpid())
+  with open(tmp_filename, "wb") as f:
+    pickle.dump((key, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.rename(tmp_filename, index_filename)
+  return index
+
+
+class MmapTxtLines(object):
+  """
+  Read-only list-like access to the non-empty lines of one or multiple (sharded) txt files.
+  We only keep a byte-offset line index in memory (about 20 bytes per line),
+  and the lines are read lazily via mmap.
+  Slicing returns a new :class:`MmapTxtLines` which shares the mmaps and does not read anything.
+  """
+
+  def __init__(self, filenames, index_cache_dir=None, _parent=None, _index=None):
+    """
+    :param list[str] filenames: uncompressed line-based txt files
+    :param str|None index_cache_dir: see get_txt_line_index()
+    """
+    self.filenames = filenames
+    if _parent:
+      self._mmaps = _parent._mmaps
+      self.file_idxs, self.offsets, self.lens = _index
+      return
+    self._mmaps = {}  # file idx -> mmap. opened lazily, such that this is also fine to use after a fork
+    file_idxs, offsets, lens = [], [], []
+    for i, filename in enumerate(filenames):
+      assert not filename.endswith(".gz") and not _is_bliss(filename), (
+        "MmapTxtLines: need uncompressed line-based txt file, got %r" % filename)
+      offsets_, lens_ = get_txt_line_index(filename, index_cache_dir=index_cache_dir)
+      file_idxs.append(numpy.full(offsets_.shape, i, dtype="int32"))
+      offsets.append(offsets_)
+      lens.append(lens_)
+    self.file_idxs = numpy.concatenate(file_idxs)
+    self.offsets = numpy.concatenate(offsets)
+    self.lens = numpy.concatenate(lens).astype("int32")
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, item):
+    """
+    :param int|slice item:
+    :return: stripped line, or sub-list
+    :rtype: str|MmapTxtLines
+    """
+    if isinstance(item, slice):
+      return MmapTxtLines(
+        self.filenames, _parent=self, _index=(self.file_idxs[item], self.offsets[item], self.lens[item]))
+    file_idx = int(self.file_idxs[item])
+    offset = int(self.offsets[item])
+    l = self._get_mmap(file_idx)[offset:offset + int(self.lens[item])]
+    try:
+      l = l.decode("utf8")
+    except UnicodeDecodeError:
+      l = l.decode("latin_1")  # like _iter_txt
+    return l.strip()
+
+  def get_byte_len(self, idx):
+    """
+    :param int idx:
+    :return: len of the line in bytes, which is an upper bound for len(self[idx])
+    :rtype: int
+    """
+    return int(self.lens[idx])
+
+  def _get_mmap(self, file_idx):
+    """
+    :param int file_idx:
+    :rtype: mmap.mmap
+    """
+    if file_idx not in self._mmaps:
+      import mmap
+      with open(self.filenames[file_idx], "rb") as f:
+        self._mmaps[file_idx] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._mmaps[file_idx]
+
+
 class AllophoneState:
   # In Sprint, see AllophoneStateAlphabet::index().
   id = None  # u16 in Sprint. here just str
@@ -877,8 +1251,9 @@ class TranslationDataset(CachedDataset2):
   """
 
   MapToDataKeys = {"source": "data", "target": "classes"}  # just by our convention
+  _cache_version = 1
 
-  def __init__(self, path, file_postfix, partition_epoch=None, target_postfix="", **kwargs):
+  def __init__(self, path, file_postfix, partition_epoch=None, target_postfix="", cache_dir=None, **kwargs):
     """
     :param str path: the directory containing the files
     :param str file_postfix: e.g. "train" or "dev". it will then search for "source." + postfix and "target." + postfix.
@@ -886,6 +1261,9 @@ class TranslationDataset(CachedDataset2):
     :param int partition_epoch: if provided, will partition the dataset into multiple epochs
     :param None|str target_postfix: will concat this at the end of the target.
       You might want to add some sentence-end symbol.
+    :param str|None cache_dir: if given, the label idx seqs are stored there once,
+      as a flat array + offsets per data key, keyed by a hash of the data files and vocabs.
+      Later, we use that cache via mmap and do not read the text files at all.
     """
     super(TranslationDataset, self).__init__(**kwargs)
     self.path = path
@@ -897,8 +1275,7 @@ class TranslationDataset(CachedDataset2):
     self._partition_epoch_num_seqs = []
     import os
     assert os.path.isdir(path)
-    self._data_files = {data_key: self._get_data_file(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
-    self._data = {data_key: [] for data_key in self._data_files.keys()}  # type: dict[str,list[numpy.ndarray]]
+    self._data = {data_key: [] for data_key in self.MapToDataKeys.values()}  # type: dict[str,list[numpy.ndarray]]
     self._data_len = None  # type: int|None
     self._vocabs = {data_key: self._get_vocab(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
     self.num_outputs = {k: [max(self._vocabs[k].values()) + 1, 1] for k in self._vocabs.keys()}  # all sparse
@@ -907,9 +1284,24 @@ class TranslationDataset(CachedDataset2):
     self._reversed_vocabs = {k: self._reverse_vocab(k) for k in self._vocabs.keys()}
     self.labels = {k: self._get_label_list(k) for k in self._vocabs.keys()}
     self._seq_order = None  # type: None|list[int]  # seq_idx -> line_nr
-    self._thread = Thread(name="%r reader" % self, target=self._thread_main)
-    self._thread.daemon = True
-    self._thread.start()
+    self._cache_dirname = self._get_cache_dirname(cache_dir) if cache_dir else None
+    self._cache = None  # type: None|dict[str,(numpy.ndarray,numpy.ndarray)]  # data_key -> (flat ids, offsets)
+    if self._cache_dirname and os.path.exists(self._cache_dirname):
+      print("%r: using cache %r" % (self, self._cache_dirname), file=log.v4)
+      self._cache = {
+        data_key: tuple([
+          numpy.load("%s/%s.%s.npy" % (self._cache_dirname, data_key, name), mmap_mode="r")
+          for name in ["ids", "offsets"]])
+        for data_key in self.MapToDataKeys.values()}
+      self._data_len = len(self._cache["data"][1]) - 1
+      self._data_files = {}
+      self._thread = None
+    else:
+      self._data_files = {
+        data_key: self._get_data_file(prefix) for (prefix, data_key) in self.MapToDataKeys.items()}
+      self._thread = Thread(name="%r reader" % self, target=self._thread_main)
+      self._thread.daemon = True
+      self._thread.start()
 
   def _thread_main(self):
     from Util import interrupt_main
@@ -950,33 +1342,89 @@ class TranslationDataset(CachedDataset2):
       for k, f in list(self._data_files.items()):
         f.close()
         self._data_files[k] = None
+      if self._cache_dirname:
+        self._write_cache()
 
     except Exception:
       sys.excepthook(*sys.exc_info())
       interrupt_main()
 
-  def _get_data_file(self, prefix):
+  def _get_cache_dirname(self, cache_dir):
+    """
+    :param str cache_dir:
+    :return: dir for the cache files, keyed by the data files (name, size, mtime), the vocabs and the options
+    :rtype: str
+    """
+    import hashlib
+    h = hashlib.md5()
+    h.update(repr((self._cache_version, sorted(self._add_postfix.items()))).encode("utf8"))
+    for prefix in sorted(self.MapToDataKeys.keys()):
+      filename = os.path.abspath(self._get_data_filename(prefix))
+      stat = os.stat(filename)
+      h.update(("%s %i %i" % (filename, stat.st_size, int(stat.st_mtime))).encode("utf8"))
+      with open(self._get_vocab_filename(prefix), "rb") as f:
+        h.update(f.read())
+    return "%s/%s.%s" % (cache_dir, self.file_postfix, h.hexdigest())
+
+  def _write_cache(self):
+    """
+    Writes all the data (which must be completely loaded) to self._cache_dirname.
+    """
+    # Write to a temp dir first so that parallel readers never see a partial cache.
+    tmp_dirname = "%s.tmp%i" % (self._cache_dirname, os.getpid())
+    os.makedirs(tmp_dirname)
+    for data_key, seqs in self._data.items():
+      offsets = numpy.zeros((len(seqs) + 1,), dtype="int64")
+      numpy.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+      ids = numpy.concatenate(seqs) if seqs else numpy.zeros((0,), dtype="int32")
+      numpy.save("%s/%s.ids.npy" % (tmp_dirname, data_key), ids.astype("int32"))
+      numpy.save("%s/%s.offsets.npy" % (tmp_dirname, data_key), offsets)
+    try:
+      os.rename(tmp_dirname, self._cache_dirname)
+    except OSError:  # maybe created in parallel
+      import shutil
+      shutil.rmtree(tmp_dirname)
+    print("%r: wrote cache %r" % (self, self._cache_dirname), file=log.v4)
+
+  def _get_data_filename(self, prefix):
     """
     :param str prefix: e.g. "source" or "target"
-    :return: full filename
-    :rtype: io.FileIO
+    :return: full filename, maybe with ".gz"
+    :rtype: str
     """
     import os
     filename = "%s/%s.%s" % (self.path, prefix, self.file_postfix)
     if os.path.exists(filename):
-      return open(filename, "rb")
+      return filename
     if os.path.exists(filename + ".gz"):
-      import gzip
-      return gzip.GzipFile(filename + ".gz", "rb")
+      return filename + ".gz"
     raise Exception("Data file not found: %r (.gz)?" % filename)
 
+  def _get_data_file(self, prefix):
+    """
+    :param str prefix: e.g. "source" or "target"
+    :rtype: io.FileIO
+    """
+    filename = self._get_data_filename(prefix)
+    if filename.endswith(".gz"):
+      import gzip
+      return gzip.GzipFile(filename, "rb")
+    return open(filename, "rb")
+
+  def _get_vocab_filename(self, prefix):
+    """
+    :param str prefix: e.g. "source" or "target"
+    :rtype: str
+    """
+    return "%s/%s.vocab.pkl" % (self.path, prefix)
+
   def _get_vocab(self, prefix):
     """
     :param str prefix: e.g. "source" or "target"
     :rtype: dict[str,int]
     """
     import os
-    filename = "%s/%s.vocab.pkl" % (self.path, prefix)
+    filename = self._get_vocab_filename(prefix)
     if not os.path.exists(filename):
       raise Exception("Vocab file not found: %r" % filename)
     import pickle
@@ -1023,6 +1471,9 @@ class TranslationDataset(CachedDataset2):
     :return: 1D array
     :rtype: numpy.ndarray
     """
+    if self._cache:
+      ids, offsets = self._cache[key]
+      return numpy.asarray(ids[offsets[line_nr]:offsets[line_nr + 1]])
     import time
     last_print_time = 0
     last_print_len = None
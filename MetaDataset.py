@@ -6,7 +6,197 @@ from CachedDataset2 import CachedDataset2
 from Util import NumbersDict, load_json
 from Log import log
 from random import Random
+from collections import deque
+from threading import Condition, Thread
 import numpy
+import os
+import sys
+import time
+
+
+class SubDatasetsLoader(object):
+  """
+  Calls load_seqs() on the sub-datasets of e.g. :class:`MetaDataset` or :class:`CombinedDataset`,
+  and keeps track of the time spent per sub-dataset, such that we can see which one is the bottleneck.
+  With parallel=True, there is one thread per sub-dataset, and the sub-datasets are loaded concurrently.
+  The parent can then also start a read-ahead after it has collected its seqs,
+  which loads more seqs in the background until the next load_seqs() or wait().
+  The parent must call wait() before it accesses the sub-datasets in any other way.
+  """
+
+  def __init__(self, datasets, parallel=False):
+    """
+    :param dict[str,Dataset] datasets: dataset-key -> dataset
+    :param bool parallel: one thread per sub-dataset
+    """
+    self.datasets = datasets
+    self.parallel = parallel
+    self.load_time = {key: 0.0 for key in datasets}  # dataset-key -> secs spent in load_seqs()
+    self.wait_time = 0.0  # secs in load_seqs() in total, i.e. what the parent was blocked
+    self._workers = {}  # type: dict[str,_SubDatasetLoadWorker]
+    if parallel:
+      self._workers = {key: _SubDatasetLoadWorker(key, dataset, self) for (key, dataset) in datasets.items()}
+      import atexit
+      import weakref
+      atexit.register(  # weak, such that we can be freed
+        _stop_sub_datasets_loader_at_exit, weakref.ref(self), [worker.thread for worker in self._workers.values()])
+
+  def stop(self):
+    """
+    Stops the threads, if there are any.
+    """
+    for worker in self._workers.values():
+      worker.stop()
+
+  def load_seqs(self, ranges):
+    """
+    :param dict[str,(int,int)] ranges: dataset-key -> (start, end)
+    """
+    start_time = time.time()
+    if self.parallel:
+      self.wait()  # pending read-ahead
+      for key, (start, end) in ranges.items():
+        self._workers[key].submit(start, end)
+      self.wait()
+    else:
+      for key, (start, end) in sorted(ranges.items()):
+        self.datasets[key].load_seqs(start, end)
+        self.load_time[key] += time.time() - start_time
+        start_time = time.time()
+    self.wait_time += time.time() - start_time
+
+  def start_read_ahead(self, ranges):
+    """
+    :param dict[str,(int,int)] ranges: dataset-key -> (start, end). only for parallel, otherwise ignored
+    """
+    if not self.parallel:
+      return
+    for key, (start, end) in ranges.items():
+      self._workers[key].submit(start, end)
+
+  def wait(self):
+    """
+    Waits until all sub-datasets are done with loading.
+    """
+    for worker in self._workers.values():
+      worker.wait()
+
+  def get_load_time_info(self):
+    """
+    :rtype: str
+    """
+    return "%s, waited %.3f sec in total" % (
+      ", ".join(["%s: %.3f sec" % (key, self.load_time[key]) for key in sorted(self.load_time.keys())]),
+      self.wait_time)
+
+
+class _SubDatasetLoadWorker(object):
+  """
+  Thread which calls load_seqs() on one sub-dataset, for :class:`SubDatasetsLoader`.
+  """
+
+  def __init__(self, key, dataset, parent):
+    """
+    :param str key: dataset-key
+    :param Dataset dataset:
+    :param SubDatasetsLoader parent:
+    """
+    self.key = key
+    self.dataset = dataset
+    self.parent = parent
+    self.cond = Condition()
+    self.pending = None  # type: None|(int,int)
+    self.exc_info = None
+    self.quit = False
+    import weakref
+    # The thread only keeps a weak reference to us while it is idle, such that we can be freed.
+    self.thread = Thread(
+      name="%s load_seqs %s" % (parent, key), target=_sub_dataset_load_thread_main, args=(weakref.ref(self),))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _load_pending(self):
+    """
+    Called by the thread. Does the pending load_seqs(), if there is one.
+
+    :return: False if the thread should quit
+    :rtype: bool
+    """
+    with self.cond:
+      if self.quit:
+        return False
+      if self.pending is None:
+        return True
+      start, end = self.pending
+    start_time = time.time()
+    try:
+      self.dataset.load_seqs(start, end)
+    except Exception:
+      self.exc_info = sys.exc_info()
+    with self.cond:
+      self.parent.load_time[self.key] += time.time() - start_time
+      self.pending = None
+      self.cond.notify_all()
+    return True
+
+  def submit(self, start, end):
+    """
+    :param int start:
+    :param int end:
+    """
+    with self.cond:
+      assert self.pending is None
+      self.pending = (start, end)
+      self.cond.notify_all()
+
+  def stop(self):
+    """
+    Lets the thread quit (after a pending load), such that it does not get killed during interpreter shutdown.
+    """
+    with self.cond:
+      self.quit = True
+      self.cond.notify_all()
+    self.thread.join()
+
+  def wait(self):
+    with self.cond:
+      while self.pending is not None:
+        self.cond.wait()
+    if self.exc_info:
+      exc_info, self.exc_info = self.exc_info, None
+      sys.excepthook(*exc_info)  # the original traceback would get lost otherwise
+      raise exc_info[1]
+
+
+def _sub_dataset_load_thread_main(worker_ref):
+  """
+  :param weakref.ref worker_ref: -> _SubDatasetLoadWorker
+  """
+  import better_exchook
+  better_exchook.install()
+  while True:
+    worker = worker_ref()
+    if worker is None or not worker._load_pending():
+      return
+    cond = worker.cond
+    with cond:
+      idle = worker.pending is None and not worker.quit
+      del worker
+      if idle:
+        cond.wait(1.0)  # wake up regularly to check whether the worker still exists
+
+
+def _stop_sub_datasets_loader_at_exit(loader_ref, threads):
+  """
+  :param weakref.ref loader_ref: -> SubDatasetsLoader
+  :param list[threading.Thread] threads: of the workers
+  """
+  loader = loader_ref()
+  if loader is not None:
+    loader.stop()
+  else:
+    for thread in threads:
+      thread.join()  # they quit soon, as the loader is gone, but they must not run during interpreter shutdown
 
 
 class MetaDataset(CachedDataset2):
@@ -21,6 +211,8 @@ class MetaDataset(CachedDataset2):
                datasets,
                data_map, data_dims,
                data_dtypes=None,
+               parallel_load=False, load_read_ahead=0,
+               tag_index_file=None,
                window=1, **kwargs):
     """
     :param str seq_list_file: filename. line-separated
@@ -30,6 +222,11 @@ class MetaDataset(CachedDataset2):
       Should contain 'data' as key. Also defines the target-list, which is all except 'data'.
     :param dict[str,(int,int)] data_dims: self-data-key -> data-dimension, len(shape) (1 ==> sparse repr).
     :param dict[str,str] data_dtypes: self-data-key -> dtype. automatic if not specified
+    :param bool parallel_load: load the sub-datasets concurrently, one thread per sub-dataset
+    :param int load_read_ahead: with parallel_load, after each load, load up to this num of seqs ahead
+      in the background
+    :param str|None tag_index_file: filename (.npz). if given, the tag index (see _get_tag_index) is stored there
+      and reused as long as all the seq tags are the same
     """
     assert window == 1  # not implemented
     super(MetaDataset, self).__init__(**kwargs)
@@ -43,7 +240,7 @@ class MetaDataset(CachedDataset2):
     self.dataset_keys = set([m[0] for m in self.data_map.values()]); ":type: set[str]"
     self.data_keys = set(self.data_map.keys()); ":type: set[str]"
     assert "data" in self.data_keys
-    self.target_list = sorted(self.data_keys - ["data"])
+    self.target_list = sorted(self.data_keys - {"data"})
 
     data_dims = convert_data_dims(data_dims)
     self.data_dims = data_dims
@@ -70,12 +267,87 @@ class MetaDataset(CachedDataset2):
 
     # Will only init the needed datasets.
     self.datasets = {key: init_dataset(datasets[key]) for key in self.dataset_keys}
+    self.load_read_ahead = load_read_ahead
+    self.sub_datasets_loader = SubDatasetsLoader(self.datasets, parallel=parallel_load)
+    self.tag_index_file = tag_index_file
+    self._tag_index = None  # type: dict[str,numpy.ndarray|None]  # see _get_tag_index()
+    self._seq_index = None  # type: numpy.ndarray  # sorted seq idx -> idx in seq_list_original
+
+  def _get_tag_index(self):
+    """
+    Maps our seq_list_original to the seq indices of each sub-dataset, i.e. indices into dataset.get_all_tags().
+    This is computed only once (or loaded from tag_index_file), so that we can pass each epoch's
+    order to the sub-datasets via init_seq_order_by_index() as a simple numpy permutation,
+    instead of going through lists of seq tags and doing the tag lookup every epoch.
+
+    :return: dataset-key -> int32 array of len num_seqs, or None if the dataset does not support get_all_tags()
+    :rtype: dict[str,numpy.ndarray|None]
+    """
+    if self._tag_index is not None:
+      return self._tag_index
+    all_tags = {}  # type: dict[str,list[str]]
+    for key, dataset in sorted(self.datasets.items()):
+      try:
+        all_tags[key] = dataset.get_all_tags()
+      except NotImplementedError:
+        print("%s: dataset %r does not provide get_all_tags(), will use seq tag lists" % (
+          self.__class__.__name__, key), file=log.v4)
+    checksum = self._get_tags_checksum([self.seq_list_original] + [all_tags[key] for key in sorted(all_tags)])
+    tag_index = None
+    if self.tag_index_file and os.path.exists(self.tag_index_file):
+      f = numpy.load(self.tag_index_file)
+      if str(f["checksum"]) == checksum and sorted(f["keys"].tolist()) == sorted(all_tags.keys()):
+        tag_index = {key: f["idx_%s" % key] for key in all_tags.keys()}
+      else:
+        print("%s: tag index file %r is outdated, recreating" % (
+          self.__class__.__name__, self.tag_index_file), file=log.v3)
+    if tag_index is None:
+      tag_index = {}
+      for key, tags in all_tags.items():
+        dataset_tag_idx = {tag: idx for (idx, tag) in enumerate(tags)}
+        missing = [tag for tag in self.seq_list_original if tag not in dataset_tag_idx]
+        assert not missing, "%s: dataset %r misses %i seqs, e.g. %r" % (
+          self.__class__.__name__, key, len(missing), missing[:3])
+        tag_index[key] = numpy.array([dataset_tag_idx[tag] for tag in self.seq_list_original], dtype="int32")
+      if self.tag_index_file:
+        # Write to a tmp file first, such that concurrent readers never see a partial file.
+        tmp_filename = "%s.%i.tmp.npz" % (self.tag_index_file, os.getpid())
+        numpy.savez(
+          tmp_filename, checksum=checksum, keys=numpy.array(sorted(tag_index.keys())),
+          **{"idx_%s" % key: idx for (key, idx) in tag_index.items()})
+        os.rename(tmp_filename, self.tag_index_file)
+    self._tag_index = {key: tag_index.get(key) for key in self.datasets.keys()}
+    return self._tag_index
+
+  @staticmethod
+  def _get_tags_checksum(tag_lists):
+    """
+    :param list[list[str]] tag_lists:
+    :rtype: str
+    """
+    import hashlib
+    m = hashlib.md5()
+    for tags in tag_lists:
+      m.update(("%i\n" % len(tags)).encode("utf8"))
+      m.update("\n".join(tags).encode("utf8"))
+    return m.hexdigest()
+
+  def get_all_tags(self):
+    """
+    :rtype: list[str]
+    """
+    return self.seq_list_original
 
   def init_seq_order(self, epoch=None, seq_list=None):
     need_reinit = self.epoch is None or self.epoch != epoch
     super(MetaDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    self._num_seqs = len(seq_list) if seq_list else len(self.seq_list_original)  # was reset by the base class
     if not need_reinit:
       return False
+    self.sub_datasets_loader.wait()
+    if self.sub_datasets_loader.wait_time:
+      print("%s load_seqs time per sub-dataset: %s" % (
+        self.__class__.__name__, self.sub_datasets_loader.get_load_time_info()), file=log.v4)
 
     if seq_list:
       seq_index = [self.tag_idx[tag] for tag in seq_list]
@@ -85,18 +357,29 @@ class MetaDataset(CachedDataset2):
       else:
         get_seq_len = None
       seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, get_seq_len)
-    self.seq_list_ordered = [self.seq_list_original[s] for s in seq_index]
+    self._seq_index = numpy.array(seq_index, dtype="int32")
 
-    for dataset in self.datasets.values():
-      dataset.init_seq_order(epoch=epoch, seq_list=self.seq_list_ordered)
+    tag_index = self._get_tag_index()
+    seq_list_ordered = None
+    for key, dataset in self.datasets.items():
+      if tag_index[key] is not None:
+        dataset.init_seq_order_by_index(epoch=epoch, seq_order=tag_index[key][self._seq_index])
+      else:
+        if seq_list_ordered is None:
+          seq_list_ordered = [self.seq_list_original[s] for s in self._seq_index]
+        dataset.init_seq_order(epoch=epoch, seq_list=seq_list_ordered)
     return True
 
   def _load_seqs(self, start, end):
+    end = min(end, self.num_seqs)
+    self.sub_datasets_loader.load_seqs({key: (start, end) for key in self.datasets.keys()})
     for dataset in self.datasets.values():
-      dataset.load_seqs(start, end)
       for seq_idx in range(start, end):
         self._check_dataset_seq(dataset, seq_idx)
     super(MetaDataset, self)._load_seqs(start=start, end=end)
+    read_ahead_end = min(end + self.load_read_ahead, self.num_seqs)
+    if read_ahead_end > end:
+      self.sub_datasets_loader.start_read_ahead({key: (start, read_ahead_end) for key in self.datasets.keys()})
 
   def _check_dataset_seq(self, dataset, seq_idx):
     """
@@ -122,18 +405,18 @@ class MetaDataset(CachedDataset2):
     :type seq_idx: int
     :rtype: DatasetSeq
     """
-    seq_tag = self.seq_list_ordered[seq_idx]
+    seq_tag = self.get_tag(seq_idx)
     features = self._get_data(seq_idx, "data")
     targets = {target: self._get_data(seq_idx, target) for target in self.target_list}
     return DatasetSeq(seq_idx=seq_idx, seq_tag=seq_tag, features=features, targets=targets)
 
   def get_seq_length(self, sorted_seq_idx):
     if self._seq_lens:
-      return self._seq_lens[self.seq_list_ordered[sorted_seq_idx]]
+      return self._seq_lens[self.get_tag(sorted_seq_idx)]
     return super(MetaDataset, self).get_seq_length(sorted_seq_idx)
 
   def get_tag(self, sorted_seq_idx):
-    return self.seq_list_ordered[sorted_seq_idx]
+    return self.seq_list_original[self._seq_index[sorted_seq_idx]]
 
   def get_target_list(self):
     return self.target_list
@@ -212,8 +495,11 @@ class ClusteringDataset(CachedDataset2):
     data["cluster_idx"] = numpy.array([self.cluster_map[seq_name]], dtype=self.cluster_idx_dtype)
     return DatasetSeq(seq_idx=seq_idx, features=data["data"], targets=data)
 
-  def _generate_batches(self, recurrent_net, batch_size, max_seqs=-1, seq_drop=0.0, max_seq_length=None, used_data_keys=None):
+  def _generate_batches(self, recurrent_net, batch_size, max_seqs=-1, seq_drop=0.0, max_seq_length=None,
+                        used_data_keys=None, bucket_boundaries=None, sort_window=None):
     import sys
+    if bucket_boundaries or sort_window:
+      raise Exception("ClusteringDataset: bucket_boundaries and sort_window not supported, batches are by cluster")
     if max_seq_length is None: max_seq_length = sys.maxsize
     if batch_size == 0: batch_size = sys.maxsize
     assert batch_size > 0
@@ -368,6 +654,7 @@ class CombinedDataset(CachedDataset2):
                datasets,
                data_map, data_dims,
                data_dtypes=None,
+               parallel_load=False, load_read_ahead=0,
                window=1, **kwargs):
     """
     :param dict[str,dict[str]] datasets: dataset-key -> dataset-kwargs. including keyword 'class' and maybe 'files'
@@ -375,6 +662,9 @@ class CombinedDataset(CachedDataset2):
       Should contain 'data' as key. Also defines the target-list, which is all except 'data'.
     :param dict[str,(int,int)] data_dims: self-data-key -> data-dimension, len(shape) (1 ==> sparse repr).
     :param dict[str,str] data_dtypes: self-data-key -> dtype. automatic if not specified
+    :param bool parallel_load: load the sub-datasets concurrently, one thread per sub-dataset
+    :param int load_read_ahead: with parallel_load, after each load, load up to this num of seqs ahead
+      in the background
     """
     assert window == 1  # not implemented
     super(CombinedDataset, self).__init__(**kwargs)
@@ -391,7 +681,7 @@ class CombinedDataset(CachedDataset2):
     # Build target lookup table
     target_lookup_table = {}
     for dataset_key in self.dataset_keys:
-      target_lookup_table[dataset_key] = {datamap_maps: datamap_keys[1] for datamap_keys,datamap_maps in data_map.iteritems() if datamap_keys[0]==dataset_key}
+      target_lookup_table[dataset_key] = {datamap_maps: datamap_keys[1] for datamap_keys,datamap_maps in data_map.items() if datamap_keys[0]==dataset_key}
       for key in self.data_keys:
         target_lookup_table[dataset_key].setdefault(key,None)
 
@@ -410,6 +700,8 @@ class CombinedDataset(CachedDataset2):
 
     # Will only init the needed datasets.
     self.datasets = {key: init_dataset(datasets[key]) for key in self.dataset_keys}
+    self.load_read_ahead = load_read_ahead
+    self.sub_datasets_loader = SubDatasetsLoader(self.datasets, parallel=parallel_load)
 
     try:
       self._num_seqs = sum([self.datasets[k].num_seqs for k in sorted(self.datasets.keys())])
@@ -450,8 +742,14 @@ class CombinedDataset(CachedDataset2):
     assert seq_list is None, "seq_list not supported for %s" % self.__class__
     need_reinit = self.epoch is None or self.epoch != epoch
     super(CombinedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    if self.know_num_seqs_beforehand:
+      self._num_seqs = sum([self.datasets[k].num_seqs for k in sorted(self.datasets.keys())])  # was reset
     if not need_reinit:
       return False
+    self.sub_datasets_loader.wait()
+    if self.sub_datasets_loader.wait_time:
+      print("%s load_seqs time per sub-dataset: %s" % (
+        self.__class__.__name__, self.sub_datasets_loader.get_load_time_info()), file=log.v4)
 
     if self.know_num_seqs_beforehand:
       # We just select for which seq-idx we will use which dataset.
@@ -485,6 +783,7 @@ class CombinedDataset(CachedDataset2):
     :param num_values: int Add num_values entries to the dataset-segment-idx mapping table
     :return:
     """
+    self.sub_datasets_loader.wait()  # we access the sub-datasets below
     for i in range(num_values):
       if self.seq_ordering in ("default", "random"):  # default is random. this is different from base class!
         while True:
@@ -545,16 +844,28 @@ class CombinedDataset(CachedDataset2):
     if not self.know_num_seqs_beforehand and end > len(self.dataset_seq_idxs):
       self._expand_dataset_sec_idxs(end-len(self.dataset_seq_idxs))
 
-    requested_seqs = self.dataset_seq_idxs[start:end]
+    self.sub_datasets_loader.load_seqs(self._get_sub_dataset_ranges(start, end))
+    super(CombinedDataset, self)._load_seqs(start=start, end=end)
+    if self.load_read_ahead and end < len(self.dataset_seq_idxs):
+      # Only as far as we already know the dataset-seq-idxs.
+      self.sub_datasets_loader.start_read_ahead(self._get_sub_dataset_ranges(start, end + self.load_read_ahead))
 
+  def _get_sub_dataset_ranges(self, start, end):
+    """
+    :param int start:
+    :param int end:
+    :return: dataset-key -> (sub_start, sub_end), for all datasets which are used in the seqs start..end-1
+    :rtype: dict[str,(int,int)]
+    """
+    requested_seqs = self.dataset_seq_idxs[start:end]
+    ranges = {}
     for i in range(len(self.datasets)):
-      dataset = self.datasets[self.dataset_idxs[i]]
       sub_requested_seqs = [s[1] for s in requested_seqs if s[0]==i]
       if sub_requested_seqs == []:
         continue
       sub_start, sub_end = min(sub_requested_seqs), max(sub_requested_seqs)
-      dataset.load_seqs(sub_start, sub_end+1)
-    super(CombinedDataset, self)._load_seqs(start=start, end=end)
+      ranges[self.dataset_idxs[i]] = (sub_start, sub_end + 1)
+    return ranges
 
   def _check_dataset_seq(self, dataset, seq_idx): # TODO this check makes no sense here
     """
@@ -620,6 +931,201 @@ class CombinedDataset(CachedDataset2):
     return self.data_dims[key][0]
 
 
+class ChunkRingBuffer(object):
+  """
+  Preallocated storage for the chunks of :class:`ChunkShuffleDataset`.
+  For every data key, there is one contiguous array (optionally a memory-mapped temp file)
+  which is used as a ring buffer, and an offsets table (pos, len) per chunk.
+  Chunks are written in the order they are added. They can be removed in any order,
+  but the space is reclaimed only once all earlier added chunks are removed as well,
+  or when we compact the buffer because we run out of space otherwise.
+  Only if the remaining chunks really need more space, the buffer grows.
+  The :class:`DatasetSeq` which is added gets its data replaced by views into the buffer.
+  """
+
+  def __init__(self, num_frames, mmap_dir=None):
+    """
+    :param int num_frames: capacity in frames, per data key
+    :param str|None mmap_dir: if given, the buffers are memory-mapped temp files in this dir
+    """
+    assert num_frames > 0
+    self.num_frames = num_frames
+    self.mmap_dir = mmap_dir
+    self.arrays = {}  # type: dict[str,numpy.ndarray]  # data key -> (num_frames, ...)
+    self.write_pos = {}  # type: dict[str,int]
+    self.max_chunk_len = NumbersDict(0)
+    self.num_used = NumbersDict(0)  # frames of not-removed chunks
+    self._entries = deque()  # type: deque[list]  # [seq, dict key -> (pos, len), removed], in add-order
+    self._entry_by_seq = {}  # type: dict[int,list]  # id(seq) -> entry
+    self.num_compact = 0
+    self.num_grow = 0
+
+  def _alloc(self, key, num_frames, shape, dtype):
+    """
+    :param str key:
+    :param int num_frames:
+    :param tuple[int] shape: per frame
+    :param str|numpy.dtype dtype:
+    :rtype: numpy.ndarray
+    """
+    if self.mmap_dir:
+      import tempfile
+      # The temp file is deleted automatically once the array is not referenced anymore.
+      f = tempfile.TemporaryFile(dir=self.mmap_dir, prefix="returnn-chunk-buffer-%s-" % key)
+      return numpy.memmap(f, dtype=dtype, mode="w+", shape=(num_frames,) + tuple(shape))
+    return numpy.zeros((num_frames,) + tuple(shape), dtype=dtype)
+
+  def _get_tail_pos(self, key):
+    """
+    :param str key:
+    :return: start pos of the oldest used region, or None if nothing is used
+    :rtype: int|None
+    """
+    for entry in self._entries:
+      pos, n = entry[1][key]
+      if n > 0:
+        return pos
+    return None
+
+  def _find_pos(self, key, n):
+    """
+    :param str key:
+    :param int n: num frames
+    :return: pos where we can write n frames, or None if there is no space
+    :rtype: int|None
+    """
+    head = self.write_pos[key]
+    tail = self._get_tail_pos(key)
+    if n == 0:
+      return head
+    if tail is None:
+      return 0 if n <= self.num_frames else None
+    if head > tail:  # used region is [tail, head)
+      if head + n <= self.num_frames:
+        return head
+      if n <= tail:
+        return 0
+      return None
+    # wrapped around, used region is [tail, end) + [0, head)
+    if head + n <= tail:
+      return head
+    return None
+
+  def has_space(self, num_frames=None):
+    """
+    :param NumbersDict|None num_frames: by default the max chunk len seen so far
+    :return: whether we can add a chunk of this len without growing
+    :rtype: bool
+    """
+    if num_frames is None:
+      num_frames = self.max_chunk_len
+    for key in self.arrays.keys():
+      if self._find_pos(key, num_frames[key]) is None:
+        return False
+    return True
+
+  def add(self, seq):
+    """
+    Copies the data of the seq into the buffer, and replaces it by views into the buffer.
+    If there is no contiguous free space, we compact the buffer, or grow it if that is not enough.
+
+    :param DatasetSeq seq:
+    """
+    data = seq.targets  # includes "data"
+    if not self.arrays:
+      for key, v in data.items():
+        self.arrays[key] = self._alloc(key, self.num_frames, v.shape[1:], v.dtype)
+        self.write_pos[key] = 0
+    assert set(data.keys()) == set(self.arrays.keys())
+    lens = NumbersDict({key: v.shape[0] for (key, v) in data.items()})
+    self.max_chunk_len = NumbersDict.max([self.max_chunk_len, lens])
+    if not self.has_space(lens):
+      if (self.num_used + lens).max_value() <= self.num_frames:
+        self._compact()
+        self.num_compact += 1
+      else:
+        num_frames = max(self.num_frames * 2, (self.num_used + lens).max_value())
+        print("ChunkRingBuffer: grow from %i to %i frames" % (self.num_frames, num_frames), file=log.v4)
+        self._compact(num_frames=num_frames)
+        self.num_grow += 1
+    offsets = {}
+    for key, v in data.items():
+      pos = self._find_pos(key, v.shape[0])
+      assert pos is not None
+      self.arrays[key][pos:pos + v.shape[0]] = v
+      self.write_pos[key] = pos + v.shape[0]
+      offsets[key] = (pos, v.shape[0])
+    entry = [seq, offsets, False]
+    self.num_used += lens
+    self._entries.append(entry)
+    self._entry_by_seq[id(seq)] = entry
+    self._set_views(entry)
+
+  def _set_views(self, entry):
+    """
+    :param list entry: [seq, offsets, removed]
+    """
+    seq, offsets, _ = entry
+    seq.targets = {key: self.arrays[key][pos:pos + n] for (key, (pos, n)) in offsets.items()}
+    seq.features = seq.targets["data"]
+
+  def remove(self, seq):
+    """
+    :param DatasetSeq seq:
+    """
+    entry = self._entry_by_seq.pop(id(seq))
+    entry[2] = True
+    self.num_used -= NumbersDict({key: n for (key, (pos, n)) in entry[1].items()})
+    while self._entries and self._entries[0][2]:
+      self._entries.popleft()
+
+  def clear(self):
+    self._entries.clear()
+    self._entry_by_seq.clear()
+    self.num_used = NumbersDict(0)
+    for key in self.write_pos.keys():
+      self.write_pos[key] = 0
+
+  def _compact(self, num_frames=None):
+    """
+    Moves all remaining chunks to the start of the buffers, in add-order, which frees the space
+    of chunks which were removed out of order.
+    If num_frames is given, reallocates the buffers with this size.
+
+    :param int|None num_frames: new capacity
+    """
+    entries = [entry for entry in self._entries if not entry[2]]
+    for key in list(self.arrays.keys()):
+      parts = [self.arrays[key][pos:pos + n] for (pos, n) in [entry[1][key] for entry in entries]]
+      used = sum([len(part) for part in parts])
+      if num_frames is None:
+        if not parts:
+          pass
+        elif len(parts) == 1:
+          parts = [numpy.array(parts[0])]
+        else:
+          parts = [numpy.concatenate(parts)]  # we need a copy, as we will overwrite the buffer
+        arr = self.arrays[key]
+      else:
+        assert used <= num_frames
+        arr = self._alloc(key, num_frames, self.arrays[key].shape[1:], self.arrays[key].dtype)
+      pos = 0
+      for part in parts:
+        arr[pos:pos + len(part)] = part
+        pos += len(part)
+      pos = 0
+      for entry in entries:
+        n = entry[1][key][1]
+        entry[1][key] = (pos, n)
+        pos += n
+      self.arrays[key] = arr
+      self.write_pos[key] = pos
+    if num_frames is not None:
+      self.num_frames = num_frames
+    self._entries = deque(entries)
+    for entry in entries:
+      self._set_views(entry)
+
 class ChunkShuffleDataset(CachedDataset2):
   """
   This goes through a dataset, caches some recent chunks
@@ -629,9 +1135,15 @@ class ChunkShuffleDataset(CachedDataset2):
                chunk_shuffle_cache=1000,
                batch_gen_batch_size=5000, batch_gen_max_seqs=1,
                batch_gen_recurrent_net=True,
+               chunk_buffer_num_frames=None, chunk_buffer_mmap_dir=None,
                **kwargs):
     """
     :param dict[str] dataset: kwargs for init_dataset
+    :param int chunk_shuffle_cache: num of chunks ahead which we shuffle
+    :param int|None chunk_buffer_num_frames: if set, the chunks are stored in a preallocated ChunkRingBuffer
+      of this size (per data key). we stop reading chunks ahead once it is full,
+      i.e. this bounds the memory, and together with chunk_shuffle_cache it defines the shuffle quality.
+    :param str|None chunk_buffer_mmap_dir: if set, the ChunkRingBuffer is a memory-mapped temp file in this dir
     """
     super(ChunkShuffleDataset, self).__init__(**kwargs)
     self.dataset = init_dataset(dataset)
@@ -647,6 +1159,11 @@ class ChunkShuffleDataset(CachedDataset2):
     self.labels = self.dataset.labels
     self.rng = Random(0)
     self.load_seqs_end = None
+    if chunk_buffer_num_frames:
+      self.chunk_buffer = ChunkRingBuffer(num_frames=chunk_buffer_num_frames, mmap_dir=chunk_buffer_mmap_dir)
+    else:
+      assert not chunk_buffer_mmap_dir, "chunk_buffer_mmap_dir needs chunk_buffer_num_frames"
+      self.chunk_buffer = None  # type: ChunkRingBuffer|None
 
   def init_seq_order(self, epoch=None, seq_list=None):
     """
@@ -658,6 +1175,8 @@ class ChunkShuffleDataset(CachedDataset2):
     self.load_seqs_end = 0
     self.dataset_last_load_seq_end = 0
     self.rng.seed(epoch or 1)
+    if self.chunk_buffer:
+      self.chunk_buffer.clear()
     if not need_reinit:
       return False
 
@@ -685,9 +1204,19 @@ class ChunkShuffleDataset(CachedDataset2):
       seq_idx = self.added_data[-1].seq_idx + 1
     tag = "%s.%i" % (original_tag, seq_idx)
     seq = DatasetSeq(seq_idx=seq_idx, features=features, targets=data, seq_tag=tag)
+    if self.chunk_buffer:
+      self.chunk_buffer.add(seq)
     self._num_timesteps_accumulated += seq.num_frames
     self.added_data += [seq]
 
+  def _cleanup_old_seqs(self, seq_idx_end):
+    if self.chunk_buffer:
+      for seq in self.added_data:
+        if seq.seq_idx >= seq_idx_end:
+          break
+        self.chunk_buffer.remove(seq)
+    super(ChunkShuffleDataset, self)._cleanup_old_seqs(seq_idx_end)
+
   def _shuffle(self):
     start_seq_idx = self.added_data[0].seq_idx
     end_seq_idx = self.added_data[-1].seq_idx
@@ -714,9 +1243,10 @@ class ChunkShuffleDataset(CachedDataset2):
     batches = self.batch_gen.peek_next_n(1)
     for batch in batches:
       assert batch.seqs
-      if batch.end_seq > self.dataset_last_load_seq_end:
-        self.dataset.load_seqs(batch.start_seq, batch.end_seq)
-        self.dataset_last_load_seq_end = batch.end_seq
+      for start_seq, end_seq in batch.get_seq_ranges():
+        if end_seq > self.dataset_last_load_seq_end:
+          self.dataset.load_seqs(start_seq, end_seq)
+          self.dataset_last_load_seq_end = end_seq
 
       used_data_keys = self.get_data_keys()
       for seq in batch.seqs:
@@ -733,7 +1263,14 @@ class ChunkShuffleDataset(CachedDataset2):
 
   def _add_more_until(self, end, shuffle=False):
     if self.added_data and end <= self.added_data[-1].seq_idx: return True
-    while self._add_more():
+    while True:
+      if shuffle and self.chunk_buffer and self.added_data and self.added_data[-1].seq_idx > self.load_seqs_end:
+        # We have all the seqs which are requested by load_seqs(). Don't read further ahead when the buffer is full.
+        if not self.chunk_buffer.has_space():
+          self._shuffle()
+          return True
+      if not self._add_more():
+        break
       assert self.added_data
       if end <= self.added_data[-1].seq_idx:
         if shuffle:
@@ -783,6 +1320,18 @@ class ChunkShuffleDataset(CachedDataset2):
     """
     assert False, "should not be called"
 
+  def get_input_data(self, sorted_seq_idx):
+    features = super(ChunkShuffleDataset, self).get_input_data(sorted_seq_idx)
+    if self.chunk_buffer:
+      features = numpy.array(features)  # the buffer will be overwritten
+    return features
+
+  def get_targets(self, target, sorted_seq_idx):
+    targets = super(ChunkShuffleDataset, self).get_targets(target, sorted_seq_idx)
+    if self.chunk_buffer:
+      targets = numpy.array(targets)  # the buffer will be overwritten
+    return targets
+
   def get_target_list(self):
     return self.dataset.get_target_list()
 
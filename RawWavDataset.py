@@ -1,3 +1,5 @@
+from __future__ import print_function
+
 import h5py
 from CachedDataset2 import CachedDataset2
 from Dataset import DatasetSeq
@@ -6,14 +8,59 @@ import tempfile
 import scipy.io.wavfile
 import numpy as np
 import time
+from collections import OrderedDict
+
+
+def _frameTimeSignal(timeSignal, frameLength, frameShift, pad=True):
+  """
+  Cuts the time signal into (overlapping) frames. The frames are strided views into the signal,
+  i.e. this does not copy the signal, except for the zero padding of the last frame.
+
+  :type timeSignal: numpy.ndarray
+  :param timeSignal: 1D time signal
+  :type frameLength: int
+  :type frameShift: int
+  :type pad: bool
+  :param pad: if True, the signal is zero padded for the last frame, otherwise the remaining samples are cut
+  :rtype: 2D numpy.ndarray (frames, features)
+  :return: read-only view of shape (nrOfFrames, frameLength)
+  """
+  nrOfFrames = int(np.ceil((float(timeSignal.shape[0]-frameLength)/frameShift) + 1))
+  if pad:
+    padLength = (nrOfFrames -1) * frameShift + frameLength - timeSignal.shape[0]
+    if padLength > 0:
+      timeSignal = np.concatenate([timeSignal, np.zeros((padLength, ), dtype=timeSignal.dtype)])
+  else:
+    nrOfFrames -= 1
+  timeSignal = np.ascontiguousarray(timeSignal)
+  frames = np.lib.stride_tricks.as_strided(
+    timeSignal, shape=(nrOfFrames, frameLength),
+    strides=(timeSignal.strides[0] * frameShift, timeSignal.strides[0]))
+  frames.flags.writeable = False  # the frames overlap, writing to them would be confusing
+  return frames
+
+
+def _readWavFile(wavFilePath):
+  """
+  :type wavFilePath: str
+  :rtype: numpy.ndarray
+  :return: 1D float32 time signal, with the same values as in the wav file (no normalization)
+  """
+  (r, x) = scipy.io.wavfile.read(wavFilePath)
+  return x.astype(np.float32)
+
 
 class RawWavDataset(CachedDataset2):
   """
   This dataset returns the raw waveform information of wav files as sequence input data
   It uses temporary hdf files to buffer the data, to avoid repeatadly rading the
   wav files.
+  Alternatively, in streaming mode, it decodes the wav files in a pool of worker threads
+  (ahead of the current seq) into a bounded LRU cache in memory, without the hdf buffer.
   """
-  def __init__(self, listFile, frameLength, frameShift, num_outputs=None, **kwargs):
+  def __init__(self, listFile, frameLength, frameShift, num_outputs=None,
+               streaming=False, cacheByteSize=256 * 1024 * 1024, numDecodeWorkers=2, decodeReadAhead=4,
+               **kwargs):
     """
     constructor
 
@@ -28,6 +75,14 @@ class RawWavDataset(CachedDataset2):
     :param num_outputs: this needs to be set if the data set is used with  
                         only input data (e.g. for the extraction
                         process). 
+    :type streaming: bool
+    :param streaming: if True, don't use the hdf buffer but the in-memory LRU cache of decoded wav files
+    :type cacheByteSize: int
+    :param cacheByteSize: streaming mode: max size of the decoded wav files in the cache
+    :type numDecodeWorkers: int
+    :param numDecodeWorkers: streaming mode: number of threads to decode wav files. 0 to decode in the main thread
+    :type decodeReadAhead: int
+    :param decodeReadAhead: streaming mode: number of seqs ahead of the current one which get decoded
     """
     self._flag_buffering = False
     super(RawWavDataset, self).__init__(**kwargs)
@@ -42,7 +97,22 @@ class RawWavDataset(CachedDataset2):
     self._num_seqs = len(self._wavFiles) 
     self._seq_index_list = None
 
-    self._hdfBufferHandler, self._hdfBufferPath = self._openHdfBuffer()
+    self._streaming = streaming
+    self._cacheByteSize = cacheByteSize
+    self._decodedCache = OrderedDict()  # wavFileId -> float32 time signal, in LRU order
+    self._decodedCacheBytes = 0
+    self._decodePending = {}  # wavFileId -> multiprocessing.pool.AsyncResult
+    self._decodeReadAhead = decodeReadAhead
+    self._decodePool = None
+    if streaming:
+      self._hdfBufferHandler, self._hdfBufferPath = None, None
+      if numDecodeWorkers > 0:
+        from multiprocessing.pool import ThreadPool
+        import atexit
+        self._decodePool = ThreadPool(numDecodeWorkers)
+        atexit.register(self._decodePool.terminate)
+    else:
+      self._hdfBufferHandler, self._hdfBufferPath = self._openHdfBuffer()
 
     self.num_inputs = self._frameLength 
     self.num_outputs = self._getNumOutputs(num_outputs)
@@ -56,6 +126,12 @@ class RawWavDataset(CachedDataset2):
     :returns DatasetSeq or None if seq_idx >= num_seqs.
     """
     wavFileId = self._seq_index_list[seq_idx]
+    if self._streaming:
+      self._startDecoding([self._seq_index_list[i] for i in range(
+        seq_idx + 1, min(seq_idx + 1 + self._decodeReadAhead, self.num_seqs))])
+      timeSignal = self._getDecodedTimeSignal(wavFileId)
+      inputFeatures = _frameTimeSignal(timeSignal, self._frameLength, self._frameShift, pad=self._flag_pad)
+      return DatasetSeq(seq_idx, inputFeatures, None)
     if not self._isInBuffer(wavFileId):
       self._loadWavFileIdIntoBuffer(wavFileId)
 
@@ -98,23 +174,44 @@ class RawWavDataset(CachedDataset2):
       self._loadWavFileIdIntoBuffer(wavFileId)
 
     timeSignal = self._hdfBufferHandler['timeSignal'][str(wavFileId)][...]
-    frameLength = self._frameLength
-    frameShift = self._frameShift
-    nrOfFrames = int(np.ceil((float(timeSignal.shape[0]-frameLength)/frameShift) + 1))
-    if self._flag_pad:
-      padLength = (nrOfFrames -1) * frameShift + frameLength - timeSignal.shape[0]
-      timeSignalPad = np.zeros((timeSignal.shape[0] + padLength, ))
-      timeSignalPad[0:timeSignal.shape[0]] = timeSignal
+    return _frameTimeSignal(timeSignal, self._frameLength, self._frameShift, pad=self._flag_pad)
+
+  def _startDecoding(self, wavFileIds):
+    """
+    streaming mode: starts decoding the wav files in the worker pool, if they are not in the cache yet
+
+    :type wavFileIds: list[int]
+    """
+    if not self._decodePool:
+      return
+    for wavFileId in wavFileIds:
+      if wavFileId in self._decodedCache or wavFileId in self._decodePending:
+        continue
+      self._decodePending[wavFileId] = self._decodePool.apply_async(_readWavFile, (self._wavFiles[wavFileId],))
+
+  def _getDecodedTimeSignal(self, wavFileId):
+    """
+    streaming mode: returns the decoded time signal, via the LRU cache
+
+    :type wavFileId: int
+    :rtype: numpy.ndarray
+    :return: 1D float32 time signal
+    """
+    if wavFileId in self._decodedCache:
+      timeSignal = self._decodedCache.pop(wavFileId)
+      self._decodedCache[wavFileId] = timeSignal  # mark as most recently used
+      return timeSignal
+    if wavFileId in self._decodePending:
+      timeSignal = self._decodePending.pop(wavFileId).get()
     else:
-      nrOfFrames -= 1  
-      sigLength = (nrOfFrames -1) * frameShift + frameLength
-      timeSignalPad = np.zeros((sigLength, ))
-      timeSignalPad[:] = timeSignal[0:sigLength]
-        
-    inputFeatures = np.zeros((nrOfFrames, frameLength), dtype=np.float32)
-    for i1 in range(nrOfFrames):
-      inputFeatures[i1,:] = timeSignalPad[i1*frameShift:(i1*frameShift+frameLength)]
-    return inputFeatures
+      timeSignal = _readWavFile(self._wavFiles[wavFileId])
+    self._decodedCache[wavFileId] = timeSignal
+    self._decodedCacheBytes += timeSignal.nbytes
+    # Always keep the current one, even if it alone exceeds the limit.
+    while self._decodedCacheBytes > self._cacheByteSize and len(self._decodedCache) > 1:
+      _, oldTimeSignal = self._decodedCache.popitem(last=False)
+      self._decodedCacheBytes -= oldTimeSignal.nbytes
+    return timeSignal
 
   def _getOutputFeatures(self, wavFileId):
     """
@@ -157,8 +254,7 @@ class RawWavDataset(CachedDataset2):
     if self._isInBuffer(wavFileId):
         return False
     wavFilePath = self._wavFiles[wavFileId] 
-    (r, x) = scipy.io.wavfile.read(wavFilePath)
-    self._hdfBufferHandler['timeSignal'].create_dataset(str(wavFileId), data=x.astype(np.float32))
+    self._hdfBufferHandler['timeSignal'].create_dataset(str(wavFileId), data=_readWavFile(wavFilePath))
     self._flag_buffering = False
     return True
 
@@ -205,9 +301,15 @@ class RawWavDataset(CachedDataset2):
       self.seq_index  # sorted seq idx
     """
     super(RawWavDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    # The read-ahead of the previous seq order. The results which are not done yet are simply dropped.
+    # Failed decodes are dropped as well, they would raise again when the file is needed.
+    for wavFileId, asyncResult in list(self._decodePending.items()):
+      if asyncResult.ready() and asyncResult.successful():
+        self._getDecodedTimeSignal(wavFileId)  # moves it into the cache
+    self._decodePending.clear()
 
     if epoch is None:
-        self._seq_index_list = range(self.num_seqs)
+        self._seq_index_list = list(range(self.num_seqs))
         return True
 
     if seq_list:
@@ -218,7 +320,7 @@ class RawWavDataset(CachedDataset2):
     self._seq_index_list = seq_index
     if epoch is not None:
       # Give some hint to the user in case he is wondering why the cache is reloading.
-      print >> log.v4, "Reinitialize dataset seq order for epoch %i." % epoch
+      print("Reinitialize dataset seq order for epoch %i." % epoch, file=log.v4)
 
     return True
 
@@ -11,10 +11,13 @@ from __future__ import print_function
 import sys
 import os
 import array
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 import numpy
 import zlib
 import mmap
+import copy
+import threading
+from collections import OrderedDict
 
 
 class FileInfo:
@@ -79,7 +82,9 @@ class FileArchive:
     return res
 
   # write routines
-  def write_str(self, s):
+  def write_str(self, s, enc='ascii'):
+    if not isinstance(s, bytes):
+      s = s.encode(enc)
     return self.f.write(pack("%ds" % len(s), s))
 
   def write_char(self, i):
@@ -104,8 +109,18 @@ class FileArchive:
   start_recovery_tag = 0xaa55aa55
   end_recovery_tag = 0x55aa55aa
 
-  def __init__(self, filename, must_exists=True):
+  def __init__(self, filename, must_exists=True, use_mmap=False):
+    """
+    :param str filename:
+    :param bool must_exists: otherwise, if it does not exist, we create a new archive for writing
+    :param bool use_mmap: for reading. maps the file into memory and reads the entries from there,
+      without any seek on a shared file object. see :func:`_read_entry_data`
+    """
 
+    self.filename = filename
+    self.use_mmap = use_mmap
+    self._lock = threading.Lock()  # for self.f and self._mmap
+    self._mmap = None  # type: mmap.mmap|None
     self.ft = {}  # type: dict[str,FileInfo]
     if os.path.exists(filename):
       self.allophones = []
@@ -118,6 +133,8 @@ class FileArchive:
         self.readFileInfoTable()
       else:
         self.scanArchive()
+      if use_mmap:
+        self._mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
 
     else:
       assert not must_exists, "File does not exist: %r" % filename
@@ -131,7 +148,25 @@ class FileArchive:
       self._short_seg_names.clear()
 
   def __del__(self):
-    self.f.close()
+    if self.f:
+      self.f.close()
+
+  def close(self):
+    """
+    Closes the file. When reading, it will be reopened on demand.
+    """
+    with self._lock:
+      # Some other thread might still read from the mmap. It will be closed once it is not referenced anymore.
+      self._mmap = None
+      if self.f:
+        self.f.close()
+        self.f = None
+
+  def is_open(self):
+    """
+    :rtype: bool
+    """
+    return self.f is not None
 
   def file_list(self):
     return self.ft.keys()
@@ -289,36 +324,197 @@ class FileArchive:
     :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]
     """
 
+    fi = self._get_file_info(filename)
+    data = self._read_entry_data(filename)
+    if data is None:
+      return None
+    # Decode from an anonymous memmap file object, via a shallow copy of ourselves,
+    # such that we don't touch our own self.f, and this is thread-safe.
+    reader = copy.copy(self)
+    reader.f = mmap.mmap(-1, len(data))
+    reader.f.write(data)
+    reader.f.seek(0)
+    try:
+      return reader._raw_read(size=fi.size, typ=typ)
+    finally:
+      # Don't close it in reader.__del__. The returned arrays might point into it.
+      reader.f = None
+
+  def _get_file_info(self, filename):
+    """
+    :param str filename: the entry-name in the archive, or the short name
+    :rtype: FileInfo
+    """
     if filename not in self.ft:
       if filename in self._short_seg_names:
         filename = self._short_seg_names[filename]
+    return self.ft[filename]
 
-    fi = self.ft[filename]
-    self.f.seek(fi.pos)
-    size = self.read_U32()
-    comp = self.read_U32()
-    chk  = self.read_U32()
+  def _read_entry_data(self, filename):
+    """
+    This is thread-safe. With use_mmap, different threads can read in parallel.
+
+    :param str filename: the entry-name in the archive
+    :return: the raw (decompressed) content of the entry, or None if it is empty
+    :rtype: bytes|None
+    """
+    fi = self._get_file_info(filename)
+    with self._lock:
+      if not self.f:  # was closed, reopen
+        self.f = open(self.filename, 'rb')
+        if self.use_mmap:
+          self._mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+      m = self._mmap
+      if not m:
+        self.f.seek(fi.pos)
+        size, comp, chk = unpack("III", self.f.read(12))
+        data = self.f.read(comp if comp > 0 else size)
+    if m:
+      # The mmap is never modified, so we don't need the lock.
+      size, comp, chk = unpack_from("III", m, fi.pos)
+      data = m[fi.pos + 12:fi.pos + 12 + (comp if comp > 0 else size)]
     if size == 0:
       return None
-
     if comp > 0:
-      # read compressed bytes into memory as 'bytearray'
-      a = array.array('b')
-      a.fromfile(self.f, comp)
-      # unpack
-      b = zlib.decompress(a.tostring(), 15+32)
-      # substitute self.f by an anonymous memmap file object
-      # restore original file handle after we're done
-      backup_f = self.f
-      self.f = mmap.mmap(-1, len(b))
-      self.f.write(b)
-      self.f.seek(0)
-      try:
-        return self._raw_read(size=fi.size, typ=typ)
-      finally:
-        self.f = backup_f
+      return zlib.decompress(data, 15+32)
+    return data
 
-    return self._raw_read(size=fi.size, typ=typ)
+  def read_numpy(self, filename, typ):
+    """
+    Like :func:`read`, but decodes the whole entry at once via Numpy, which is much faster.
+
+    :param str filename: the entry-name in the archive
+    :param str typ: "feat", "align" or "align_raw"
+    :return: depending on typ,
+      "feat" -> (times, features), times of shape (time,2) (start-time,end-time) in float64,
+        features of shape (time,dim) in float32;
+      "align" -> (times, allophones, states), all of shape (time,) in int32;
+      "align_raw" -> (times, mixtures, None), i.e. like "align" but the states are not decoded from the mixtures,
+      or None if the entry is empty.
+    :rtype: (numpy.ndarray,numpy.ndarray)|(numpy.ndarray,numpy.ndarray,numpy.ndarray|None)|None
+    """
+    data = self._read_entry_data(filename)
+    if data is None:
+      return None
+    if typ == "feat":
+      return self.decode_feature_data(data)
+    if typ in ["align", "align_raw"]:
+      times, mixtures = self.decode_alignment_data(data)
+      if typ == "align_raw":
+        return times, mixtures, None
+      allophones, states = self.get_states(mixtures)
+      return times, allophones, states
+    raise NotImplementedError("typ: %r" % typ)
+
+  @staticmethod
+  def _decode_str(data, pos):
+    """
+    :param bytes data:
+    :param int pos:
+    :return: (str, new pos), for a string with its length (U32) in front
+    :rtype: (str, int)
+    """
+    l, = unpack_from("I", data, pos)
+    return data[pos + 4:pos + 4 + l].decode("ascii"), pos + 4 + l
+
+  @classmethod
+  def decode_feature_data(cls, data):
+    """
+    :param bytes data: raw content of a feature entry, see :func:`_read_entry_data`
+    :return: (times, features), times of shape (time,2) in float64, features of shape (time,dim) in float32
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    typ, pos = cls._decode_str(data, 0)
+    assert typ == "vector-f32"
+    count, = unpack_from("I", data, pos)
+    pos += 4
+    if count == 0:
+      return numpy.zeros((0, 2), dtype="float64"), numpy.zeros((0, 0), dtype="float32")
+    dim, = unpack_from("I", data, pos)
+    # Each frame is (dim: U32, features: dim x f32, times: 2 x f64). All frames have the same dim.
+    frame_dtype = numpy.dtype([("dim", "u4"), ("data", "f4", (dim,)), ("time", "f8", (2,))])
+    assert len(data) >= pos + count * frame_dtype.itemsize, "feature entry too short, or varying dims"
+    frames = numpy.frombuffer(data, dtype=frame_dtype, count=count, offset=pos)
+    assert (frames["dim"] == dim).all(), "varying feature dims are not supported"
+    return numpy.ascontiguousarray(frames["time"]), numpy.ascontiguousarray(frames["data"]).reshape((count, dim))
+
+  @classmethod
+  def decode_alignment_data(cls, data):
+    """
+    :param bytes data: raw content of an alignment entry, see :func:`_read_entry_data`
+    :return: (times, mixtures), both of shape (time,) in int32. see :func:`get_states` for the mixtures
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    typ, pos = cls._decode_str(data, 0)
+    assert typ == "flow-alignment"
+    pos += 4  # flag
+    typ = data[pos:pos + 8].decode("ascii")
+    pos += 8
+    if typ not in ["ALIGNRLE", "AALPHRLE"]:
+      raise Exception("No valid alignment header found (found: %r). Wrong cache?" % typ)
+    size, = unpack_from("I", data, pos)
+    pos += 4
+    if size >= (1 << 31):
+      raise NotImplementedError("No support for weighted alignments yet.")
+    # The RLE scheme has variable-length records, thus we go over the runs (not the frames) in Python,
+    # and collect for each run where its value(s) are, and then gather all the values at once.
+    run_times = []  # start time for each run
+    run_lens = []
+    run_offsets = []  # byte offset of the (first) value
+    run_strides = []  # 4 if there are run_len values, 0 if one value is repeated
+    time = 0
+    num_frames = 0
+    while num_frames < size:
+      n, = unpack_from("b", data, pos)
+      pos += 1
+      if n == 0:
+        time, = unpack_from("i", data, pos)
+        pos += 4
+        continue
+      run_times.append(time)
+      run_offsets.append(pos)
+      if n > 0:
+        run_lens.append(n)
+        run_strides.append(4)
+        pos += 4 * n
+      else:
+        n = -n
+        run_lens.append(n)
+        run_strides.append(0)
+        pos += 4
+      time += n
+      num_frames += n
+    run_lens = numpy.array(run_lens, dtype="int64")
+    # For each frame, the index within its run.
+    frame_idx_in_run = numpy.arange(num_frames) - numpy.repeat(numpy.cumsum(run_lens) - run_lens, run_lens)
+    times = numpy.repeat(numpy.array(run_times, dtype="int64"), run_lens) + frame_idx_in_run
+    offsets = (
+      numpy.repeat(numpy.array(run_offsets, dtype="int64"), run_lens) +
+      numpy.repeat(numpy.array(run_strides, dtype="int64"), run_lens) * frame_idx_in_run)
+    raw = numpy.frombuffer(data, dtype="uint8")
+    mixtures = raw[offsets[:, None] + numpy.arange(4)[None, :]].view("i4").reshape((num_frames,))
+    return times.astype("int32"), mixtures
+
+  def get_states(self, mixtures):
+    """
+    Vectorized variant of :func:`getState`.
+
+    :param numpy.ndarray mixtures: shape (time,), int32
+    :return: (allophones, states), both of shape (time,), int32
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    assert self.allophones
+    max_states = 6
+    allophones = numpy.array(mixtures, dtype="int32")
+    states = numpy.zeros(allophones.shape, dtype="int32")
+    for state in range(1, max_states):
+      mask = allophones >= len(self.allophones)
+      if not mask.any():
+        break
+      allophones[mask] -= (1 << 26)
+      states[mask] = state
+    assert (allophones >= 0).all()
+    return allophones, states
 
   def getState(self, mix):
     # See src/Tools/Archiver/Archiver.cc:getStateInfo() from Sprint source code.
@@ -373,6 +569,38 @@ class FileArchive:
 
     self.addAttributes(filename, len(features[0]), times[-1][1])
 
+  def addAlignmentCache(self, filename, mixtures):
+    """
+    Writes an alignment in the RLE scheme, as it is read by :func:`read` with typ "align".
+
+    :param str filename:
+    :param list[int]|numpy.ndarray mixtures: for each frame, allophone + state * (1 << 26)
+    """
+    self.write_U32(self.start_recovery_tag)
+    self.write_u32(len(filename))
+    self.write_str(filename)
+    pos = self.f.tell()
+    body = [pack("I", 14), b"flow-alignment", pack("i", 0), b"ALIGNRLE", pack("I", len(mixtures))]
+    i = 0
+    while i < len(mixtures):
+      n = 1
+      while i + n < len(mixtures) and n < 128 and mixtures[i + n] == mixtures[i]:
+        n += 1
+      if n > 1:  # one value, repeated n times
+        body += [pack("b", -n), pack("i", mixtures[i])]
+      else:  # single values, as many as possible until the next repetition
+        while i + n < len(mixtures) and n < 127 and (i + n + 1 >= len(mixtures) or mixtures[i + n + 1] != mixtures[i + n]):
+          n += 1
+        body += [pack("b", n)] + [pack("i", m) for m in mixtures[i:i + n]]
+      i += n
+    body = b"".join(body)
+    self.write_u32(len(body))
+    self.write_u32(0)
+    self.write_u32(0)
+    self.f.write(body)
+    self.ft[filename] = FileInfo(filename, pos, len(body), 0, len(self.ft))
+    self.write_U32(self.end_recovery_tag)
+
   def addAttributes(self, filename, dim, duration):
     data = '<flow-attributes><flow-attribute name="datatype" value="vector-f32"/><flow-attribute name="sample-size" value="%d"/><flow-attribute name="total-duration" value="%.5f"/></flow-attributes>' % (dim, duration)
     self.write_U32(self.start_recovery_tag)
@@ -391,20 +619,130 @@ class FileArchive:
 
 class FileArchiveBundle():
 
-  def __init__(self, filename):
+  _IndexVersion = 1  # for the index_cache_dir files, increase when the format changes
+
+  def __init__(self, filename, use_mmap=False, max_open_archives=None, index_cache_dir=None):
     """
     :param str filename: .bundle file 
+    :param bool use_mmap: see :class:`FileArchive`
+    :param int|None max_open_archives: if set, we keep at most that many archives open (LRU).
+      the others are closed and reopened on demand.
+      as this is not strictly synchronized with the reads in other threads,
+      some archive might be reopened by a read while we close it, so there can temporarily be a few more open.
+    :param str|None index_cache_dir: if given, the index (archive content file -> archive) is stored there,
+      keyed by the size and mtime of the bundle and its archives, and reused.
+      then no archive is opened here at all, but only on the first access of its content.
+      otherwise, we need to open each archive once initially, to read its content list
     """
-    # filename -> FileArchive
+    self.filename = filename
+    self.use_mmap = use_mmap
+    self.archive_filenames = open(filename).read().splitlines()  # type: list[str]
+    # filename -> FileArchive. only the ones which were opened (once) so far, see self._get_archive_by_idx()
     self.archives = {}  # type: dict[str,FileArchive]
-    # archive content file -> FileArchive
-    self.files = {}  # type: dict[str,FileArchive]
+    # archive content file -> idx in self.archive_filenames
+    self.files = {}  # type: dict[str,int]
+    self._short_seg_names = {}
+    self._allophones_filename = None  # type: str|None  # see setAllophones()
+    self.max_open_archives = max_open_archives
+    self._open_archives = OrderedDict()  # type: dict[str,FileArchive]  # LRU order, last is most recently used
+    self._lock = threading.Lock()  # for self.archives and self._open_archives
+    self._load_index(index_cache_dir)
+
+  def _load_index(self, index_cache_dir):
+    """
+    Sets self.files and self._short_seg_names, maybe from the index file in index_cache_dir.
+
+    :param str|None index_cache_dir:
+    """
+    import hashlib
+    import pickle
+    index_filename = None
+    key = None
+    if index_cache_dir:
+      filename = os.path.abspath(self.filename)
+      key = (self._IndexVersion, filename) + tuple([
+        (fn, st.st_size, int(st.st_mtime)) for (fn, st) in [
+          (fn, os.stat(fn)) for fn in [filename] + self.archive_filenames]])
+      index_filename = "%s/%s.%s.index.pickle" % (
+        index_cache_dir, os.path.basename(filename), hashlib.md5(filename.encode("utf8")).hexdigest()[:8])
+      if os.path.exists(index_filename):
+        try:
+          with open(index_filename, "rb") as f:
+            cached_key, self.files, self._short_seg_names = pickle.load(f)
+          if cached_key == key:
+            return
+        except Exception as exc:
+          print("FileArchiveBundle: ignoring broken index file %s: %r" % (index_filename, exc), file=sys.stderr)
+    self.files = {}
     self._short_seg_names = {}
-    for l in open(filename).read().splitlines():
-      self.archives[l] = a = FileArchive(l, must_exists=True)
+    for i in range(len(self.archive_filenames)):
+      a = self._get_archive_by_idx(i)
       for f in a.ft.keys():
-        self.files[f] = a
+        self.files[f] = i
       self._short_seg_names.update(a._short_seg_names)
+      if index_filename or self.max_open_archives is not None:
+        a.close()  # reopened on demand
+    if index_filename:
+      if not os.path.exists(index_cache_dir):
+        try:
+          os.makedirs(index_cache_dir)
+        except OSError:  # maybe created in parallel
+          pass
+      # Write to a temp file first so that parallel readers never see a partial index.
+      tmp_filename = "%s.tmp%i" % (index_filename, os.getpid())
+      with open(tmp_filename, "wb") as f:
+        pickle.dump((key, self.files, self._short_seg_names), f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_filename, index_filename)
+
+  def _get_archive_by_idx(self, archive_idx):
+    """
+    :param int archive_idx: index in self.archive_filenames
+    :return: the archive, which is opened if this is the first access
+    :rtype: FileArchive
+    """
+    archive_filename = self.archive_filenames[archive_idx]
+    with self._lock:
+      if archive_filename not in self.archives:
+        a = FileArchive(archive_filename, must_exists=True, use_mmap=self.use_mmap)
+        if self._allophones_filename:
+          a.setAllophones(self._allophones_filename)
+        self.archives[archive_filename] = a
+      return self.archives[archive_filename]
+
+  def _touch_archive(self, archive):
+    """
+    Marks the archive as most recently used, and closes the least recently used ones if there are too many open.
+
+    :param FileArchive archive:
+    """
+    if self.max_open_archives is None:
+      return
+    with self._lock:
+      self._open_archives.pop(archive.filename, None)
+      self._open_archives[archive.filename] = archive
+      while len(self._open_archives) > self.max_open_archives:
+        _, old_archive = self._open_archives.popitem(last=False)
+        old_archive.close()
+
+  def _get_archive(self, filename):
+    """
+    :param str filename: the entry-name in the archive, or the short name
+    :return: (archive, entry-name)
+    :rtype: (FileArchive, str)
+    """
+    if filename not in self.files:
+      if filename in self._short_seg_names:
+        filename = self._short_seg_names[filename]
+    archive = self._get_archive_by_idx(self.files[filename])
+    self._touch_archive(archive)
+    return archive, filename
+
+  def get_num_open_archives(self):
+    """
+    :rtype: int
+    """
+    with self._lock:
+      return len([a for a in self.archives.values() if a.is_open()])
 
   def file_list(self):
     """
@@ -434,30 +772,47 @@ class FileArchiveBundle():
 
     Uses FileArchive.read().
     """
-    if filename not in self.files:
-      if filename in self._short_seg_names:
-        filename = self._short_seg_names[filename]
-    return self.files[filename].read(filename, typ)
+    archive, filename = self._get_archive(filename)
+    return archive.read(filename, typ)
+
+  def read_numpy(self, filename, typ):
+    """
+    :param str filename: the entry-name in the archive
+    :param str typ: "feat", "align" or "align_raw"
+    :return: see :func:`FileArchive.read_numpy`
+    :rtype: (numpy.ndarray,numpy.ndarray)|(numpy.ndarray,numpy.ndarray,numpy.ndarray|None)|None
+
+    Uses FileArchive.read_numpy().
+    """
+    archive, filename = self._get_archive(filename)
+    return archive.read_numpy(filename, typ)
 
   def setAllophones(self, filename):
     """
     :param str filename: allophone filename 
     """
-    for a in self.archives.values():
-      a.setAllophones(filename)
+    with self._lock:
+      self._allophones_filename = filename  # for the archives which we open later
+      for a in self.archives.values():
+        a.setAllophones(filename)
 
 
-def open_file_archive(archive_filename, must_exists=True):
+def open_file_archive(archive_filename, must_exists=True, use_mmap=False, max_open_archives=None,
+                      index_cache_dir=None):
   """
   :param str archive_filename:
   :param bool must_exists:
+  :param bool use_mmap: see :class:`FileArchive`
+  :param int|None max_open_archives: for a bundle, see :class:`FileArchiveBundle`
+  :param str|None index_cache_dir: for a bundle, see :class:`FileArchiveBundle`
   :rtype: FileArchiveBundle|FileArchive
   """
   if archive_filename.endswith(".bundle"):
     assert must_exists
-    return FileArchiveBundle(archive_filename)
+    return FileArchiveBundle(
+      archive_filename, use_mmap=use_mmap, max_open_archives=max_open_archives, index_cache_dir=index_cache_dir)
   else:
-    return FileArchive(archive_filename, must_exists=must_exists)
+    return FileArchive(archive_filename, must_exists=must_exists, use_mmap=use_mmap)
 
 
 def is_sprint_cache_file(filename):
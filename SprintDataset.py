@@ -24,7 +24,7 @@ from Dataset import Dataset, DatasetSeq
 from CachedDataset2 import CachedDataset2
 from Log import log
 from TaskSystem import Unpickler, numpy_copy_and_set_unused
-from Util import eval_shell_str, interrupt_main, unicode
+from Util import eval_shell_str, interrupt_main, unicode, NumbersDict
 
 
 class SprintDatasetBase(Dataset):
@@ -694,16 +694,21 @@ class SprintCacheDataset(CachedDataset2):
   """
 
   class SprintCacheReader(object):
-    def __init__(self, data_key, filename, type=None, allophone_labeling=None):
+    def __init__(self, data_key, filename, type=None, allophone_labeling=None, use_mmap=False, max_open_archives=None,
+                 index_cache_dir=None):
       """
       :param str data_key: e.g. "data" or "classes"
       :param str filename: to Sprint cache archive
       :param str|None type: "feat" or "align"
       :param dict[str] allophone_labeling: kwargs for :class:`AllophoneLabeling`
+      :param bool use_mmap: see :class:`SprintCache.FileArchive`
+      :param int|None max_open_archives: for a bundle, see :class:`SprintCache.FileArchiveBundle`
+      :param str|None index_cache_dir: for a bundle, see :class:`SprintCache.FileArchiveBundle`
       """
       self.data_key = data_key
       from SprintCache import open_file_archive
-      self.sprint_cache = open_file_archive(filename)
+      self.sprint_cache = open_file_archive(
+        filename, use_mmap=use_mmap, max_open_archives=max_open_archives, index_cache_dir=index_cache_dir)
       if not type:
         if data_key == "data":
           type = "feat"
@@ -747,12 +752,10 @@ class SprintCacheDataset(CachedDataset2):
     def _get_feature_dim(self):
       assert self.type == "feat"
       assert self.content_keys
-      times, feats = self.sprint_cache.read(self.content_keys[0], "feat")
+      times, feats = self.sprint_cache.read_numpy(self.content_keys[0], "feat")
       assert len(times) == len(feats) > 0
-      feat = feats[0]
-      assert isinstance(feat, numpy.ndarray)
-      assert feat.ndim == 1
-      return feat.shape[0]
+      assert feats.ndim == 2
+      return feats.shape[1]
 
     def read(self, name):
       """
@@ -760,19 +763,24 @@ class SprintCacheDataset(CachedDataset2):
       :return: numpy array of shape (time, [num_labels])
       :rtype: numpy.ndarray
       """
-      res = self.sprint_cache.read(name, typ=self.type)
-      if self.type == "align":
-        label_seq = numpy.array([self.allophone_labeling.get_label_idx(a, s) for (t, a, s) in res], dtype=self.dtype)
-        assert label_seq.shape == (len(res),)
-        return label_seq
-      elif self.type == "align_raw":
-        label_seq = numpy.array([self.allophone_labeling.state_tying_by_allo_state_idx[a] for (t, a, s) in res], dtype=self.dtype)
-        assert label_seq.shape == (len(res),)
+      res = self.sprint_cache.read_numpy(name, typ=self.type)
+      if self.type in ["align", "align_raw"]:
+        times, allophones, states = res
+        # Map each distinct (allophone, state) only once.
+        if self.type == "align":
+          allo_states = allophones.astype("int64") + states.astype("int64") * (1 << 26)
+          get_label_idx = self.allophone_labeling.get_label_idx_by_allo_state_idx
+        else:
+          allo_states = allophones  # the raw mixtures
+          get_label_idx = self.allophone_labeling.state_tying_by_allo_state_idx.__getitem__
+        uniq_allo_states, label_seq_idxs = numpy.unique(allo_states, return_inverse=True)
+        uniq_labels = numpy.array([get_label_idx(int(a)) for a in uniq_allo_states], dtype=self.dtype)
+        label_seq = uniq_labels[label_seq_idxs]
+        assert label_seq.shape == (len(times),)
         return label_seq
       elif self.type == "feat":
-        times, feats = res
-        assert len(times) == len(feats) > 0
-        feat_mat = numpy.array(feats, dtype=self.dtype)
+        times, feat_mat = res
+        assert len(times) == len(feat_mat) > 0
         assert feat_mat.shape == (len(times), self.num_labels)
         return feat_mat
       else:
@@ -855,6 +863,201 @@ class SprintCacheDataset(CachedDataset2):
     return self.seq_list_ordered[sorted_seq_idx]
 
 
+class SprintCachePackedDataset(CachedDataset2):
+  """
+  Reads the packed corpus which was created via :func:`pack_sprint_cache_dataset`
+  (or tools/sprint-cache-pack.py) from a :class:`SprintCacheDataset` config.
+  All sequences of a data key are concatenated in one flat binary file, which we memory-map,
+  and the index (tags, lengths, offsets) is loaded once at init.
+  Thus, reading a sequence is just a slice, without any parsing or label mapping.
+  The data keys and dims are the same as for the original :class:`SprintCacheDataset`.
+
+  The directory layout is:
+    meta.json: num_outputs and dtype per data key
+    index.npz: "tags", and "lens_<key>", "offsets_<key>" per data key, in the original cache order
+    <key>.bin: the raw concatenated data of the data key
+  """
+
+  def __init__(self, path, **kwargs):
+    """
+    :param str path: directory of the packed corpus
+    """
+    super(SprintCachePackedDataset, self).__init__(**kwargs)
+    import json
+    self.path = path
+    with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+    self.num_outputs = {str(key): tuple(v) for (key, v) in meta["num_outputs"].items()}
+    self.num_inputs = self.num_outputs["data"][0]
+    self.dtypes = {str(key): str(v) for (key, v) in meta["dtypes"].items()}
+    index = numpy.load(os.path.join(path, "index.npz"))
+    self.seq_list_original = [str(tag) for tag in index["tags"]]
+    self._tag_idx = {tag: i for (i, tag) in enumerate(self.seq_list_original)}
+    self._seq_lens = {key: index["lens_%s" % key] for key in self.num_outputs}
+    self._seq_offsets = {key: index["offsets_%s" % key] for key in self.num_outputs}
+    self._data = {key: self._open_data(key) for key in self.num_outputs}
+    self._seq_index = list(range(len(self.seq_list_original)))
+    self._num_seqs = len(self._seq_index)
+
+  def _open_data(self, key):
+    """
+    :param str key:
+    :return: read-only memory-mapped array of shape (total_time, [dim])
+    :rtype: numpy.ndarray
+    """
+    dim, ndim = self.num_outputs[key]
+    shape = (int(numpy.sum(self._seq_lens[key])),) + ((dim,) if ndim == 2 else ())
+    if shape[0] == 0:
+      return numpy.zeros(shape, dtype=self.dtypes[key])  # mmap of an empty file is not possible
+    return numpy.memmap(os.path.join(self.path, "%s.bin" % key), dtype=self.dtypes[key], mode="r", shape=shape)
+
+  def init_seq_order(self, epoch=None, seq_list=None):
+    """
+    :param int|None epoch:
+    :param list[str]|None seq_list: predefined order, via the seq tags
+    :rtype: bool
+    """
+    super(SprintCachePackedDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    if seq_list is not None:
+      self._seq_index = [self._tag_idx[tag] for tag in seq_list]
+    else:
+      data_lens = self._seq_lens["data"]
+      self._seq_index = self.get_seq_order_for_epoch(
+        epoch, len(self.seq_list_original), get_seq_len=lambda s: data_lens[s])
+    self._num_seqs = len(self._seq_index)
+    return True
+
+  def init_seq_order_by_index(self, epoch=None, seq_order=None):
+    """
+    :param int|None epoch:
+    :param list[int]|numpy.ndarray seq_order: indices into seq_list_original
+    :rtype: bool
+    """
+    super(SprintCachePackedDataset, self).init_seq_order(epoch=epoch)
+    self._seq_index = numpy.asarray(seq_order)
+    self._num_seqs = len(self._seq_index)
+    return True
+
+  def get_all_tags(self):
+    """
+    :rtype: list[str]
+    """
+    return self.seq_list_original
+
+  def get_dataset_seq_for_name(self, name, seq_idx=-1):
+    """
+    :param str name: seq tag
+    :param int seq_idx:
+    :rtype: DatasetSeq
+    """
+    return self._get_dataset_seq(orig_seq_idx=self._tag_idx[name], seq_idx=seq_idx)
+
+  def _get_dataset_seq(self, orig_seq_idx, seq_idx):
+    """
+    :param int orig_seq_idx: index into seq_list_original
+    :param int seq_idx:
+    :rtype: DatasetSeq
+    """
+    data = {}
+    for key, arr in self._data.items():
+      offset = self._seq_offsets[key][orig_seq_idx]
+      data[key] = numpy.array(arr[offset:offset + self._seq_lens[key][orig_seq_idx]])
+    return DatasetSeq(
+      seq_idx=seq_idx, seq_tag=self.seq_list_original[orig_seq_idx], features=data["data"], targets=data)
+
+  def _collect_single_seq(self, seq_idx):
+    """
+    :type seq_idx: int
+    :rtype: DatasetSeq | None
+    :returns DatasetSeq or None if seq_idx >= num_seqs.
+    """
+    if seq_idx >= self.num_seqs:
+      return None
+    return self._get_dataset_seq(orig_seq_idx=self._seq_index[seq_idx], seq_idx=seq_idx)
+
+  def get_seq_length(self, sorted_seq_idx):
+    """
+    We know all the lengths from the index, so this does not need to load the seq.
+
+    :param int sorted_seq_idx:
+    :rtype: NumbersDict
+    """
+    orig_seq_idx = self._seq_index[sorted_seq_idx]
+    return NumbersDict({key: int(lens[orig_seq_idx]) for (key, lens) in self._seq_lens.items()})
+
+  def get_num_timesteps(self):
+    """
+    :rtype: int
+    """
+    return int(numpy.sum(self._seq_lens["data"][self._seq_index]))
+
+  def get_data_keys(self):
+    """
+    :rtype: list[str]
+    """
+    return sorted(self.num_outputs.keys())
+
+  def get_target_list(self):
+    """
+    :rtype: list[str]
+    """
+    return [key for key in self.get_data_keys() if key != "data"]
+
+  def get_data_dtype(self, key):
+    """
+    :param str key:
+    :rtype: str
+    """
+    return self.dtypes[key]
+
+  def get_tag(self, sorted_seq_idx):
+    """
+    :rtype: str
+    """
+    return self.seq_list_original[self._seq_index[sorted_seq_idx]]
+
+
+def pack_sprint_cache_dataset(dataset, path):
+  """
+  Converts all the sequences of a :class:`SprintCacheDataset` (in the original cache order)
+  into the packed corpus format which is read by :class:`SprintCachePackedDataset`.
+  This does all the cache parsing and allophone label mapping once.
+  The data is written sequentially, so this does not need to keep the corpus in memory.
+
+  :param SprintCacheDataset dataset:
+  :param str path: directory, will be created if it does not exist
+  """
+  import json
+  if not os.path.exists(path):
+    os.makedirs(path)
+  keys = sorted(dataset.data.keys())
+  tags = dataset.seq_list_original
+  seq_lens = {key: numpy.zeros((len(tags),), dtype="int64") for key in keys}
+  files = {key: open(os.path.join(path, "%s.bin" % key), "wb") for key in keys}
+  try:
+    for i, tag in enumerate(tags):
+      if i % 1000 == 0:
+        print("Pack seq %i/%i, %r" % (i, len(tags), tag), file=log.v4)
+      seq = dataset.get_dataset_seq_for_name(tag, seq_idx=i)
+      for key in keys:
+        x = numpy.ascontiguousarray(seq.get_data(key), dtype=dataset.data[key].dtype)
+        files[key].write(x.tobytes())
+        seq_lens[key][i] = x.shape[0]
+  finally:
+    for f in files.values():
+      f.close()
+  index = {"tags": numpy.array(tags)}
+  for key in keys:
+    index["lens_%s" % key] = seq_lens[key]
+    index["offsets_%s" % key] = numpy.cumsum(seq_lens[key]) - seq_lens[key]
+  numpy.savez(os.path.join(path, "index.npz"), **index)
+  with open(os.path.join(path, "meta.json"), "w") as f:
+    json.dump({
+      "num_outputs": {key: list(dataset.num_outputs[key]) for key in keys},
+      "dtypes": {key: dataset.data[key].dtype for key in keys}}, f)
+  print("Packed %i seqs into %r." % (len(tags), path), file=log.v3)
+
+
 def demo():
   print("SprintDataset demo.")
   from argparse import ArgumentParser
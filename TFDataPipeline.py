@@ -112,11 +112,30 @@ Pipeline implementation
 
 It depends on whether the full network is recurrent or not.
 
+
+Data providers used by the TF engine
+------------------------------------
+
+The chunking and batching is done by the Dataset (BatchSetGenerator) in all of them.
+
+* :class:`FeedDictDataProvider` (default): a background thread constructs the batches, fed via feed_dict.
+* :class:`MultiProcessDataProvider` (``data_provider_num_workers = N``): the batches are constructed in
+  N worker processes.
+* :class:`StagingDataProvider` (``data_provider = "staging"``, experimental): the background thread also puts
+  the batches into a StagingArea on the device (:class:`CpuToDefaultDevStage`), from where the network gets its data,
+  i.e. the CPU->GPU copy overlaps with the computation of the current step.
+  This is only the staging part, i.e. the batches are constructed like in :class:`FeedDictDataProvider`,
+  not via the queue-based pipeline described above, and it only helps if the copy to the device matters.
+  Every ``session.run()`` which depends on the network inputs takes one batch from the staging area,
+  thus it must use the feed dict from :func:`StagingDataProvider.get_feed_dict`. Otherwise it fails, see there.
+
 """
 
 from __future__ import print_function
 
 import sys
+import os
+import mmap
 try:
   # noinspection PyCompatibility
   from Queue import Queue
@@ -132,6 +151,7 @@ from tensorflow.python.ops.data_flow_ops import StagingArea
 from Dataset import Dataset, BatchSetGenerator
 from TFNetwork import ExternData, Data
 from Util import NumbersDict
+from Log import log
 
 
 class PipeBase(object):
@@ -710,40 +730,71 @@ class QueueOutput(object):
 
 
 class CpuToDefaultDevStage(object):
-  def __init__(self, input_data, names, dtypes, extern_data, data_keys):
+  def __init__(self, extern_data, data_keys, input_data=None, names=None, dtypes=None, capacity=0):
     """
-    :param dict[str,tf.Tensor] input_data:
-    :param list[str] names: data_keys + extra info
-    :param list[tf.DType|str] dtypes: corresponds to names
     :param ExternData extern_data:
-    :param list[str] data_keys:
+    :param list[str] data_keys: the keys which we stage
+    :param dict[str,tf.Tensor]|None input_data: if not given, we create placeholders for it,
+      see self.input_placeholders
+    :param list[str]|None names: data_keys + extra info
+    :param list[tf.DType|str]|None dtypes: corresponds to names
+    :param int capacity: max number of staged elements. 0 means unlimited. the put will block if full
     """
-    from TFUtil import post_control_dependencies
+    self.data_keys = data_keys
+    self.input_placeholders = None  # type: MakePlaceholders
+    # With the placeholders, we also stage a batch id, and the outputs check it against the expected batch id.
+    # Thus a session.run() which does not feed the expected batch id cannot silently take a staged batch.
+    self.batch_id_placeholder = None  # type: tf.Tensor|None
+    self.expected_batch_id_placeholder = None  # type: tf.Tensor|None
+    shapes = None
+    if input_data is None:
+      with tf.device("/cpu:0"):
+        self.input_placeholders = MakePlaceholders(data_keys=data_keys, extern_data=extern_data, with_batch=True)
+        self.batch_id_placeholder = tf.placeholder(tf.int64, shape=(), name="staged_batch_id")
+        self.expected_batch_id_placeholder = tf.placeholder(tf.int64, shape=(), name="expected_staged_batch_id")
+      input_data = self.input_placeholders.data_placeholders()
+      input_data["batch_id"] = self.batch_id_placeholder
+      names = self.input_placeholders.names + ["batch_id"]
+      dtypes = self.input_placeholders.dtypes + ["int64"]
+      shapes = [input_data[name].get_shape() for name in names]
 
     # The device-scope when this gets called is the default device,
     # so everywhere where we want to do it on CPU, we have to specify it explicitly.
     # StagingArea can be used for async CPU->GPU transfer.
     # It will live on the current device by the current device scope, e.g. the GPU.
-    self._tf_staging_area = StagingArea(names=names, dtypes=dtypes)
+    self._tf_staging_area = StagingArea(names=names, dtypes=dtypes, shapes=shapes, capacity=capacity)
 
     with tf.device("/cpu:0"):
-      self.staging_size = tf.Variable(0, trainable=False, dtype=tf.int32, name="staging_size")
-      self._staging_size_init = tf.variables_initializer([self.staging_size])
-      with tf.control_dependencies([tf.assign_add(self.staging_size, 1)]):
-        self.stage_put_op = self._tf_staging_area.put(input_data)
-      get_updates = [tf.assign_sub(self.staging_size, 1)]
+      self.stage_put_op = self._tf_staging_area.put(input_data)
+      self.staging_size = self._tf_staging_area.size()
+      self.stage_clear_op = self._tf_staging_area.clear()
     # This should run on the default device (GPU).
-    self.stage_get_op = post_control_dependencies(self._tf_staging_area.get(), updates=get_updates)
-
+    # With the batch id check, we don't unstage anything if the expected batch id is not fed.
+    with tf.control_dependencies([self.expected_batch_id_placeholder] if self.batch_id_placeholder is not None else []):
+      self.stage_get_op = self._tf_staging_area.get()
+    stage_output = self.stage_get_op
+    if self.batch_id_placeholder is not None:
+      with tf.device("/cpu:0"):
+        check = tf.Assert(
+          tf.equal(self.stage_get_op["batch_id"], self.expected_batch_id_placeholder),
+          ["staged batch id", self.stage_get_op["batch_id"], "expected", self.expected_batch_id_placeholder])
+      with tf.control_dependencies([check]):
+        stage_output = {name: tf.identity(self.stage_get_op[name]) for name in names if name != "batch_id"}
+
+    # Same as extern_data, but the staged data comes from the staging area.
     self.output_as_extern_data = ExternData(
       default_input=extern_data.default_input,
-      default_target=extern_data.default_target,
-      data={key: Data(**data.get_kwargs()) for (key, data) in data_keys})
-    for key, data in self.output_as_extern_data.data.items():
-      data.placeholder = self.stage_get_op[key]
+      default_target=extern_data.default_target)
+    for key, data in extern_data.data.items():
+      if key not in data_keys:
+        self.output_as_extern_data.data[key] = data
+        continue
+      data = Data(**data.get_kwargs())
+      data.placeholder = stage_output[key]
       data.size_placeholder = {
-        axis: self.stage_get_op["%s/size%i" % (key, axis)]
+        axis: stage_output["%s/size%i" % (key, axis)]
         for axis in data.get_axes_with_size()}
+      self.output_as_extern_data.data[key] = data
 
   def loop(self, parent, coord, session):
     """
@@ -824,6 +875,97 @@ class DataProviderBase(object):
     raise NotImplementedError
 
 
+class BatchBufferPool(object):
+  """
+  Reusable numpy buffers for the batch data, such that we don't allocate new arrays for every batch and data key.
+  For every key, there is a ring of `num_buffers` flat buffers, which grow on demand.
+  A buffer is reused after `num_buffers` further requests for the same key,
+  thus the consumer must be done with the data by then (e.g. it was fed to TF, which makes a copy).
+  """
+
+  def __init__(self, num_buffers):
+    """
+    :param int num_buffers:
+    """
+    assert num_buffers > 0
+    self.num_buffers = num_buffers
+    self._buffers = {}  # type: dict[str,list[numpy.ndarray|None]]
+    self._next_idx = {}  # type: dict[str,int]
+
+  def get_zeros(self, key, shape, dtype):
+    """
+    :param str key:
+    :param list[int]|tuple[int] shape:
+    :param str|numpy.dtype dtype:
+    :return: like numpy.zeros(shape, dtype), C-contiguous, but a view on one of the buffers of the key
+    :rtype: numpy.ndarray
+    """
+    dtype = numpy.dtype(dtype)
+    size = int(numpy.prod(shape))
+    buffers = self._buffers.setdefault(key, [None] * self.num_buffers)
+    idx = self._next_idx.get(key, 0)
+    self._next_idx[key] = (idx + 1) % self.num_buffers
+    buf = buffers[idx]
+    if buf is None or buf.dtype != dtype or buf.size < size:
+      # Some extra space, such that we don't need to reallocate for every slightly bigger batch.
+      buf = buffers[idx] = numpy.empty((size + size // 4,), dtype=dtype)
+    res = buf[:size].reshape(shape)
+    res.fill(0)
+    return res
+
+
+def _fill_batch_arrays(dataset, data_key_infos, batch_desc, buffer_pool):
+  """
+  Loads the seqs of the batch and copies them into the zero-padded batch arrays.
+
+  :param Dataset dataset:
+  :param dict[str,(str,str|None)] data_key_infos: see :func:`FeedDictDataProvider._get_data_key_infos`
+  :param dict[str] batch_desc: see :func:`FeedDictDataProvider._get_batch_descriptor`
+  :param BatchBufferPool|SharedMemoryBatchSlot buffer_pool: where we allocate the batch arrays
+  :returns (batch-data-value-dict, batch-seq-lens)
+  :rtype: (dict[str,numpy.ndarray], dict[str,numpy.ndarray])
+  """
+  shapes = batch_desc["shapes"]
+  data = {k: buffer_pool.get_zeros(k, shape=shapes[k], dtype=dtype)
+          for (k, (dtype, _)) in data_key_infos.items() if dtype != "string"}
+  # Numpy cannot handle "string" dtype. Just make it a list[str], which is what TF can handle.
+  data.update({k: [""] * batch_desc["num_slices"]
+               for (k, (dtype, _)) in data_key_infos.items() if dtype == "string"})
+  seq_lens = {k: buffer_pool.get_zeros("%s_seq_lens" % k, shape=(shapes[k][0],), dtype=size_dtype)
+              for (k, (_, size_dtype)) in data_key_infos.items() if size_dtype}
+  for start, end in batch_desc["seq_ranges"]:  # not just (start_seq, end_seq), the seqs might have gaps
+    dataset.load_seqs(start, end)
+  key_frames = batch_desc["key_frames"]
+  with dataset.lock:
+    for i, seq_idx in enumerate(batch_desc["seq_idxs"]):
+      q = batch_desc["batch_slices"][i]
+      # input-data, input-index will also be set in this loop. That is data-key "data".
+      for k in data_key_infos.keys():
+        # Some special cases first, such as "seq_idx" and "seq_tag".
+        # See also :func:`TFNetwork.get_extern_data`.
+        if k == "seq_idx":
+          data[k][q] = seq_idx
+          continue
+        if k == "seq_tag":
+          data[k][q] = dataset.get_tag(seq_idx)
+          continue
+        if k in key_frames:
+          begin, end, o, defined = [x[i] for x in key_frames[k]]
+          if not defined or end - begin == 0:
+            continue
+        v = dataset.get_data(seq_idx, k)
+        if k in key_frames:
+          # Like Util.slice_pad_zeros(), but we copy directly into the batch, which is already zero-padded.
+          ls = end - begin
+          v_begin, v_end = max(begin, 0), min(end, v.shape[0])
+          if v_end > v_begin:
+            data[k][q, o + v_begin - begin:o + v_end - begin] = v[v_begin:v_end]
+          seq_lens[k][q] = max(seq_lens[k][q], o + ls)
+        else:  # no time-axis
+          data[k][q] = v
+  return data, seq_lens
+
+
 class FeedDictDataProvider(DataProviderBase):
   """
   This class will fill all the placeholders used for training or forwarding or evaluation etc.
@@ -850,6 +992,8 @@ class FeedDictDataProvider(DataProviderBase):
     self.tf_queue = tf_queue
     if not self.tf_queue:
       self.queue = Queue(maxsize=capacity)
+    # The batch in the making, up to `capacity` batches in the queue, and the one currently used by the consumer.
+    self.buffer_pool = BatchBufferPool(num_buffers=capacity + 2)
     self.thread = None  # type: Thread
     self.thread_finished = False
     self.reached_end = False
@@ -867,13 +1011,25 @@ class FeedDictDataProvider(DataProviderBase):
     self._flush_all_data()
     self.thread.join()
 
-  def _get_next_batch(self):
+  def _get_data_key_infos(self):
     """
-    :returns (batch-data-value-dict, batch-seq-lens)
-    :rtype: (dict[str,numpy.ndarray], dict[str,numpy.ndarray])
+    :return: data key -> (dtype, size dtype or None if it has no time axis).
+      this and the batch descriptor is all what we need to fill the batch arrays, see :func:`_fill_batch_arrays`
+    :rtype: dict[str,(str,str|None)]
+    """
+    return {
+      k: (self.extern_data.data[k].dtype,
+          self.extern_data.data[k].size_dtype if self.extern_data.data[k].have_time_axis() else None)
+      for k in self.data_keys}
+
+  def _get_batch_descriptor(self, batch):
+    """
+    :param Batch batch:
+    :return: all what we need to know about the batch to fill the batch arrays, see :func:`_fill_batch_arrays`.
+      only plain Python types, such that it can also be sent to another process
+    :rtype: dict[str]
     """
     # See EngineUtil.assign_dev_data() for reference.
-    batch, = self.batches.peek_next_n(1)
     from Dataset import Batch, shapes_for_batches
     assert isinstance(batch, Batch)
     # In Returnn with Theano, we usually have the shape (time,batch,feature).
@@ -881,53 +1037,36 @@ class FeedDictDataProvider(DataProviderBase):
     # This is also what we use here, i.e. batch_dim_first=True.
     # This must match the Data specification in TFNetwork.ExternData.init_from_config().
     shapes = shapes_for_batches([batch], data_keys=self.data_keys, extern_data=self.extern_data)
-    data = {k: numpy.zeros(shape=shapes[k], dtype=self.extern_data.data[k].dtype)
-            for k in self.data_keys if self.extern_data.data[k].dtype != "string"}
-    # Numpy cannot handle "string" dtype. Just make it a list[str], which is what TF can handle.
-    data.update({k: [""] * batch.num_slices
-                 for k in self.data_keys if self.extern_data.data[k].dtype == "string"})
-    seq_lens = {k: numpy.zeros(shape=(shapes[k][0],), dtype=self.extern_data.data[k].size_dtype)
-                for k in self.data_keys if self.extern_data.data[k].have_time_axis()}
-    self.dataset.load_seqs(batch.start_seq, batch.end_seq)
-    from Util import slice_pad_zeros
-    with self.dataset.lock:
-      for seq in batch.seqs:
-        o = seq.batch_frame_offset
-        q = seq.batch_slice
-        l = seq.frame_length
-        # input-data, input-index will also be set in this loop. That is data-key "data".
-        for k in self.data_keys:
-          # Some special cases first, such as "seq_idx" and "seq_tag".
-          # See also :func:`TFNetwork.get_extern_data`.
-          if k == "seq_idx":
-            data[k][q] = seq.seq_idx
-            continue
-          if k == "seq_tag":
-            data[k][q] = self.dataset.get_tag(seq.seq_idx)
-            continue
-          if self.extern_data.data[k].have_time_axis():
-            if l[k] in [0, None]:
-              continue
-          v = self.dataset.get_data(seq.seq_idx, k)
-          if self.extern_data.data[k].have_time_axis():
-            v = slice_pad_zeros(v, begin=seq.seq_start_frame[k], end=seq.seq_end_frame[k])
-            ls = v.shape[0]
-            if ls != l[k]:
-              raise Exception("got shape[0]: %i, expected: %i, start/end: %r/%r, seq_idx: %i, seq len: %r" % (
-                ls, l[k], seq.seq_start_frame, seq.seq_end_frame, seq.seq_idx, self.dataset.get_seq_length(seq.seq_idx)))
-            data[k][q, o[k]:o[k] + ls] = v
-            seq_lens[k][q] = max(seq_lens[k][q], o[k] + ls)
-          else:  # no time-axis
-            data[k][q] = v
-    return data, seq_lens
+    return dict(
+      num_slices=batch.num_slices,
+      shapes={k: [int(d) for d in shapes[k]] for k in self.data_keys},
+      seq_ranges=[(int(start), int(end)) for (start, end) in batch.get_seq_ranges()],
+      # Plain int lists per key, such that we don't need to create a BatchSeqCopyPart per part.
+      seq_idxs=batch.seqs.get_seq_idxs().tolist(),
+      batch_slices=batch.seqs.get_batch_slices().tolist(),
+      key_frames={k: [x.tolist() for x in batch.seqs.get_key_frames(k)]
+                  for k in self.data_keys if self.extern_data.data[k].have_time_axis()})
+
+  def _get_next_batch(self):
+    """
+    :returns (batch-data-value-dict, batch-seq-lens)
+    :rtype: (dict[str,numpy.ndarray], dict[str,numpy.ndarray])
+    """
+    batch, = self.batches.peek_next_n(1)
+    return _fill_batch_arrays(
+      dataset=self.dataset, data_key_infos=self._get_data_key_infos(),
+      batch_desc=self._get_batch_descriptor(batch), buffer_pool=self.buffer_pool)
 
   def get_next_batch(self):
+    """
+    :return: data and seq lens (as "<key>_seq_lens"), see self._get_next_batch()
+    :rtype: dict[str,numpy.ndarray]
+    """
     data, seq_lens = self._get_next_batch()
-    enqueue_args = data.copy()
-    for k in data.keys():
+    for k in list(data.keys()):
       if k in seq_lens:
-        enqueue_args["%s_seq_lens" % k] = seq_lens[k]
-    return enqueue_args
+        data["%s_seq_lens" % k] = seq_lens[k]
+    return data
 
   def thread_main(self):
     try:
@@ -1003,11 +1142,22 @@ class FeedDictDataProvider(DataProviderBase):
       output = self.get_next_batch()
     else:
       output = self.queue.get()
+    return self.get_feed_dict_for_output(output)
+
+  def get_feed_dict_for_output(self, output, data_keys=None):
+    """
+    :param dict[str,numpy.ndarray] output: from self.get_next_batch()
+    :param list[str]|None data_keys: by default self.data_keys
+    :return: placeholders of our external data -> values
+    :rtype: dict[tf.Tensor,numpy.ndarray]
+    """
     assert isinstance(output, dict)
+    if data_keys is None:
+      data_keys = self.data_keys
     # The data itself.
-    d = {self.extern_data.get_data(k).placeholder: output[k] for k in self.data_keys}
+    d = {self.extern_data.get_data(k).placeholder: output[k] for k in data_keys}
     # And seq lengths info.
-    for k in self.data_keys:
+    for k in data_keys:
       data = self.extern_data.get_data(k)
       for dim, len_placeholder in data.size_placeholder.items():
         if dim == 0:  # time-dim
@@ -1028,6 +1178,472 @@ class FeedDictDataProvider(DataProviderBase):
     return self.batches.completed_frac()
 
 
+class SharedMemoryBatchSlot(object):
+  """
+  One slot of shared memory for the batch data, backed by a file, preferably in /dev/shm.
+  The producer (a worker process of :class:`MultiProcessDataProvider`) allocates the batch arrays in it
+  via :func:`get_zeros`, i.e. it can be used instead of a :class:`BatchBufferPool`,
+  and the consumer maps the same file and gets the arrays without any copy via :func:`get_arrays`.
+  The consumer creates the file, the producer opens it by its filename,
+  and once both have it open, the consumer removes it via :func:`unlink`.
+  """
+
+  Alignment = 64
+
+  def __init__(self, filename=None, initial_size=1024 * 1024):
+    """
+    :param str|None filename: existing file (producer side). if not given, we create a new one (consumer side)
+    :param int initial_size: in bytes. the file grows on demand
+    """
+    if filename:
+      self.file = open(filename, "r+b")
+      self.filename = None  # not our file
+    else:
+      import tempfile
+      fd, self.filename = tempfile.mkstemp(
+        prefix="returnn-batch-slot", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+      self.file = os.fdopen(fd, "r+b")
+      os.ftruncate(self.file.fileno(), initial_size)
+    self.size = os.fstat(self.file.fileno()).st_size
+    self.mmap = None  # type: mmap.mmap|None
+    self.offset = 0
+    self.layout = {}  # type: dict[str,(int,str,tuple[int])]  # key -> (offset, dtype, shape)
+
+  def unlink(self):
+    """
+    Consumer side. Removes the file. The mappings stay valid.
+    """
+    if self.filename:
+      os.unlink(self.filename)
+      self.filename = None
+
+  def close(self):
+    self.unlink()
+    self.mmap = None
+    self.file.close()
+
+  def reset(self):
+    """
+    Producer side. Call this before a new batch is allocated in this slot.
+    """
+    self.offset = 0
+    self.layout = {}
+
+  def get_zeros(self, key, shape, dtype):
+    """
+    Producer side. Same interface as :func:`BatchBufferPool.get_zeros`.
+
+    :param str key:
+    :param list[int]|tuple[int] shape:
+    :param str|numpy.dtype dtype:
+    :return: like numpy.zeros(shape, dtype), C-contiguous, in the shared memory
+    :rtype: numpy.ndarray
+    """
+    dtype = numpy.dtype(dtype)
+    shape = tuple([int(d) for d in shape])
+    offset = self.offset
+    end = offset + int(numpy.prod(shape)) * dtype.itemsize
+    if end > self.size or not self.mmap:
+      if end > self.size:
+        self.size = max(end + end // 4, self.size * 2)
+        os.ftruncate(self.file.fileno(), self.size)
+      # Arrays in the old mapping stay valid, as both map the same file pages.
+      self.mmap = mmap.mmap(self.file.fileno(), self.size)
+    res = numpy.ndarray(shape=shape, dtype=dtype, buffer=self.mmap, offset=offset)
+    res.fill(0)
+    self.offset = end + (-end) % self.Alignment
+    self.layout[key] = (offset, dtype.str, shape)
+    return res
+
+  def get_arrays(self, layout):
+    """
+    Consumer side.
+
+    :param dict[str,(int,str,tuple[int])] layout: self.layout from the producer
+    :return: read-only arrays which share the memory with the producer
+    :rtype: dict[str,numpy.ndarray]
+    """
+    size = max([offset + int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+                for (offset, dtype, shape) in layout.values()] + [1])
+    m = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+    return {key: numpy.ndarray(shape=shape, dtype=dtype, buffer=m, offset=offset)
+            for (key, (offset, dtype, shape)) in layout.items()}
+
+
+def _multi_process_data_provider_worker_main(async_task):
+  """
+  Main of a worker process of :class:`MultiProcessDataProvider`.
+  This is a new Python process (fork+exec), i.e. it does not share any state (e.g. TF or threads) with the parent.
+  It creates the dataset again, and then fills the batches which the parent hands out.
+
+  :param TaskSystem.AsyncTask async_task:
+  """
+  conn = async_task.conn
+  msg = conn.recv()
+  assert msg[0] == "init"
+  _, dataset_opts, epoch, data_key_infos, slot_filenames = msg
+  from Dataset import init_dataset
+  dataset = init_dataset(dataset_opts)
+  dataset.init_seq_order(epoch=epoch)
+  slots = [SharedMemoryBatchSlot(filename=filename) for filename in slot_filenames]
+  conn.send(("ready",))
+  while True:
+    msg = conn.recv()
+    if msg is None:  # the parent is done
+      break
+    _, batch_idx, batch_desc, slot_idx = msg
+    slot = slots[slot_idx]
+    slot.reset()
+    try:
+      data, seq_lens = _fill_batch_arrays(
+        dataset=dataset, data_key_infos=data_key_infos, batch_desc=batch_desc, buffer_pool=slot)
+    except Exception as exc:
+      sys.excepthook(*sys.exc_info())
+      conn.send(("error", batch_idx, repr(exc)))
+      break
+    for k, v in seq_lens.items():
+      data["%s_seq_lens" % k] = v
+    other_data = {k: v for (k, v) in data.items() if k not in slot.layout}  # e.g. strings
+    conn.send(("batch", batch_idx, slot_idx, slot.layout, other_data))
+  for slot in slots:
+    slot.close()
+
+
+class MultiProcessDataProvider(FeedDictDataProvider):
+  """
+  Like :class:`FeedDictDataProvider`, but the batch construction (loading the seqs via the dataset,
+  filling and padding the batch arrays) is done by `num_workers` worker processes.
+  The parent iterates through the `BatchSetGenerator` as usual (this only needs the seq lengths)
+  and hands out the batch descriptors (see :func:`FeedDictDataProvider._get_batch_descriptor`)
+  round-robin to the workers.
+  The workers write the batch data into shared memory slots (:class:`SharedMemoryBatchSlot`)
+  and the parent collects them in the original batch order, i.e. the result is exactly the same
+  as with :class:`FeedDictDataProvider`.
+
+  The workers are new Python processes (fork+exec, via :class:`TaskSystem.AsyncTask`),
+  thus they don't inherit the TF session or any threads of the parent.
+  Each worker creates the dataset again from its options (:func:`Dataset.init_dataset`)
+  and must get the same seq order for the epoch.
+  The dataset must know its seq lengths without loading the seqs, thus :class:`CachedDataset2` is not supported.
+  Also not supported is the prefetching of :class:`CachedDataset` (each worker would prefetch all the seqs)
+  and :class:`ExternSprintDataset` (each worker would start Sprint, which determines the seq order itself).
+  """
+
+  def __init__(self, num_workers, capacity=10, **kwargs):
+    """
+    :param int num_workers:
+    :param int capacity:
+    """
+    super(MultiProcessDataProvider, self).__init__(capacity=capacity, **kwargs)
+    assert num_workers > 0
+    assert not self.tf_queue
+    self._check_dataset(self.dataset)
+    self.num_workers = num_workers
+    # Up to `capacity` batches in the queue, the one in the collector thread, the one used by the consumer.
+    # On top, each worker can already work on its next batch.
+    self.num_slots_per_worker = (capacity + 2) // num_workers + 2
+    self.workers = None  # type: list[TaskSystem.AsyncTask]
+    self.slots = None  # type: list[list[SharedMemoryBatchSlot]]
+    self.free_slots = None  # type: list[list[int]]  # per worker. protected by self.state_change_cond
+    self.queued_slots = []  # type: list[(int,int)]  # (worker_idx, slot_idx) for the batches in self.queue
+    self.consumer_slot = None  # type: (int,int)|None  # (worker_idx, slot_idx) of the batch used by the consumer
+
+  @classmethod
+  def _check_dataset(cls, dataset):
+    """
+    :param Dataset dataset:
+    """
+    from CachedDataset import CachedDataset
+    from CachedDataset2 import CachedDataset2
+    from SprintDataset import ExternSprintDataset
+    if isinstance(dataset, CachedDataset2):
+      raise Exception(
+        "%s: data_provider_num_workers does not support CachedDataset2, "
+        "as the seq lengths are only known after loading the seqs" % dataset)
+    if isinstance(dataset, CachedDataset) and dataset.prefetch_byte_size > 0:
+      raise Exception(
+        "%s: data_provider_num_workers does not support prefetch_byte_size, "
+        "as every worker would prefetch all the seqs" % dataset)
+    if isinstance(dataset, ExternSprintDataset):
+      raise Exception(
+        "%s: data_provider_num_workers does not support ExternSprintDataset, "
+        "as Sprint determines the seq order" % dataset)
+    if not dataset.init_dataset_opts:
+      raise Exception(
+        "%s: data_provider_num_workers needs the dataset options to create it again in the workers, "
+        "i.e. the dataset must be created via Dataset.init_dataset(), e.g. with a dict in the config" % dataset)
+
+  def start_threads(self):
+    from TaskSystem import AsyncTask
+    self.slots = [[SharedMemoryBatchSlot() for _ in range(self.num_slots_per_worker)]
+                  for _ in range(self.num_workers)]
+    self.free_slots = [list(range(self.num_slots_per_worker)) for _ in range(self.num_workers)]
+    self.workers = []
+    for worker_idx in range(self.num_workers):
+      worker = AsyncTask(
+        func=_multi_process_data_provider_worker_main,
+        name="DataProvider worker %i" % worker_idx, mustExec=True)
+      worker.conn.send((
+        "init", self.dataset.init_dataset_opts, self.dataset.epoch, self._get_data_key_infos(),
+        [slot.filename for slot in self.slots[worker_idx]]))
+      self.workers.append(worker)
+    for worker_idx, worker in enumerate(self.workers):
+      msg = self._recv_from_worker(worker_idx)
+      assert msg == ("ready",), "DataProvider worker %i: unexpected init reply %r" % (worker_idx, msg)
+      for slot in self.slots[worker_idx]:
+        slot.unlink()  # both sides have it open now
+    print("DataProvider: started %i worker processes" % self.num_workers, file=log.v4)
+    super(MultiProcessDataProvider, self).start_threads()
+
+  def stop_threads(self):
+    if not self.thread:
+      return
+    from TaskSystem import ProcConnectionDied
+    super(MultiProcessDataProvider, self).stop_threads()
+    for worker in self.workers:
+      try:
+        worker.conn.send(None)
+      except ProcConnectionDied:
+        pass  # already gone
+    for worker in self.workers:
+      worker.join()
+      worker.conn.close()
+    for slots in self.slots:
+      for slot in slots:
+        slot.close()
+
+  def _recv_from_worker(self, worker_idx):
+    """
+    :param int worker_idx:
+    :return: the next message of the worker, or None if we should stop
+    :rtype: tuple|None
+    """
+    conn = self.workers[worker_idx].conn
+    while not conn.poll(0.1):
+      if self.coord.should_stop():
+        return None
+      if not self.workers[worker_idx].is_alive() and not conn.poll():
+        raise Exception("DataProvider worker %i died unexpectedly" % worker_idx)
+    msg = conn.recv()
+    if msg[0] == "error":
+      raise Exception("Exception in DataProvider worker %i, batch %i: %s" % ((worker_idx,) + msg[1:]))
+    return msg
+
+  def thread_main(self):
+    """
+    The collector thread. Hands out the batches to the workers,
+    and receives them in the original order from the workers and puts them into the queue.
+    """
+    try:
+      import better_exchook
+      better_exchook.install()
+
+      pending = []  # type: list[(int,int,int)]  # (batch_idx, worker_idx, slot_idx), handed out, in batch order
+      batch_idx = 0
+      while not self.coord.should_stop():
+        # Hand out the next batches, as long as the next worker (round-robin) has a free slot.
+        while self.batches.has_more():
+          worker_idx = batch_idx % self.num_workers
+          with self.state_change_cond:
+            if not self.free_slots[worker_idx]:
+              break
+            slot_idx = self.free_slots[worker_idx].pop(0)
+          batch, = self.batches.peek_next_n(1)
+          self.workers[worker_idx].conn.send(("batch", batch_idx, self._get_batch_descriptor(batch), slot_idx))
+          self.batches.advance(1)
+          pending.append((batch_idx, worker_idx, slot_idx))
+          batch_idx += 1
+        if not pending:
+          if not self.batches.has_more():
+            break
+          # All slots of the next worker are in the queue or used by the consumer.
+          with self.state_change_cond:
+            self.state_change_cond.wait(0.1)
+          continue
+        next_batch_idx, worker_idx, slot_idx = pending.pop(0)
+        msg = self._recv_from_worker(worker_idx)
+        if msg is None:
+          break
+        _, worker_batch_idx, worker_slot_idx, layout, data = msg
+        assert (worker_batch_idx, worker_slot_idx) == (next_batch_idx, slot_idx)
+        data.update(self.slots[worker_idx][slot_idx].get_arrays(layout))
+        with self.state_change_cond:
+          self.queued_slots.append((worker_idx, slot_idx))
+        self.queue.put(data)
+        with self.state_change_cond:
+          self.state_change_cond.notifyAll()
+
+      self.reached_end = not self.batches.has_more() and not pending
+
+    except Exception as exc:
+      print("Exception in DataProvider thread: %r" % exc, file=log.v1)
+      sys.excepthook(*sys.exc_info())
+
+    finally:
+      with self.state_change_cond:
+        self.thread_finished = True
+        self.state_change_cond.notifyAll()
+
+  def get_feed_dict(self, single_threaded=False):
+    """
+    :param bool single_threaded: whether to not use the worker processes
+    :rtype: dict[tf.Tensor,numpy.ndarray]
+    """
+    if single_threaded:
+      return super(MultiProcessDataProvider, self).get_feed_dict(single_threaded=True)
+    with self.state_change_cond:
+      if self.consumer_slot:
+        # The consumer is done with the last batch (it was fed to TF, which makes a copy), so the slot can be reused.
+        worker_idx, slot_idx = self.consumer_slot
+        self.free_slots[worker_idx].append(slot_idx)
+        self.consumer_slot = None
+        self.state_change_cond.notifyAll()
+    feed_dict = super(MultiProcessDataProvider, self).get_feed_dict()
+    with self.state_change_cond:
+      self.consumer_slot = self.queued_slots.pop(0)
+    return feed_dict
+
+
+class StagingDataProvider(FeedDictDataProvider):
+  """
+  Like :class:`FeedDictDataProvider`, i.e. the batches are constructed in a background thread,
+  but that thread also puts them into a :class:`CpuToDefaultDevStage`, i.e. a TF StagingArea
+  which lives on the default device (e.g. the GPU).
+  The network gets its data from the staging area, see :func:`TFEngine.Engine._init_network`,
+  thus the feeding and the CPU->GPU copy of the next batches overlaps with the session run of the current batch.
+  Data which cannot be staged (e.g. strings) is fed as usual in :func:`get_feed_dict`.
+
+  This is experimental. Every session.run() which depends on the network inputs gets one batch
+  from the staging area, thus it must use the feed dict from :func:`get_feed_dict` for that batch.
+  This also includes extra runs, e.g. for summaries or an eval-only run.
+  Any other run would take a staged batch which belongs to another run,
+  thus it fails instead, because it does not feed the expected batch id (see :class:`CpuToDefaultDevStage`).
+  With get_feed_dict(single_threaded=True), the network inputs are fed directly,
+  and the staging area is not touched.
+  """
+
+  def __init__(self, stage, capacity=2, **kwargs):
+    """
+    :param CpuToDefaultDevStage stage: stage.output_as_extern_data should be our extern_data
+    :param int capacity: how much batches we stage at most. we don't rely on the capacity of the staging area,
+      because a blocking put would block a thread of the TF session thread pool, which can starve the session
+    """
+    super(StagingDataProvider, self).__init__(capacity=capacity, **kwargs)
+    assert not self.tf_queue
+    assert capacity > 0
+    self.capacity = capacity
+    assert stage.input_placeholders, "need the stage with placeholders as input"
+    self.stage = stage
+    self.direct_feed_keys = [key for key in self.data_keys if key not in stage.data_keys]
+    self.staged_feed_dicts = []  # type: list[dict[tf.Tensor,numpy.ndarray]]  # for each staged batch, direct feed
+    self._next_batch_id = 0
+
+  def _get_stage_input(self, output, n_batch):
+    """
+    :param dict[str,numpy.ndarray] output: from self.get_next_batch()
+    :param int n_batch:
+    :return: stage input names -> values. data keys which we don't use get some dummy empty data
+    :rtype: dict[str,numpy.ndarray]
+    """
+    d = {}
+    for key in self.stage.data_keys:
+      data = self.extern_data.data[key]
+      axes_with_size = data.get_axes_with_size()
+      if key not in output:
+        d[key] = numpy.zeros(
+          [n_batch if axis == data.batch_dim_axis else (dim or 0) for (axis, dim) in enumerate(data.batch_shape)],
+          dtype=data.dtype)
+        for axis in axes_with_size:
+          d["%s/size%i" % (key, axis)] = numpy.zeros((n_batch,), dtype=data.size_dtype)
+        continue
+      d[key] = output[key]
+      for axis in axes_with_size:
+        if axis != 0:  # time-dim
+          raise Exception(
+            "dataset currently does not support variable shape in other dimensions than the first. "
+            "dim=%i, key=%r" % (axis, key))
+        d["%s/size%i" % (key, axis)] = output["%s_seq_lens" % key]
+    return d
+
+  def thread_main(self):
+    try:
+      import better_exchook
+      better_exchook.install()
+
+      while self.batches.has_more() and not self.coord.should_stop():
+        batch, = self.batches.peek_next_n(1)
+        output = self.get_next_batch()
+        stage_input = self._get_stage_input(output, n_batch=batch.num_slices)
+        with self.state_change_cond:
+          # Wait until the consumer took some batch from the staging area.
+          while len(self.staged_feed_dicts) >= self.capacity and not self.coord.should_stop():
+            self.state_change_cond.wait()
+        if self.coord.should_stop():
+          break
+        batch_id = self._next_batch_id
+        self._next_batch_id += 1
+        put_feed_dict = self.stage.input_placeholders.feed_dict(stage_input)
+        put_feed_dict[self.stage.batch_id_placeholder] = batch_id
+        self.tf_session.run(self.stage.stage_put_op, feed_dict=put_feed_dict)
+        feed_dict = self.get_feed_dict_for_output(output, data_keys=self.direct_feed_keys)
+        feed_dict[self.stage.expected_batch_id_placeholder] = batch_id
+        with self.state_change_cond:
+          self.staged_feed_dicts.append(feed_dict)
+          self.state_change_cond.notifyAll()
+        self.batches.advance(1)
+
+      self.reached_end = not self.batches.has_more()
+
+    except Exception as exc:
+      print("Exception in DataProvider thread: %r" % exc, file=log.v1)
+      sys.excepthook(*sys.exc_info())
+
+    finally:
+      with self.state_change_cond:
+        self.thread_finished = True
+        self.state_change_cond.notifyAll()
+
+  def stop_threads(self):
+    if not self.thread:
+      return
+    self.coord.request_stop()
+    with self.state_change_cond:
+      self.state_change_cond.notifyAll()
+    self.thread.join()
+    # Don't leave anything for the next epoch or dataset.
+    self.tf_session.run(self.stage.stage_clear_op)
+    self.staged_feed_dicts = []
+
+  def have_more_data(self, session):
+    """
+    :return: whether there is another staged batch, i.e. the next session.run() can get it from the staging area
+    :rtype: bool
+    """
+    with self.state_change_cond:
+      while True:
+        if self.staged_feed_dicts:
+          return True
+        if self.thread_finished:
+          return False
+        if not self.thread.is_alive():
+          return False
+        self.state_change_cond.wait()
+
+  def get_feed_dict(self, single_threaded=False):
+    """
+    :param bool single_threaded: whether to not use the staging area. then we feed the stage output directly
+    :return: the data which is not staged, for the batch which the next session.run() gets from the staging area
+    :rtype: dict[tf.Tensor,numpy.ndarray]
+    """
+    if single_threaded:
+      return super(StagingDataProvider, self).get_feed_dict(single_threaded=True)
+    with self.state_change_cond:
+      assert self.staged_feed_dicts, "call have_more_data() first"
+      feed_dict = self.staged_feed_dicts.pop(0)
+      self.state_change_cond.notifyAll()
+      return feed_dict
+
+
 class QueueDataProvider(DataProviderBase):
   """
   This class is supposed to encapsulate all the logic of this module and to be used by the TF engine.
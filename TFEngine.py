@@ -51,12 +51,21 @@ class Runner(object):
       It might also be useful to add `network.get_extern_data("seq_idx")` and `network.get_extern_data("seq_tag")`.
     :param (**dict[str,numpy.ndarray|str|list[numpy.ndarray|str])->None extra_fetches_callback: called if extra_fetches
     """
-    from TFDataPipeline import FeedDictDataProvider, DataProviderBase
+    from TFDataPipeline import FeedDictDataProvider, MultiProcessDataProvider, StagingDataProvider, DataProviderBase
     self.engine = engine
-    self.data_provider = FeedDictDataProvider(
+    data_provider_kwargs = dict(
       tf_session=engine.tf_session, extern_data=engine.network.extern_data,
       data_keys=engine.network.used_data_keys,
       dataset=dataset, batches=batches)
+    num_workers = engine.config.int("data_provider_num_workers", 0)
+    if engine.data_stage:
+      self.data_provider = StagingDataProvider(
+        stage=engine.data_stage, capacity=engine.config.int("data_provider_staging_capacity", 2),
+        **data_provider_kwargs)
+    elif num_workers > 0:
+      self.data_provider = MultiProcessDataProvider(num_workers=num_workers, **data_provider_kwargs)
+    else:
+      self.data_provider = FeedDictDataProvider(**data_provider_kwargs)
     assert isinstance(self.data_provider, DataProviderBase)
     self._should_train = train
     self._should_eval = eval
@@ -407,6 +416,263 @@ class Runner(object):
       self.elapsed = time.time() - self.start_time
 
 
+class SearchOutputWriter(object):
+  """
+  Handles the outputs of :func:`Engine.search`: logs the hypotheses and optionally writes them to a file.
+  The serialization and writing happens in a background thread (with background=True),
+  such that it overlaps with the next batch of the search.
+
+  Output file formats:
+    "txt": the best hypothesis per line, serialized via the dataset
+    "jsonl": one JSON object per line and seq, with "seq_idx", "seq_tag" and "hyps",
+      which is the N-best list of {"output": ..., "score": ...}, where output is serialized via the dataset
+      if possible or otherwise the list of label indices, and score is the log score, if we have it.
+  """
+
+  def __init__(self, dataset, target_key, beam_size=None, output_file=None, output_format="txt", nbest=None,
+               bytes_output=False, background=True):
+    """
+    :param Dataset dataset: used to serialize the data
+    :param str target_key: e.g. "classes"
+    :param int|None beam_size: of the output, or None if it is after decision
+    :param str|None output_file:
+    :param str output_format: "txt" or "jsonl"
+    :param int|None nbest: for "jsonl", write the best N hyps. by default all in the beam
+    :param bool bytes_output: interpret the output as bytes/utf8-string
+    :param bool background: serialize and write in a background thread
+    """
+    assert output_format in ["txt", "jsonl"]
+    self.dataset = dataset
+    self.target_key = target_key
+    self.beam_size = beam_size
+    self.output_format = output_format
+    self.nbest = nbest or beam_size or 1
+    self.bytes_output = bytes_output
+    self.can_serialize = bool(target_key) and dataset.can_serialize_data(target_key)
+    self.output_file = None
+    if output_file:
+      if output_format == "txt":
+        assert self.can_serialize
+      assert not os.path.exists(output_file)
+      print("Will write outputs to: %s" % output_file, file=log.v2)
+      self.output_file = open(output_file, "wb")
+    self.num_seqs = 0
+    self._thread = None
+    self._queue = None
+    self._exc_info = None
+    if background:
+      from threading import Thread
+      self._queue = Queue(maxsize=10)  # num of batches. the search blocks if we cannot keep up
+      self._thread = Thread(target=self._thread_main, name="SearchOutputWriter")
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _thread_main(self):
+    import better_exchook
+    better_exchook.install()
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+      if self._exc_info:
+        continue  # still consume the queue, such that the search does not block
+      try:
+        self._write_batch(**item)
+      except Exception:
+        self._exc_info = sys.exc_info()
+
+  def _check_exception(self):
+    if self._exc_info:
+      exc_info, self._exc_info = self._exc_info, None
+      sys.excepthook(*exc_info)  # the original traceback would get lost otherwise
+      raise exc_info[1]
+
+  def add_batch(self, seq_idx, seq_tag, output, targets=None, beam_scores=None):
+    """
+    :param list[int] seq_idx: of length batch (without beam)
+    :param list[str] seq_tag: of length batch (without beam)
+    :param list[numpy.ndarray] output: of length batch (with beam)
+    :param list[numpy.ndarray]|None targets: of length batch (without beam)
+    :param numpy.ndarray|None beam_scores: shape (batch, beam), log scores
+    """
+    n_batch = len(seq_idx)  # without beam
+    assert n_batch == len(seq_tag)
+    assert n_batch * (self.beam_size or 1) == len(output)
+    if beam_scores is not None:
+      assert beam_scores.shape == (n_batch, self.beam_size or 1)
+    item = dict(seq_idx=seq_idx, seq_tag=seq_tag, output=output, targets=targets, beam_scores=beam_scores)
+    if self._thread:
+      self._check_exception()
+      self._queue.put(item)
+    else:
+      self._write_batch(**item)
+
+  def _serialize(self, data):
+    """
+    :param numpy.ndarray|str data:
+    :rtype: str|list[int]
+    """
+    if self.bytes_output:
+      return data
+    if self.can_serialize:
+      return self.dataset.serialize_data(key=self.target_key, data=data)
+    return data.tolist()
+
+  def _write_batch(self, seq_idx, seq_tag, output, targets=None, beam_scores=None):
+    """
+    See :func:`add_batch`.
+    """
+    import json
+    beam_size = self.beam_size or 1
+    if self.bytes_output:
+      output = [bytearray(o).decode("utf8") for o in output]
+    for i in range(len(seq_idx)):
+      out_idx = i * beam_size
+      if self.beam_size is None:
+        print("seq_idx: %i, seq_tag: %r, output: %r" % (seq_idx[i], seq_tag[i], output[i]), file=log.v1)
+      else:
+        print("seq_idx: %i, seq_tag: %r, outputs: %r" % (
+          seq_idx[i], seq_tag[i], output[out_idx:out_idx + beam_size]), file=log.v1)
+      if self.can_serialize and not self.bytes_output:
+        print("  hyp:", self.dataset.serialize_data(key=self.target_key, data=output[out_idx]), file=log.v1)
+        if targets is not None:
+          print("  ref:", self.dataset.serialize_data(key=self.target_key, data=targets[i]), file=log.v1)
+      if not self.output_file:
+        continue
+      if self.output_format == "txt":
+        self._write_line(self.dataset.serialize_data(key=self.target_key, data=output[out_idx]))
+      else:
+        hyps = []
+        for j in range(min(self.nbest, beam_size)):
+          hyp = {"output": self._serialize(output[out_idx + j])}
+          if beam_scores is not None:
+            hyp["score"] = float(beam_scores[i, j])
+          hyps.append(hyp)
+        tag = seq_tag[i].decode("utf8") if isinstance(seq_tag[i], bytes) else seq_tag[i]
+        self._write_line(json.dumps({"seq_idx": int(seq_idx[i]), "seq_tag": tag, "hyps": hyps}))
+      self.num_seqs += 1
+
+  def _write_line(self, line):
+    """
+    :param str|unicode|bytes line: without the newline. written utf8 encoded
+    """
+    if not isinstance(line, bytes):
+      line = line.encode("utf8")
+    self.output_file.write(line + b"\n")
+
+  def close(self):
+    """
+    Waits until everything is written, and closes the output file.
+    """
+    if self._thread:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+      self._check_exception()
+    if self.output_file:
+      self.output_file.close()
+      self.output_file = None
+
+
+class SeqOrderReassembler(object):
+  """
+  Passes on per-seq outputs in the original order of the seqs (i.e. by seq_idx, the order of the epoch),
+  when the seqs were processed in another order within windows of the seq idx,
+  e.g. via the length-sorted batches of :func:`Dataset.generate_batches` with sort_window.
+  The outputs of the current window are kept until the next window starts, or until :func:`flush`.
+  """
+
+  def __init__(self, callback, window):
+    """
+    :param (object)->None callback: called with each item, in the order of the seq idx
+    :param int window: number of seqs, like sort_window
+    """
+    assert window > 0
+    self.callback = callback
+    self.window = window
+    self._window_idx = 0
+    self._pending = {}  # type: dict[int,object]  # seq_idx -> item
+
+  def add(self, seq_idx, item):
+    """
+    :param int seq_idx:
+    :param object item:
+    """
+    window_idx = seq_idx // self.window
+    assert window_idx >= self._window_idx, "%s: seq idx %i from a finished window" % (self, seq_idx)
+    if window_idx > self._window_idx:
+      self.flush()
+      self._window_idx = window_idx
+    self._pending[seq_idx] = item
+
+  def flush(self):
+    """
+    Passes on all pending items. Call this in the end.
+    Seqs can be missing (e.g. filtered via max_seq_length), thus we just use the order of the ones we have.
+    """
+    for seq_idx in sorted(self._pending.keys()):
+      self.callback(self._pending[seq_idx])
+    self._pending.clear()
+
+
+class NetworkCacheEntry(object):
+  """
+  A constructed network together with its own graph and session and the related engine state,
+  such that the engine can switch between multiple networks without constructing them again.
+  See :func:`Engine._init_network`.
+  """
+
+  def __init__(self, key):
+    """
+    :param str key: see :func:`Engine._get_network_cache_key`
+    """
+    self.key = key
+    self.graph = None  # type: tf.Graph
+    self.state = None  # type: dict[str]
+
+  # These are the engine attributes which belong to the network.
+  EngineAttribs = [
+    "tf_session", "network", "updater", "data_stage",
+    "_checked_uninitialized_vars", "_merge_all_summaries", "_const_cache"]
+
+  def save(self, engine):
+    """
+    Takes over the current network of the engine. The engine does not have a network afterwards.
+
+    :param Engine engine:
+    """
+    self.graph = engine.tf_session.graph
+    self.state = {attr: getattr(engine, attr) for attr in self.EngineAttribs}
+    engine.tf_session = None
+    engine.network = None
+    engine.updater = None
+    engine.data_stage = None
+    engine._checked_uninitialized_vars = False
+    engine._merge_all_summaries = None
+    engine._const_cache = {}
+
+  def restore(self, engine):
+    """
+    Makes this the current network of the engine, and its graph the default graph.
+
+    :param Engine engine:
+    """
+    from TFUtil import set_global_default_graph
+    set_global_default_graph(self.graph)
+    for attr, value in self.state.items():
+      setattr(engine, attr, value)
+    self.state = None
+
+  def close(self):
+    """
+    Closes the session. This frees the memory of the variables.
+    """
+    if self.state and self.state["tf_session"]:
+      self.state["tf_session"].close()
+    self.graph = None
+    self.state = None
+
+
 class Engine(object):
   def __init__(self, config=None):
     """
@@ -421,6 +687,7 @@ class Engine(object):
     self.tf_session = None  # type: tf.Session
     self.network = None  # type: TFNetwork
     self.updater = None  # type: Updater
+    self.data_stage = None  # type: TFDataPipeline.CpuToDefaultDevStage|None
     self._checked_uninitialized_vars = False
     self._merge_all_summaries = None
     self.dataset_batches = {}  # type: dict[str,BatchSetGenerator]
@@ -430,12 +697,21 @@ class Engine(object):
     self.use_search_flag = config.value("task", None) == "search"
     self.use_eval_flag = config.value("task", None) != "forward"
     self._const_cache = {}  # type: dict[str,tf.Tensor]
+    # Constructed networks, which are not the current one, see self._init_network().
+    self._network_cache_size = config.int("tf_network_cache_size", 0)
+    if self._network_cache_size:
+      from TFUtil import check_set_global_default_graph_supported
+      check_set_global_default_graph_supported()  # fail early. we need it to switch the graph, see _init_network
+    self._network_cache = []  # type: list[NetworkCacheEntry]  # least recently used first
+    self._network_cache_key = None  # type: str|None  # of the current network
 
   def finalize(self):
+    self._clear_network_cache()
     self._close_tf_session()
     tf.reset_default_graph()
     self.network = None
     self.updater = None
+    self.data_stage = None
     self._merge_all_summaries = None
 
   def get_const_tensor(self, key, value):
@@ -564,6 +840,7 @@ class Engine(object):
     self.start_epoch, self.start_batch = self.get_train_start_epoch_batch(config)
     self.batch_size = config.int('batch_size', 1)
     self.shuffle_batches = config.bool('shuffle_batches', True)
+    self.bucket_boundaries = config.int_list('bucket_boundaries', None)
     self.update_batch_size = config.int('update_batch_size', 0)
     self.save_model_epoch_interval = config.int('save_interval', 1)
     self.save_epoch1_initial_model = config.bool('save_epoch1_initial_model', False)
@@ -623,9 +900,87 @@ class Engine(object):
         print("Exiting now because model cannot be loaded.", file=log.v1)
         sys.exit(1)
 
+  def _get_network_cache_key(self, net_desc):
+    """
+    :param dict[str,dict[str]] net_desc:
+    :return: hash of the net dict and everything else which influences the network construction
+    :rtype: str
+    """
+    import hashlib
+    from pprint import pformat  # sorts the dict keys
+    return "%s-train_flag_%s-eval_%s-search_%s-updater_%s" % (
+      hashlib.md5(pformat(net_desc).encode("utf8")).hexdigest(),
+      self.use_dynamic_train_flag, self.use_eval_flag, self.use_search_flag, bool(self.train_data))
+
+  def _maybe_cache_current_network(self):
+    """
+    If we use the network cache (option "tf_network_cache_size", the max number of cached networks,
+    excluding the current one), moves the current network into the cache (instead of closing it),
+    and removes the least recently used networks if the cache is full.
+    """
+    if not self._network_cache_size or not self.network or not self._network_cache_key:
+      return
+    entry = NetworkCacheEntry(key=self._network_cache_key)
+    entry.save(self)
+    self._network_cache.append(entry)
+    self._network_cache_key = None
+    while len(self._network_cache) > self._network_cache_size:
+      print("Remove network %s from cache." % self._network_cache[0].key, file=log.v4)
+      self._network_cache.pop(0).close()
+
+  def _pop_network_cache_entry(self, key):
+    """
+    :param str key: via self._get_network_cache_key()
+    :rtype: NetworkCacheEntry|None
+    """
+    for i, entry in enumerate(self._network_cache):
+      if entry.key == key:
+        return self._network_cache.pop(i)
+    return None
+
+  def _restore_network_from_cache(self, entry):
+    """
+    :param NetworkCacheEntry entry: via self._pop_network_cache_entry(). will become the current network
+    """
+    assert not self.network
+    print("Reuse network %s from cache." % entry.key, file=log.v3)
+    entry.restore(self)
+    self._network_cache_key = entry.key
+    # Behave like a new network, see self._init_network().
+    self.network.initialize_params(session=self.tf_session)
+    if self.updater and self.updater.optimizer_init_vars_op is not None:
+      self.updater.init_optimizer_vars()
+
+  def _clear_network_cache(self):
+    for entry in self._network_cache:
+      entry.close()
+    self._network_cache = []
+
   def _init_network(self, net_desc, epoch=None):
+    """
+    Constructs the network in a new graph and session, and initializes the params randomly.
+    With the option "tf_network_cache_size" (number of networks),
+    the previous networks (e.g. of earlier pretrain stages, or without the search flag) are kept
+    together with their graph and session, and if we need one of those again,
+    we just switch to it and reinit its params (and the optimizer vars), instead of constructing it again.
+    The params are then loaded or copied (as TFNetworkParamsSerialized) by the caller, as for a new network.
+    Note that a reused network keeps the rnd_seed of the epoch when it was constructed.
+
+    :param dict[str,dict[str]] net_desc:
+    :param int|None epoch:
+    """
     if epoch is None:
       epoch = self.epoch
+    network_cache_key = None
+    if self._network_cache_size:
+      network_cache_key = self._get_network_cache_key(net_desc)
+      entry = self._pop_network_cache_entry(network_cache_key)
+      self._maybe_cache_current_network()
+      if not entry:  # maybe it is the current network
+        entry = self._pop_network_cache_entry(network_cache_key)
+      if entry:
+        self._restore_network_from_cache(entry)
+        return
     self._close_tf_session()
     self._reset_graph()
     # The new session will by default use the newly created default graph.
@@ -636,13 +991,22 @@ class Engine(object):
       train_flag = get_global_train_flag_placeholder()
     else:
       train_flag = False
-    if False:  # TODO ...
+    extern_data = None  # by default, TFNetwork inits it from the config
+    self.data_stage = None
+    if self.config.value("data_provider", "feed_dict") == "staging":
+      from TFDataPipeline import CpuToDefaultDevStage
       extern_data = ExternData()
       extern_data.init_from_config(self.config)
-      # TODO...
+      # The network gets its data from the staging area, which is filled by the StagingDataProvider.
+      # Strings cannot be on the GPU. These are fed directly.
+      self.data_stage = CpuToDefaultDevStage(
+        extern_data=extern_data,
+        data_keys=[key for (key, data) in sorted(extern_data.data.items()) if data.dtype != "string"])
+      extern_data = self.data_stage.output_as_extern_data
     network = TFNetwork(
       name="root",
       config=self.config,
+      extern_data=extern_data,
       rnd_seed=epoch,
       train_flag=train_flag,
       eval_flag=self.use_eval_flag,
@@ -656,6 +1020,7 @@ class Engine(object):
       self.updater = Updater(config=self.config, tf_session=self.tf_session, network=network)
       self.updater.set_trainable_vars(network.get_trainable_params())
     network.print_network_info()
+    self._network_cache_key = network_cache_key
 
   def maybe_init_new_network(self, net_desc):
     if self.network.layers_desc == net_desc:
@@ -815,7 +1180,8 @@ class Engine(object):
                                                                        max_seq_length=int(self.max_seq_length),
                                                                        seq_drop=self.seq_drop,
                                                                        shuffle_batches=self.shuffle_batches,
-                                                                       used_data_keys=self.network.used_data_keys)
+                                                                       used_data_keys=self.network.used_data_keys,
+                                                                       bucket_boundaries=self.bucket_boundaries)
     else:
       self.dataset_batches['train'].reset()
     train_batches = self.dataset_batches['train']
@@ -823,6 +1189,7 @@ class Engine(object):
     self.updater.set_learning_rate(self.learning_rate)
     trainer = Runner(engine=self, dataset=self.train_data, batches=train_batches, train=True)
     trainer.run(report_prefix=("pre" if self.is_pretrain_epoch() else "") + "train epoch %s" % self.epoch)
+    print("%s padding ratio: %.3f" % (self.get_epoch_str(), train_batches.get_padding_ratio()), file=log.v4)
 
     if not trainer.finalized:
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
@@ -983,6 +1350,38 @@ class Engine(object):
     assert output_value.shape[1] == 1  # batch-dim
     return output_value[:, 0]  # remove batch-dim
 
+  def _get_inference_sort_window(self, dataset):
+    """
+    With the config option "inference_sort_window" (number of seqs),
+    forwarding, search and analyze sort the seqs by length within windows of that many seqs,
+    to reduce the padding. The outputs are written in the original order.
+    See :func:`Dataset.generate_batches`.
+    The seqs of a batch are not consecutive then, thus this needs a fully cached dataset,
+    e.g. HDFDataset with cache_byte_size=-1.
+
+    :param Dataset.Dataset dataset:
+    :rtype: int|None
+    """
+    if not self.network.recurrent:
+      return None  # seqs are concatenated anyway
+    sort_window = self.config.int("inference_sort_window", 0) or None
+    if sort_window and not dataset.is_fully_cached():
+      raise Exception(
+        "inference_sort_window needs a fully cached dataset (e.g. HDFDataset with cache_byte_size=-1), got %r" % (
+          dataset,))
+    return sort_window
+
+  def _print_inference_stats(self, name, runner, batches):
+    """
+    :param str name: e.g. "Search"
+    :param Runner runner:
+    :param BatchSetGenerator batches:
+    """
+    num_seqs = batches.num_seqs_advanced
+    print("%s: %i seqs in %s, %.2f seqs/sec, padding ratio %.3f." % (
+      name, num_seqs, hms(runner.elapsed), num_seqs / max(runner.elapsed, 1e-8), batches.get_padding_ratio()),
+      file=log.v2)
+
   def forward_to_hdf(self, data, output_file, combine_labels='', batch_size=0):
     """
     Is aiming at recreating the same interface and output as :func:`Engine.forward_to_hdf`.
@@ -993,88 +1392,78 @@ class Engine(object):
     :param str combine_labels: ignored at the moment
     :param int batch_size:
     """
-    import h5py
-    from Util import hdf5_strings
+    from HDFDataset import BufferedHDFWriter
 
     output_layer = self._get_output_layer()
     target = self.network.get_default_target()
-
-    cache = h5py.File(output_file, "w")
-    cache.attrs['numTimesteps'] = 0
-    cache.attrs['inputPattSize'] = data.num_inputs
-    cache.attrs['numDims'] = 1
-    cache.attrs['numLabels'] = data.num_outputs[target]
-    cache.attrs['numSeqs'] = 0
-    if target in data.labels:
-      hdf5_strings(cache, 'labels', data.labels[target])
-    else:
-      cache.create_dataset('labels', (0,), dtype="S5")
-
-    datasets = {}  # type: dict[str,h5py.Dataset]
-    tags = []  # type: list[str]
-    seq_lengths = cache.create_dataset("seqLengths", (0,2), dtype='i', maxshape=(None,2))
-
-    def insert_h5_inputs(name, raw_data):
-      """
-      Inserts a record into the hdf5-file.
-      Resizes if necessary.
-
-      :param str name:
-      :param numpy.ndarray raw_data: shape=(time,data)
-      """
-      assert len(raw_data.shape) == 2
-      if name not in datasets:
-        datasets[name] = cache.create_dataset(name, raw_data.shape, raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape))
-      else:
-        old_shape = datasets[name].shape
-        datasets[name].resize((old_shape[0] + raw_data.shape[0],) + old_shape[1:])
-      # append raw data to dataset
-      datasets[name][cache.attrs['numTimesteps']:, 0:] = raw_data
-      cache.attrs['numTimesteps'] += raw_data.shape[0]
-      cache.attrs['numSeqs'] += 1
-
-    def extra_fetches_cb(inputs, seq_len, seq_tag):
+    sort_window = self._get_inference_sort_window(data)
+    shard_opts = {}
+    if self.config.has("forward_shard_index"):  # see rnn.forwardSharded()
+      shard_opts = {
+        "shard_index": self.config.int("forward_shard_index", 0),
+        "num_shards": self.config.int("forward_num_shards", 1)}
+      print("Forward shard %i of %i." % (shard_opts["shard_index"], shard_opts["num_shards"]), file=log.v3)
+
+    writer = BufferedHDFWriter(
+      filename=output_file, dim=output_layer.output.dim,
+      input_patt_size=data.num_inputs, num_labels=data.num_outputs[target],
+      labels=data.labels.get(target),
+      block_num_frames=self.config.int("forward_hdf_block_num_frames", 100000),
+      compression=self.config.value("forward_hdf_compression", None),
+      background=self.config.bool("forward_hdf_background_writer", True),
+      with_seq_idx=bool(shard_opts))  # such that the shards can be merged in the original order
+
+    reassembler = None
+    if sort_window:
+      reassembler = SeqOrderReassembler(
+        callback=lambda item: writer.insert_batch(
+          inputs=item[0][None], seq_len=[item[0].shape[0]], seq_tag=[item[1]],
+          seq_idx=[item[2]] if shard_opts else None),
+        window=sort_window)
+
+    def extra_fetches_cb(inputs, seq_len, seq_tag, seq_idx=None):
       """
       Insert each batch into the output_file (hdf).
+      The writer buffers it and writes it in the background, while we run the next batch.
 
       :param numpy.ndarray inputs: shape=(n_batch,time,data)
       :param list[int] seq_len: sequence lengths
       :param list[str] seq_tag: sequence tags of length n_batch
+      :param list[int]|None seq_idx: with sort_window, to restore the original order, and with shards
       """
-      n_batch = len(seq_len)
-      assert n_batch == len(seq_tag)
-      assert n_batch == inputs.shape[0]
-
-      seqlen_offset = seq_lengths.shape[0]
-      seq_lengths.resize(seqlen_offset + n_batch, axis=0)
-      for i in range(n_batch):
-        tags.append(seq_tag[i])
-        seq_lengths[seqlen_offset + i] = seq_len[i]
-        insert_h5_inputs('inputs', inputs[i][:seq_len[i]])
-
+      if reassembler:
+        for i in range(len(seq_idx)):
+          reassembler.add(seq_idx[i], (inputs[i, :seq_len[i]], seq_tag[i], seq_idx[i]))
+      else:
+        writer.insert_batch(
+          inputs=inputs, seq_len=seq_len, seq_tag=seq_tag, seq_idx=seq_idx if shard_opts else None)
+
+    extra_fetches = {
+      'inputs': output_layer.output.get_placeholder_as_batch_major(),
+      "seq_len": output_layer.output.get_sequence_lengths(),
+      "seq_tag": self.network.get_seq_tags(),
+    }
+    if reassembler or shard_opts:
+      extra_fetches["seq_idx"] = self.network.get_extern_data("seq_idx", mark_data_key_as_used=True)
     batches = data.generate_batches(
       recurrent_net=self.network.recurrent,
       batch_size=batch_size,
-      used_data_keys=self.network.used_data_keys)
+      used_data_keys=self.network.used_data_keys,
+      sort_window=sort_window,
+      **shard_opts)
     forwarder = Runner(
       engine=self, dataset=data, batches=batches,
       train=False, eval=False,
-      extra_fetches={
-        'inputs': output_layer.output.get_placeholder_as_batch_major(),
-        "seq_len": output_layer.output.get_sequence_lengths(),
-        "seq_tag": self.network.get_seq_tags(),
-      },
+      extra_fetches=extra_fetches,
       extra_fetches_callback=extra_fetches_cb)
     forwarder.run(report_prefix=self.get_epoch_str() + " forward")
     if not forwarder.finalized:
       print("Error happened. Exit now.")
       sys.exit(1)
-
-    max_tag_len = max([len(d) for d in tags])
-    cache.create_dataset('seqTags', shape=(len(tags),), dtype="S%i" % (max_tag_len + 1))
-    for i, tag in enumerate(tags):
-      cache['seqTags'][i] = numpy.array(tag, dtype="S%i" % (max_tag_len + 1))
-    cache.close()
+    if reassembler:
+      reassembler.flush()
+    writer.close()
+    self._print_inference_stats(name="Forward", runner=forwarder, batches=batches)
 
   def analyze(self, data, statistics):
     """
@@ -1106,9 +1495,11 @@ class Engine(object):
       batch_size=batch_size,
       max_seqs=max_seqs,
       max_seq_length=max_seq_length,
-      used_data_keys=self.network.used_data_keys)
+      used_data_keys=self.network.used_data_keys,
+      sort_window=self._get_inference_sort_window(data))  # the stats do not depend on the order
     analyzer = Runner(engine=self, dataset=data, batches=batches, train=False)
     analyzer.run(report_prefix=self.get_epoch_str() + " analyze")
+    self._print_inference_stats(name="Analyze", runner=analyzer, batches=batches)
 
     print("Finished analyzing of the dataset %r." % data, file=log.v1)
     print("elapsed:", hms(analyzer.elapsed), file=log.v1)
@@ -1141,12 +1532,14 @@ class Engine(object):
     if do_eval:
       # It's constructed lazily and it will set used_data_keys, so make sure that we have it now.
       self.network.get_all_errors()
+    sort_window = self._get_inference_sort_window(dataset)
     batches = dataset.generate_batches(
       recurrent_net=self.network.recurrent,
       batch_size=self.config.int('batch_size', 1),
       max_seqs=self.config.int('max_seqs', -1),
       max_seq_length=int(self.config.float('max_seq_length', 0)),
-      used_data_keys=self.network.used_data_keys)
+      used_data_keys=self.network.used_data_keys,
+      sort_window=sort_window)
 
     output_layer = self.network.layers[output_layer_name]
     out_beam_size = output_layer.output.beam_size
@@ -1156,56 +1549,53 @@ class Engine(object):
       print("Given output %r has beam size %i." % (output_layer, out_beam_size), file=log.v1)
     target_key = "classes"
 
-    if output_file:
-      assert dataset.can_serialize_data(target_key)
-      assert not os.path.exists(output_file)
-      print("Will write outputs to: %s" % output_file, file=log.v2)
-      output_file = open(output_file, "w")
-
-    def extra_fetches_callback(seq_idx, seq_tag, output, targets=None):
-      """
-      :param list[int] seq_idx: of length batch (without beam)
-      :param list[str] seq_tag: of length batch (without beam)
-      :param list[numpy.ndarray] output: of length batch (with beam)
-      :param list[numpy.ndarray] targets: of length batch (without beam)
-      """
-      n_batch = len(seq_idx)  # without beam
-      assert n_batch == len(seq_tag)
-      assert n_batch * (out_beam_size or 1) == len(output)
-      if output_layer.output.dim == 256 and output_layer.output.sparse:
-        # Interpret output as bytes/utf8-string.
-        output = [bytearray(o).decode("utf8") for o in output]
-      for i in range(len(seq_idx)):
-        if out_beam_size is None:
-          print("seq_idx: %i, seq_tag: %r, output: %r" % (seq_idx[i], seq_tag[i], output[i]), file=log.v1)
-          out_idx = i
-        else:
-          print("seq_idx: %i, seq_tag: %r, outputs: %r" % (
-            seq_idx[i], seq_tag[i], output[i * out_beam_size:(i + 1)*out_beam_size]), file=log.v1)
-          out_idx = i * out_beam_size
-        if target_key and dataset.can_serialize_data(target_key):
-          print("  hyp:", dataset.serialize_data(key=target_key, data=output[out_idx]), file=log.v1)
-          print("  ref:", dataset.serialize_data(key=target_key, data=targets[out_idx]), file=log.v1)
-        if output_file:
-          output_file.write("%s\n" % dataset.serialize_data(key=target_key, data=output[out_idx]).encode("utf8"))
-          output_file.flush()
+    writer = SearchOutputWriter(
+      dataset=dataset, target_key=target_key, beam_size=out_beam_size, output_file=output_file,
+      output_format=self.config.value("search_output_file_format", "txt"),
+      nbest=self.config.int("search_output_nbest", 0) or None,
+      bytes_output=output_layer.output.dim == 256 and output_layer.output.sparse,
+      background=self.config.bool("search_output_background_writer", True))
+    extra_fetches = {
+      "output": output_layer,
+      "seq_idx": self.network.get_extern_data("seq_idx", mark_data_key_as_used=True),
+      "seq_tag": self.network.get_extern_data("seq_tag", mark_data_key_as_used=True),
+      "targets": self.network.get_extern_data(target_key, mark_data_key_as_used=True)}
+    if out_beam_size is not None:
+      search_choices_layer = self.network.get_search_choices(src=output_layer)
+      if search_choices_layer and search_choices_layer.search_choices.beam_scores is not None:
+        if search_choices_layer.search_choices.beam_size == out_beam_size:
+          extra_fetches["beam_scores"] = search_choices_layer.search_choices.beam_scores  # (batch, beam)
+
+    extra_fetches_callback = writer.add_batch
+    if sort_window:
+      reassembler = SeqOrderReassembler(callback=lambda item: writer.add_batch(**item), window=sort_window)
+
+      def extra_fetches_callback(seq_idx, seq_tag, output, targets=None, beam_scores=None):
+        """
+        Splits the batch into single seqs, which we pass on to the writer in the original order.
+        See :func:`SearchOutputWriter.add_batch` for the args.
+        """
+        beam_size = out_beam_size or 1
+        for i in range(len(seq_idx)):
+          reassembler.add(seq_idx[i], dict(
+            seq_idx=[seq_idx[i]], seq_tag=[seq_tag[i]], output=output[i * beam_size:(i + 1) * beam_size],
+            targets=[targets[i]] if targets is not None else None,
+            beam_scores=beam_scores[i:i + 1] if beam_scores is not None else None))
 
     runner = Runner(
       engine=self, dataset=dataset, batches=batches, train=False, eval=do_eval,
-      extra_fetches={
-        "output": output_layer,
-        "seq_idx": self.network.get_extern_data("seq_idx", mark_data_key_as_used=True),
-        "seq_tag": self.network.get_extern_data("seq_tag", mark_data_key_as_used=True),
-        "targets": self.network.get_extern_data(target_key, mark_data_key_as_used=True)},
+      extra_fetches=extra_fetches,
       extra_fetches_callback=extra_fetches_callback)
     runner.run(report_prefix=self.get_epoch_str() + " search")
     if not runner.finalized:
       print("Error happened. Exit now.")
       sys.exit(1)
+    if sort_window:
+      reassembler.flush()
+    writer.close()
+    self._print_inference_stats(name="Search", runner=runner, batches=batches)
     print("Search done. Final: score %s error %s" % (
       self.format_score(runner.score), self.format_score(runner.error)), file=log.v1)
-    if output_file:
-      output_file.close()
 
   def compute_priors(self, dataset, config=None):
     """
@@ -184,6 +184,7 @@ class TFNetwork(object):
     self.extra_vars_to_save = []  # type: list[tf.Variable]
     self.recurrent = False
     self._assigner_cache = {}  # type: dict[tf.Variable,VariableAssigner]
+    self._params_initializer = None  # type: (list[tf.Variable],tf.Operation)|None  # see initialize_params()
     self.concat_sources_dropout_cache = {}  # type: dict[(tuple[LayerBase],float),Data]
 
   def __repr__(self):
@@ -571,16 +572,17 @@ class TFNetwork(object):
     """
     :param tf.Session session:
 
-    Note: This will create a new node to the graph for each call!
-    And it will overwrite also the already initialized variables.
-    So you should call this only once after network construction and before you maybe load some of the params
-    from external sources.
+    Note: This will overwrite also the already initialized variables.
+    So you should call this only after network construction (or when the network is reused, e.g. via the
+    network cache of the TFEngine) and before you maybe load some of the params from external sources.
+    The initializer node is created only once for the current list of params and then reused.
     If you know that you will load all params explicitly, you would not need to call this function.
     """
     var_list = self.get_params_list() + self.get_auxiliary_params()
-    with tf.name_scope("var_initializer"):
-      initializer_op = tf.variables_initializer(var_list=var_list)
-    session.run(initializer_op)
+    if not self._params_initializer or self._params_initializer[0] != var_list:
+      with tf.name_scope("var_initializer"):
+        self._params_initializer = (var_list, tf.variables_initializer(var_list=var_list))
+    session.run(self._params_initializer[1])
     for var in var_list:
       # Some of our code could set this, e.g. the SubnetworkLayer.
       custom_post_init = getattr(var, "custom_post_init", None)
@@ -2935,6 +2935,39 @@ def windowed_nd(source, window, padding="same", time_axis=1, new_window_axis=2):
     return final
 
 
+def set_global_default_graph(graph):
+  """
+  Like :func:`tf.reset_default_graph`, but the given graph becomes the new global default graph
+  (the one which is used when we are not inside a ``with graph.as_default()`` context).
+  There is no public TF API for this, thus we use TF internals,
+  see :func:`check_set_global_default_graph_supported`.
+  E.g. the TFEngine uses this to switch between cached networks, each in its own graph.
+
+  :param tf.Graph graph:
+  """
+  check_set_global_default_graph_supported()
+  from tensorflow.python.framework import ops
+  # Same check as in tf.reset_default_graph().
+  assert ops._default_graph_stack.is_cleared(), "must not be called inside a graph.as_default() context"
+  ops._default_graph_stack.reset()
+  ops._default_graph_stack._global_default_graph = graph
+  assert tf.get_default_graph() is graph
+
+
+def check_set_global_default_graph_supported():
+  """
+  :func:`set_global_default_graph` uses TF internals (tested with TF 1.x).
+  This raises an exception if those are not like we expect.
+  """
+  from tensorflow.python.framework import ops
+  stack = getattr(ops, "_default_graph_stack", None)
+  for attr in ["_global_default_graph", "is_cleared", "reset"]:
+    if not hasattr(stack, attr):
+      raise NotImplementedError(
+        "set_global_default_graph: not supported with TF %s, the internal default graph stack %r has no %r" % (
+          tf.__version__, stack, attr))
+
+
 def global_tensor(f, name):
   """
   This creates a global accessible tensor in the graph to be reused later,
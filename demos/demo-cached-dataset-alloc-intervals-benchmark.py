@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark for the CachedDataset.alloc_intervals bookkeeping
+(is_cached(), alloc_interval_index(), insert_alloc_interval(), remove_alloc_interval(), delete()).
+
+It compares the current bisect-based implementation against the previous implementation,
+which walked the list of intervals linearly in _modify_alloc_intervals().
+No data is read, only the cache index is modified, with random inserts and removes,
+such that there are many intervals, as with a big cache and shuffled batches.
+It also checks that both implementations give the same is_cached() results and end up with the same intervals.
+
+Usage:
+  demos/demo-cached-dataset-alloc-intervals-benchmark.py [--num_seqs 100000] [--num_ops 20000]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import better_exchook
+from Log import log
+from CachedDataset import CachedDataset
+
+
+class SyntheticCachedDataset(CachedDataset):
+  """
+  Random seq lengths, and _load_seqs() only allocates the cache.
+  """
+
+  def __init__(self, num_seqs, **kwargs):
+    super(SyntheticCachedDataset, self).__init__(**kwargs)
+    rnd = numpy.random.RandomState(42)
+    self._num_seqs = num_seqs
+    self.num_inputs = 1
+    self.num_outputs = {"data": (1, 2), "classes": (1, 1)}
+    self.target_keys = ["classes"]
+    seq_lens = rnd.randint(1, 20, size=(num_seqs,))
+    self._seq_lengths = numpy.stack([seq_lens, seq_lens], axis=1)
+    self._seq_start = [numpy.zeros((2,), dtype="int64")]
+
+  def _load_seqs(self, start, end):
+    self.insert_alloc_interval(start, end)
+
+
+class SyntheticCachedDatasetLinearScan(SyntheticCachedDataset):
+  """
+  The previous implementation of the interval bookkeeping.
+  """
+
+  def alloc_interval_index(self, ids):
+    s = 0
+    e = len(self.alloc_intervals)
+    while s < e:
+      i = (s + e) // 2
+      alloc_start, alloc_end, _ = self.alloc_intervals[i]
+      if alloc_start <= ids < alloc_end:
+        return i
+      elif alloc_start <= ids and ids >= alloc_end:
+        if s == i: return -1
+        s = i
+      elif alloc_start > ids:
+        if e == i: return -1
+        e = i
+    return -1
+
+  def is_cached(self, start, end):
+    if start == end: return True
+    idx = self.alloc_interval_index(start)
+    if idx < 0:
+      return False
+    return end <= self.alloc_intervals[idx][1]
+
+  def _modify_alloc_intervals(self, start, end, invert):
+    if end is None: end = start + 1
+    if start == end: return
+    i = 0
+    selection = []
+    modify = self._insert_alloc_interval if invert else self._remove_alloc_interval
+    while i < len(self.alloc_intervals) - invert:
+      ni = self.alloc_intervals[i + invert][1 - invert]
+      ci = self.alloc_intervals[i][invert]
+      flag = ((ci <= start < ni), (ci < end <= ni), (ci < start and ni <= start) or (ci >= end and ni > end))
+      if not flag[0] and not flag[1]:
+        if not flag[2]:
+          selection.extend(range(ci, ni))
+          i += modify(i, (ci, ni))
+      elif flag[1]:
+        v = (start if flag[0] else ci, end)
+        selection.extend(range(v[0], v[1]))
+        i += modify(i, v)
+        break
+      elif flag[0]:
+        selection.extend(range(start, ni))
+        i += modify(i, (start, ni))
+      i += 1
+    if self.alloc_intervals[0][0] != 0:
+      self.alloc_intervals.insert(0, (0, 0, numpy.zeros([1] + self.get_data_shape("data"), dtype=self.get_data_dtype("data"))))
+    if self.alloc_intervals[-1][1] != self.num_seqs:
+      self.alloc_intervals.append((self.num_seqs, self.num_seqs, numpy.zeros([1] + self.get_data_shape("data"), dtype=self.get_data_dtype("data"))))
+    return selection
+
+
+def make_ops(num_seqs, num_ops, max_range_len, seed=1):
+  """
+  :return: list of (op,start,end), op is "insert", "remove" or "delete" (with nframes=end-start).
+    inserts are more likely than removes, so that we end up with many intervals.
+  :rtype: list[(str,int,int)]
+  """
+  rnd = numpy.random.RandomState(seed)
+  ops = []
+  for _ in range(num_ops):
+    start = rnd.randint(0, num_seqs - 1)
+    end = min(start + rnd.randint(1, max_range_len + 1), num_seqs)
+    r = rnd.uniform()
+    ops.append(("insert" if r < 0.6 else "remove" if r < 0.999 else "delete", start, end))
+  return ops
+
+
+def run(cls, ops, args):
+  """
+  :param type cls:
+  :param list[(str,int,int)] ops:
+  :return: (time in sec, final intervals, is_cached() results)
+  :rtype: (float, list[(int,int)], list[bool])
+  """
+  dataset = cls(num_seqs=args.num_seqs, cache_byte_size=-1)
+  dataset.initialize()
+  dataset.init_seq_order(epoch=1)
+  cached = []
+  start_time = time.time()
+  for op, start, end in ops:
+    if op == "insert":
+      dataset.insert_alloc_interval(start, end)
+      cached.append(dataset.is_cached(start, end))
+    elif op == "remove":
+      dataset.remove_alloc_interval(start, end)
+      cached.append(dataset.is_cached(start, end))
+    else:
+      dataset.delete(end - start)
+    for i in (start, (start + end) // 2, end - 1):
+      dataset.alloc_interval_index(i)
+  elapsed = time.time() - start_time
+  return elapsed, [(s, e) for (s, e, _) in dataset.alloc_intervals], cached
+
+
+def main():
+  arg_parser = ArgumentParser()
+  arg_parser.add_argument("--num_seqs", type=int, default=100000)
+  arg_parser.add_argument("--num_ops", type=int, default=20000)
+  arg_parser.add_argument("--max_range_len", type=int, default=10)
+  args = arg_parser.parse_args()
+  log.initialize(verbosity=[2])
+  ops = make_ops(args.num_seqs, args.num_ops, args.max_range_len)
+  print("Settings:", vars(args))
+  results = {}
+  for cls in [SyntheticCachedDatasetLinearScan, SyntheticCachedDataset]:
+    elapsed, intervals, cached = run(cls, ops, args)
+    results[cls.__name__] = (intervals, cached)
+    print("%s: %.3f sec, %i intervals at the end" % (cls.__name__, elapsed, len(intervals)))
+  assert results[SyntheticCachedDatasetLinearScan.__name__] == results[SyntheticCachedDataset.__name__]
+  print("Both implementations give the same results.")
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  main()
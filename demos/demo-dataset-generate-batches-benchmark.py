@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for Dataset.generate_batches() in the recurrent case without chunking.
+
+It compares the per-seq loop in Dataset._generate_batches() against the vectorized
+Dataset._generate_batches_from_seq_lengths(), which is used when the dataset implements
+Dataset.get_seq_length_array() (e.g. HDFDataset).
+The seq lengths are sampled from some synthetic distributions, no data is loaded.
+It reports the time until the first batch and for the whole epoch,
+and checks that both variants produce the same batches.
+
+Usage:
+  demos/demo-dataset-generate-batches-benchmark.py [--num_seqs 200000] [--batch_size 5000] [--max_seqs 40]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import better_exchook
+from Log import log
+from Dataset import Dataset
+from Util import NumbersDict
+
+
+def make_seq_lengths(distribution, num_seqs):
+  """
+  :param str distribution: "uniform", "lognormal" or "bimodal"
+  :param int num_seqs:
+  :return: seq lengths for "data" and "classes"
+  :rtype: dict[str,numpy.ndarray]
+  """
+  rnd = numpy.random.RandomState(42)
+  if distribution == "uniform":
+    data = rnd.randint(1, 1000, size=(num_seqs,))
+  elif distribution == "lognormal":  # roughly like utterance lengths in frames
+    data = numpy.maximum(rnd.lognormal(mean=6.0, sigma=0.5, size=(num_seqs,)).astype("int64"), 1)
+  elif distribution == "bimodal":  # short and long seqs mixed
+    data = numpy.where(rnd.uniform(size=(num_seqs,)) < 0.8, rnd.randint(10, 100, size=(num_seqs,)),
+                       rnd.randint(1000, 3000, size=(num_seqs,)))
+  else:
+    raise Exception("unknown distribution %r" % distribution)
+  classes = numpy.maximum(data // 8, 1)
+  return {"data": data, "classes": classes}
+
+
+class SyntheticLengthsDataset(Dataset):
+  """
+  Only provides the seq lengths.
+  """
+
+  def __init__(self, seq_lengths, **kwargs):
+    """
+    :param dict[str,numpy.ndarray] seq_lengths:
+    """
+    super(SyntheticLengthsDataset, self).__init__(**kwargs)
+    self.seq_lengths = seq_lengths
+    self._num_seqs = len(seq_lengths["data"])
+
+  @property
+  def num_seqs(self):
+    return self._num_seqs
+
+  def get_seq_length(self, seq_idx):
+    return NumbersDict({k: v[seq_idx] for (k, v) in self.seq_lengths.items()})
+
+  def get_seq_length_array(self):
+    return self.seq_lengths
+
+
+class SyntheticLengthsDatasetPerSeq(SyntheticLengthsDataset):
+  """
+  Uses the per-seq loop in Dataset._generate_batches().
+  """
+
+  def get_seq_length_array(self):
+    return None
+
+
+def run(cls, seq_lengths, args):
+  """
+  :param type cls:
+  :param dict[str,numpy.ndarray] seq_lengths:
+  :return: (time to first batch, time for whole epoch, batches as lists of seq idx)
+  :rtype: (float, float, list[list[int]])
+  """
+  dataset = cls(seq_lengths=seq_lengths)
+  dataset.init_seq_order(epoch=1)
+  start_time = time.time()
+  batch_gen = dataset.generate_batches(
+    recurrent_net=True, batch_size=args.batch_size, max_seqs=args.max_seqs, max_seq_length=args.max_seq_length,
+    seq_drop=args.seq_drop)
+  batches = []
+  first_batch_time = None
+  while batch_gen.has_more():
+    batch, = batch_gen.peek_next_n(1)
+    if first_batch_time is None:
+      first_batch_time = time.time() - start_time
+    batches.append([s.seq_idx for s in batch.seqs])
+    batch_gen.advance(1)
+  return first_batch_time, time.time() - start_time, batches
+
+
+def main():
+  arg_parser = ArgumentParser()
+  arg_parser.add_argument("--num_seqs", type=int, default=200000)
+  arg_parser.add_argument("--batch_size", type=int, default=5000)
+  arg_parser.add_argument("--max_seqs", type=int, default=40)
+  arg_parser.add_argument("--max_seq_length", type=int, default=2000)
+  arg_parser.add_argument("--seq_drop", type=float, default=0.0)
+  arg_parser.add_argument("--distributions", default="uniform,lognormal,bimodal")
+  args = arg_parser.parse_args()
+  log.initialize(verbosity=[2])
+  print("Settings:", vars(args))
+  for distribution in args.distributions.split(","):
+    seq_lengths = make_seq_lengths(distribution, args.num_seqs)
+    results = {}
+    for cls in [SyntheticLengthsDatasetPerSeq, SyntheticLengthsDataset]:
+      first_batch_time, elapsed, batches = run(cls, seq_lengths, args)
+      results[cls.__name__] = batches
+      print("%s, %s: first batch after %.3f sec, %i batches in %.3f sec" % (
+        distribution, cls.__name__, first_batch_time, len(batches), elapsed))
+    assert results[SyntheticLengthsDatasetPerSeq.__name__] == results[SyntheticLengthsDataset.__name__]
+  print("Both variants give the same batches.")
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  main()
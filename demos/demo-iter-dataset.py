@@ -29,7 +29,8 @@ def iterateDataset(dataset, recurrent_net, batch_size, max_seqs):
   while batch_gen.has_more():
     batches = batch_gen.peek_next_n(dev_num_batches)
     for batch in batches:
-      dataset.load_seqs(batch.start_seq, batch.end_seq)
+      for start_seq, end_seq in batch.get_seq_ranges():
+        dataset.load_seqs(start_seq, end_seq)
     batch_gen.advance(len(batches))
 
 
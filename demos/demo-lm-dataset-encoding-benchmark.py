@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the orth symbol encoding of LmDataset.
+
+It generates random char-based sentences and compares the symbol-by-symbol encoding
+(parse_orthography(), orth_replace_map, space collapsing and orth_symbols_map lookup per symbol,
+like LmDataset did it before) against LmDataset.OrthSymbolsEncoder, which encodes a batch at once.
+It checks that both give the same result.
+
+Usage:
+  demos/demo-lm-dataset-encoding-benchmark.py [--num_seqs 10000] [--seq_len 100] [--batch_size 100]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import better_exchook
+from Util import parse_orthography
+from LmDataset import OrthSymbolsEncoder
+
+
+def encode_orth_per_symbol(orth, orth_symbols_map, orth_replace_map):
+  """
+  :param str orth:
+  :param dict[str,int] orth_symbols_map:
+  :param dict[str,list[str]] orth_replace_map:
+  :rtype: numpy.ndarray
+  """
+  orth_syms = parse_orthography(orth)
+  orth_syms = sum([orth_replace_map.get(s, [s]) for s in orth_syms], [])
+  i = 0
+  while i < len(orth_syms) - 1:
+    if orth_syms[i:i + 2] == [" ", " "]:
+      orth_syms[i:i + 2] = [" "]  # collapse two spaces
+    else:
+      i += 1
+  return numpy.array([orth_symbols_map[s] for s in orth_syms], dtype="int32")
+
+
+def main():
+  arg_parser = ArgumentParser()
+  arg_parser.add_argument("--num_seqs", type=int, default=10000)
+  arg_parser.add_argument("--seq_len", type=int, default=100)
+  arg_parser.add_argument("--batch_size", type=int, default=100)
+  args = arg_parser.parse_args()
+  print("Settings:", vars(args))
+  rnd = numpy.random.RandomState(42)
+  chars = list(u"abcdefghijklmnopqrstuvwxyz\xe4\xf6\xfc     ")
+  orths = [u"".join(rnd.choice(chars, size=rnd.randint(args.seq_len // 2, args.seq_len * 3 // 2)))
+           for _ in range(args.num_seqs)]
+  orths = [orth + u" [NOISE]" if i % 10 == 0 else orth for (i, orth) in enumerate(orths)]
+  symbols = ["[END]", "[NOISE]", " "] + sorted(set(chars) - {u"\xe4", u"\xf6", u"\xfc"})
+  orth_symbols_map = {sym: i for (i, sym) in enumerate(symbols)}
+  orth_replace_map = {u"\xe4": [u"a", u"e"], u"\xf6": [u"o", u"e"], u"\xfc": [u"u", u"e"]}
+  num_syms = sum([len(orth) for orth in orths])
+
+  start_time = time.time()
+  res_ref = [encode_orth_per_symbol(orth, orth_symbols_map, orth_replace_map) for orth in orths]
+  elapsed_ref = time.time() - start_time
+
+  encoder = OrthSymbolsEncoder(orth_symbols_map=orth_symbols_map, orth_replace_map=orth_replace_map)
+  start_time = time.time()
+  res = []
+  for i in range(0, len(orths), args.batch_size):
+    res += encoder.encode_batch(orths[i:i + args.batch_size])
+  elapsed = time.time() - start_time
+
+  print("per symbol: %.3f sec, %.0f syms/sec; OrthSymbolsEncoder: %.3f sec, %.0f syms/sec; speedup %.1fx" % (
+    elapsed_ref, num_syms / elapsed_ref, elapsed, num_syms / elapsed, elapsed_ref / elapsed))
+  for r_ref, r in zip(res_ref, res):
+    assert r_ref.tolist() == r.tolist()
+  print("Both variants give the same result.")
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  main()
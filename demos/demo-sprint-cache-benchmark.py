@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for reading Sprint caches via SprintCache.FileArchive.
+
+It writes a synthetic feature cache and alignment cache and then compares
+FileArchive.read(), which decodes frame by frame,
+against FileArchive.read_numpy(), which decodes the whole entry at once via Numpy.
+It checks that both give the same result.
+
+Usage:
+  demos/demo-sprint-cache-benchmark.py [--num_seqs 200] [--seq_len 500] [--dim 40]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+from argparse import ArgumentParser
+
+import numpy
+
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import better_exchook
+from SprintCache import FileArchive
+
+
+def write_caches(args, tmp_dir):
+  """
+  :param args:
+  :param str tmp_dir:
+  :return: (feature cache filename, alignment cache filename, allophone filename)
+  :rtype: (str, str, str)
+  """
+  rnd = numpy.random.RandomState(42)
+  feat_fn = "%s/feat.cache" % tmp_dir
+  align_fn = "%s/align.cache" % tmp_dir
+  allophone_fn = "%s/allophones.txt" % tmp_dir
+  with open(allophone_fn, "w") as f:
+    for i in range(args.num_allophones):
+      f.write("a%i{#+#}\n" % i)
+  feat_cache = FileArchive(feat_fn, must_exists=False)
+  align_cache = FileArchive(align_fn, must_exists=False)
+  for i in range(args.num_seqs):
+    name = "corpus/seq-%i/1" % i
+    feat = rnd.normal(size=(args.seq_len, args.dim)).astype("float32")
+    feat_cache.addFeatureCache(name, feat, [(0.01 * t, 0.01 * (t + 1)) for t in range(args.seq_len)])
+    # Roughly like a HMM alignment: each state for a few frames.
+    mixtures = []
+    while len(mixtures) < args.seq_len:
+      mixtures += [rnd.randint(0, args.num_allophones) + rnd.randint(0, 3) * (1 << 26)] * rnd.randint(1, 8)
+    align_cache.addAlignmentCache(name, mixtures[:args.seq_len])
+  feat_cache.finalize()
+  align_cache.finalize()
+  return feat_fn, align_fn, allophone_fn
+
+
+def benchmark(archive, typ, use_numpy):
+  """
+  :param FileArchive archive:
+  :param str typ:
+  :param bool use_numpy:
+  :return: (elapsed time, results)
+  :rtype: (float, list)
+  """
+  names = sorted(archive.file_list())
+  start_time = time.time()
+  if use_numpy:
+    results = [archive.read_numpy(name, typ) for name in names]
+  else:
+    results = [archive.read(name, typ) for name in names]
+  return time.time() - start_time, results
+
+
+def main():
+  arg_parser = ArgumentParser()
+  arg_parser.add_argument("--num_seqs", type=int, default=200)
+  arg_parser.add_argument("--seq_len", type=int, default=500)
+  arg_parser.add_argument("--dim", type=int, default=40)
+  arg_parser.add_argument("--num_allophones", type=int, default=1000)
+  args = arg_parser.parse_args()
+  print("Settings:", vars(args))
+  tmp_dir = tempfile.mkdtemp(prefix="returnn-sprint-cache-benchmark")
+  try:
+    print("Writing caches...")
+    feat_fn, align_fn, allophone_fn = write_caches(args, tmp_dir)
+    num_frames = args.num_seqs * args.seq_len
+    feat_cache = FileArchive(feat_fn)
+    feat_cache.ft = {k: v for (k, v) in feat_cache.ft.items() if not k.endswith(".attribs")}
+    align_cache = FileArchive(align_fn)
+    align_cache.setAllophones(allophone_fn)
+    for typ, archive in [("feat", feat_cache), ("align", align_cache)]:
+      elapsed_ref, res_ref = benchmark(archive, typ, use_numpy=False)
+      elapsed, res = benchmark(archive, typ, use_numpy=True)
+      print("%s: read(): %.3f sec, %.0f frames/sec; read_numpy(): %.3f sec, %.0f frames/sec; speedup %.1fx" % (
+        typ, elapsed_ref, num_frames / elapsed_ref, elapsed, num_frames / elapsed, elapsed_ref / elapsed))
+      for r_ref, r in zip(res_ref, res):
+        if typ == "feat":
+          assert numpy.array_equal(numpy.array(r_ref[0]), r[0])
+          assert numpy.array_equal(numpy.array(r_ref[1]), r[1])
+        else:
+          assert r_ref == list(zip(*[x.tolist() for x in r]))
+    print("Both variants give the same result.")
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  main()
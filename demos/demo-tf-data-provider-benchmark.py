@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmark for the data providers of the TF engine (TFDataPipeline).
+
+It trains a small feed-forward network for one epoch on a synthetic dataset (DummyDataset)
+with each of the data providers:
+
+  feed_dict: FeedDictDataProvider, the data is fed via feed_dict in the session.run() of the train step
+  staging: StagingDataProvider, the data is put into a StagingArea on the device in the background
+  multi_process: MultiProcessDataProvider, the batches are constructed in worker processes
+
+and reports the train steps and frames per second.
+The time for the CPU->GPU copy only shows up when we run on a GPU.
+
+Usage:
+  demos/demo-tf-data-provider-benchmark.py [--num_seqs 500] [--seq_len 200] [--input_dim 100] [--batch_size 5000]
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+from argparse import ArgumentParser
+
+sys.path += [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import better_exchook
+from Log import log
+from Config import Config
+from Dataset import init_dataset
+import TFUtil
+
+
+def run(data_provider, args, model_dir):
+  """
+  :param str data_provider:
+  :param args:
+  :param str model_dir:
+  :return: (elapsed time, number of steps)
+  :rtype: (float, int)
+  """
+  from TFEngine import Engine
+  # Via init_dataset(), such that the workers of MultiProcessDataProvider can create it again.
+  dataset = init_dataset({
+    "class": "DummyDataset", "input_dim": args.input_dim, "output_dim": args.output_dim,
+    "num_seqs": args.num_seqs, "seq_len": args.seq_len})
+  dataset.init_seq_order(epoch=1)
+  config = Config()
+  config.update({
+    "model": "%s/model-%s" % (model_dir, data_provider),
+    "num_outputs": args.output_dim,
+    "num_inputs": args.input_dim,
+    "network": {
+      "hidden": {"class": "linear", "activation": "relu", "n_out": args.hidden_dim},
+      "output": {"class": "softmax", "loss": "ce", "from": ["hidden"]}},
+    "batch_size": args.batch_size,
+    "max_seqs": args.max_seqs,
+    "learning_rate": 0.001,
+    "start_epoch": 1,
+    "num_epochs": 1})
+  if data_provider == "multi_process":
+    config.set("data_provider_num_workers", args.num_workers)
+  else:
+    config.set("data_provider", data_provider)
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=dataset, dev_data=None, eval_data=None)
+  start_time = time.time()
+  engine.train()
+  elapsed = time.time() - start_time
+  num_steps = engine.dataset_batches["train"].get_current_batch_idx()
+  engine.finalize()
+  return elapsed, num_steps
+
+
+def main():
+  arg_parser = ArgumentParser()
+  arg_parser.add_argument("--num_seqs", type=int, default=500)
+  arg_parser.add_argument("--seq_len", type=int, default=200)
+  arg_parser.add_argument("--input_dim", type=int, default=100)
+  arg_parser.add_argument("--output_dim", type=int, default=50)
+  arg_parser.add_argument("--hidden_dim", type=int, default=512)
+  arg_parser.add_argument("--batch_size", type=int, default=5000)
+  arg_parser.add_argument("--max_seqs", type=int, default=40)
+  arg_parser.add_argument("--num_workers", type=int, default=2)
+  arg_parser.add_argument("--data_providers", default="feed_dict,staging,multi_process")
+  args = arg_parser.parse_args()
+  log.initialize(verbosity=[2])
+  print("Settings:", vars(args))
+  TFUtil.setup_tf_thread_pools()
+  model_dir = tempfile.mkdtemp(prefix="returnn-data-provider-benchmark")
+  num_frames = args.num_seqs * args.seq_len
+  try:
+    for data_provider in args.data_providers.split(","):
+      elapsed, num_steps = run(data_provider, args, model_dir=model_dir)
+      print("%s: %i steps in %.3f sec, %.1f steps/sec, %.0f frames/sec" % (
+        data_provider, num_steps, elapsed, num_steps / elapsed, num_frames / elapsed))
+  finally:
+    shutil.rmtree(model_dir)
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  main()
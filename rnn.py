@@ -31,7 +31,7 @@ from Dataset import Dataset, init_dataset, init_dataset_via_str
 from HDFDataset import HDFDataset
 from Debug import initIPythonKernel, initBetterExchook, initFaulthandler, initCudaNotInMainProcCheck
 from Util import initThreadJoinHack, describe_crnn_version, describe_theano_version, \
-  describe_tensorflow_version, BackendEngine, get_tensorflow_version_tuple
+  describe_tensorflow_version, BackendEngine, get_tensorflow_version_tuple, hms
 try:
   import Server
 except ImportError:
@@ -45,6 +45,7 @@ dev_data = None; """ :type: Dataset """
 eval_data = None; """ :type: Dataset """
 quit = False
 server = None; """:type: Server"""
+command_line_args = None; """ :type: list[str] """  # config filename and options, e.g. for sub processes
 
 
 def initConfig(configFilename=None, commandLineOptions=(), extra_updates=None):
@@ -303,7 +304,7 @@ def initBackendEngine():
     if get_tensorflow_version_tuple()[0] == 0:
       print("Warning: TF <1.0 is not supported and likely broken.", file=log.v2)
     from TFUtil import debugRegisterBetterRepr, setup_tf_thread_pools
-    setup_tf_thread_pools(log_file=log.v2)
+    setup_tf_thread_pools(num_threads=config.int("tf_num_threads", 0) or None, log_file=log.v2)
     debugRegisterBetterRepr()
   else:
     raise NotImplementedError
@@ -316,6 +317,8 @@ def init(configFilename=None, commandLineOptions=(), config_updates=None, extra_
   :param dict[str]|None config_updates:
   :param str|None extra_greeting:
   """
+  global command_line_args
+  command_line_args = ([configFilename] if configFilename else []) + list(commandLineOptions or [])
   initBetterExchook()
   initThreadJoinHack()
   initConfig(configFilename=configFilename, commandLineOptions=commandLineOptions, extra_updates=config_updates)
@@ -363,9 +366,58 @@ def needData():
   task = config.value('task', 'train')
   if task in ['theano_graph', "nop"]:
     return False
+  if task == 'forward' and isForwardShardedMainProcess():
+    return False  # only the sub processes need the data, see forwardSharded()
   return True
 
 
+def isForwardShardedMainProcess():
+  """
+  :return: whether this is the main process of the sharded forwarding, see :func:`forwardSharded`
+  :rtype: bool
+  """
+  return config.int('forward_num_shards', 1) > 1 and not config.has('forward_shard_index')
+
+
+def forwardSharded(output_file, num_shards):
+  """
+  Runs the forward task in num_shards sub processes (rnn.py with the same config and options),
+  where each sub process forwards every num_shards-th batch of the eval data (see :func:`TFEngine.Engine.forward_to_hdf`)
+  with its own TF session and thread pools, and writes its own HDF file.
+  This main process does not load the data itself.
+  The sub processes share the available CPU threads (or tf_num_threads, if set, per sub process).
+  Then the shard files are merged into output_file, in the order of the seqs as without sharding,
+  unless forward_merge_shards is False,
+  in which case you can also directly use all the shard files with :class:`HDFDataset`.
+  Only the TF backend is supported. The Theano Engine.forward_to_hdf does not shard.
+
+  :param str output_file:
+  :param int num_shards:
+  """
+  import subprocess
+  import multiprocessing
+  assert BackendEngine.is_tensorflow_selected(), "forward_num_shards is only supported with TensorFlow"
+  num_threads = config.int("tf_num_threads", 0) or max(multiprocessing.cpu_count() // num_shards, 1)
+  shard_files = ["%s.shard-%i-of-%i" % (output_file, i, num_shards) for i in range(num_shards)]
+  print("Forward in %i shards with %i threads each." % (num_shards, num_threads), file=log.v3)
+  start_time = time.time()
+  procs = []
+  for shard_index, shard_file in enumerate(shard_files):
+    args = [sys.executable, os.path.abspath(__file__)] + command_line_args + [
+      "++forward_shard_index", str(shard_index), "++output_file", shard_file,
+      "++tf_num_threads", str(num_threads), "++log", "%s.log" % shard_file]
+    procs.append(subprocess.Popen(args))
+  failed = [i for (i, proc) in enumerate(procs) if proc.wait() != 0]
+  if failed:
+    raise Exception("forward shards %r failed, see the logs %r" % (failed, ["%s.log" % shard_files[i] for i in failed]))
+  print("Forward shards finished, took %s." % hms(time.time() - start_time), file=log.v3)
+  if config.bool("forward_merge_shards", True):
+    from HDFDataset import merge_hdf_files
+    merge_hdf_files(filenames=shard_files, output_file=output_file)
+    for shard_file in shard_files:
+      os.remove(shard_file)
+
+
 def executeMainTask():
   start_time = time.time()
   task = config.value('task', 'train')
@@ -380,14 +432,17 @@ def executeMainTask():
     print("Evaluate epoch", engine.epoch, file=log.v4)
     engine.eval_model()
   elif task == 'forward':
-    assert eval_data is not None, 'no eval data provided'
     assert config.has('output_file'), 'no output file provided'
     combine_labels = config.value('combine_labels', '')
     output_file = config.value('output_file', '')
-    engine.init_network_from_config(config)
-    engine.forward_to_hdf(
-      data=eval_data, output_file=output_file, combine_labels=combine_labels,
-      batch_size=config.int('forward_batch_size', 0))
+    if isForwardShardedMainProcess():
+      forwardSharded(output_file=output_file, num_shards=config.int('forward_num_shards', 1))
+    else:
+      assert eval_data is not None, 'no eval data provided'
+      engine.init_network_from_config(config)
+      engine.forward_to_hdf(
+        data=eval_data, output_file=output_file, combine_labels=combine_labels,
+        batch_size=config.int('forward_batch_size', 0))
   elif task == "search":
     engine.use_search_flag = True
     engine.init_network_from_config(config)
@@ -305,3 +305,40 @@ def test_task12ax_window():
   assert_equal(list(data2a[1, 1]), list(data1[1]))
   assert_equal(list(data2a[1, 2]), list(data1[2]))
   assert_equal(list(data2a[-1, 2]), [0] * input_dim)  # zero-padded right
+
+
+def test_generate_batches_vectorized_same_as_per_seq():
+  from GeneratingDataset import StaticDataset
+
+  def _nd(d):
+    return sorted(d.dict.items()), d.value
+
+  class StaticDatasetPerSeq(StaticDataset):
+    def get_seq_length_array(self):
+      return None  # fall back to the per-seq loop
+
+  rnd = np.random.RandomState(42)
+  data = []
+  for seq_idx in range(100):
+    seq_len = rnd.randint(1, 30)
+    data.append({"data": rnd.normal(size=(seq_len, 2)).astype("float32"),
+                 "classes": rnd.randint(0, 3, size=(rnd.randint(1, 30),)).astype("int32")})
+  for opts in [dict(batch_size=50, max_seqs=10), dict(batch_size=0, max_seqs=7),
+               dict(batch_size=100, max_seqs=-1, max_seq_length=20),
+               dict(batch_size=100, max_seqs=5, max_seq_length=-15),
+               dict(batch_size=30, max_seqs=20, seq_drop=0.3)]:
+    all_batches = []
+    for cls in [StaticDatasetPerSeq, StaticDataset]:
+      dataset = cls(data=data, output_dim={"data": [2, 2], "classes": [3, 1]})
+      dataset.init_seq_order(epoch=1)
+      batch_gen = dataset.generate_batches(recurrent_net=True, **opts)
+      batches = []
+      while batch_gen.has_more():
+        batch, = batch_gen.peek_next_n(1)
+        batches.append((_nd(batch.max_num_frames_per_slice), batch.num_slices, [
+          (s.seq_idx, _nd(s.seq_start_frame), _nd(s.seq_end_frame), s.batch_slice, _nd(s.batch_frame_offset))
+          for s in batch.seqs]))
+        batch_gen.advance(1)
+      all_batches.append(batches)
+    print(opts, "num batches:", len(all_batches[0]))
+    assert_equal(all_batches[0], all_batches[1])
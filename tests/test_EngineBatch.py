@@ -0,0 +1,96 @@
+
+from __future__ import print_function
+
+import sys
+sys.path += ["."]  # Python 3 hack
+
+from nose.tools import assert_equal, assert_is_instance, assert_raises
+from EngineBatch import Batch, BatchSeqCopyPart
+from Util import NumbersDict
+import numpy
+
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _nd(d):
+  return sorted(d.dict.items()), d.value
+
+
+def _part_tuple(part):
+  """
+  :param BatchSeqCopyPart part:
+  """
+  return (part.seq_idx, _nd(part.seq_start_frame), _nd(part.seq_end_frame), part.batch_slice,
+          _nd(part.batch_frame_offset))
+
+
+def test_batch_seq_copy_parts_same_as_list():
+  batch = Batch()
+  expected = []
+  args = [
+    dict(seq_idx=3, seq_start_frame=NumbersDict({"data": 0, "classes": 0}),
+         seq_end_frame=NumbersDict({"data": 7, "classes": 3}), batch_slice=0, batch_frame_offset=0),
+    dict(seq_idx=4, seq_start_frame=NumbersDict(2), seq_end_frame=NumbersDict({"data": 5}),
+         batch_slice=1, batch_frame_offset=NumbersDict({"data": 1, "classes": 2})),
+    dict(seq_idx=5, seq_start_frame=0, seq_end_frame=NumbersDict(numbers_dict={"data": 4, "orth": 2}, broadcast_value=4),
+         batch_slice=2, batch_frame_offset=NumbersDict(3))]
+  for i, kwargs in enumerate(args):
+    batch.seqs.append(**kwargs)
+    expected.append(BatchSeqCopyPart(**kwargs))
+    if i == 1:
+      batch.seqs.pack()  # the next part adds a new key
+  assert_equal(len(batch.seqs), 3)
+  for part in batch.seqs:
+    assert_is_instance(part, BatchSeqCopyPart)
+  assert_equal([_part_tuple(p) for p in batch.seqs], [_part_tuple(p) for p in expected])
+  assert_equal(_part_tuple(batch.seqs[-1]), _part_tuple(expected[-1]))
+  assert_equal(batch.start_seq, 3)
+  assert_equal(batch.end_seq, 6)
+  assert_equal(_nd(batch.get_total_num_frames()), _nd(sum([p.frame_length for p in expected])))
+  for key in ["data", "classes", "orth", "other"]:
+    start, end, offset, defined = batch.seqs.get_key_frames(key)
+    assert_equal(start.tolist(), [p.seq_start_frame.get(key, 0) for p in expected])
+    assert_equal(end.tolist(), [p.seq_end_frame.get(key, 0) for p in expected])
+    assert_equal(offset.tolist(), [p.batch_frame_offset.get(key, 0) for p in expected])
+    assert_equal(defined.tolist(), [p.frame_length.get(key) is not None for p in expected])
+  assert_equal(batch.seqs.get_batch_slices().tolist(), [0, 1, 2])
+
+
+def test_batch_seq_copy_parts_read_only():
+  batch = Batch()
+  batch.add_frames(seq_idx=0, seq_start_frame=0, length=NumbersDict({"data": 5, "classes": 2}))
+  part = batch.seqs[0]
+  with assert_raises(AttributeError):
+    part.batch_slice = 1
+  with assert_raises(TypeError):
+    part.seq_start_frame["data"] = 1
+  with assert_raises(TypeError):
+    part.batch_frame_offset += 1
+  assert_equal(_nd(part.seq_end_frame + 1), ([("classes", 3), ("data", 6)], None))
+  assert_equal(_part_tuple(batch.seqs[0]), _part_tuple(part))
+
+
+def test_batch_add_sequences_as_slices():
+  seq_idxs = numpy.array([2, 3, 5])
+  lengths = numpy.array([[7, 3], [5, 2], [9, 4]])
+  batch1 = Batch()
+  batch1.add_sequences_as_slices(seq_idxs=seq_idxs, keys=["classes", "data"], lengths=lengths)
+  batch2 = Batch()
+  for seq_idx, (classes_len, data_len) in zip(seq_idxs, lengths):
+    batch2.add_sequence_as_slice(
+      seq_idx=seq_idx, seq_start_frame=NumbersDict({"classes": 0, "data": 0}),
+      length=NumbersDict({"classes": classes_len, "data": data_len}))
+  assert_equal(_nd(batch1.max_num_frames_per_slice), _nd(batch2.max_num_frames_per_slice))
+  assert_equal(batch1.num_slices, batch2.num_slices)
+  assert_equal([_part_tuple(p) for p in batch1.seqs], [_part_tuple(p) for p in batch2.seqs])
+  assert_equal(_nd(batch1.get_total_num_frames()), ([("classes", 21), ("data", 9)], None))
+
+
+def test_batch_get_seq_ranges():
+  batch = Batch()
+  assert_equal(batch.get_seq_ranges(), [])
+  batch.add_sequences_as_slices(
+    seq_idxs=numpy.array([7, 2, 3, 9, 5, 6]), keys=["data"], lengths=numpy.array([[1]] * 6))
+  assert_equal(batch.get_seq_ranges(), [(2, 4), (5, 8), (9, 10)])
+  assert_equal((batch.start_seq, batch.end_seq), (2, 10))
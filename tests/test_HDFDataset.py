@@ -54,3 +54,367 @@ class TestHDFDataset(object):
     toy_dataset = self.test_init()
     # TODO: auto-generate file, then use here
     #toy_dataset.add_file("/u/kulikov/develop/crnn/tests/toy_set.hdf")
+
+
+def generate_hdf_from_dummy(num_seqs=4, seq_len=5):
+  """
+  :return: filename of a temporary HDF file, created via hdf_dump from a DummyDataset
+  :rtype: str
+  """
+  sys.path += ["tools"]
+  import tempfile
+  from hdf_dump import hdf_dataset_init, hdf_dump_from_dataset, hdf_close
+  from GeneratingDataset import DummyDataset
+  from Util import DictAsObj
+  hdf_filename = tempfile.mktemp(suffix=".hdf", prefix="nose-hdf-dataset")
+  hdf_dataset = hdf_dataset_init(hdf_filename)
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=num_seqs, seq_len=seq_len)
+  dataset.init_seq_order(epoch=1)
+  hdf_dump_from_dataset(dataset, hdf_dataset, DictAsObj({"epoch": 1, "start_seq": 0, "end_seq": float("inf")}))
+  hdf_close(hdf_dataset)
+  return hdf_filename
+
+
+def test_hdf_use_mmap():
+  from Log import log
+  log.initialize()
+  filenames = [generate_hdf_from_dummy(num_seqs=3), generate_hdf_from_dummy(num_seqs=4, seq_len=7)]
+  datasets = []
+  for use_mmap in [False, True]:
+    dataset = HDFDataset(use_mmap=use_mmap)
+    for fn in filenames:
+      dataset.add_file(fn)
+    dataset.initialize()
+    dataset.init_seq_order(epoch=1)
+    assert_equal(dataset.num_seqs, 7)
+    assert_equal(dataset.get_num_timesteps(), 3 * 5 + 4 * 7)
+    assert_equal(dataset.file_index.tolist(), [0] * 3 + [1] * 4)
+    dataset.load_seqs(0, dataset.num_seqs)
+    assert dataset.bytes_read > 0
+    datasets.append(dataset)
+  ds_h5py, ds_mmap = datasets
+  for seq_idx in range(ds_h5py.num_seqs):
+    assert_equal(ds_h5py.get_tag(seq_idx), ds_mmap.get_tag(seq_idx))
+    for key in ["data", "classes"]:
+      assert_equal(ds_h5py.get_data(seq_idx, key).tolist(), ds_mmap.get_data(seq_idx, key).tolist())
+  assert_equal(ds_h5py.bytes_read, ds_mmap.bytes_read)
+  ds_mmap.init_seq_order(epoch=2)
+  assert_equal(ds_mmap.bytes_read_per_epoch, {1: ds_h5py.bytes_read})
+  ds_mmap.close_files()
+  for fn in filenames:
+    os.remove(fn)
+
+
+def test_hdf_dump_num_outputs():
+  from Log import log
+  log.initialize()
+  # hdf_dump stores (dim, ndim) in 'targets/size'.
+  filename = generate_hdf_from_dummy(num_seqs=2)
+  dataset = HDFDataset()
+  dataset.add_file(filename)
+  dataset.initialize()
+  assert_equal(dataset.num_outputs["classes"], [3, 1])
+  assert_equal(dataset.num_outputs["data"], [2, 2])
+  os.remove(filename)
+
+
+def test_hdf_add_files_index_cache():
+  import tempfile
+  import shutil
+  from Log import log
+  log.initialize()
+  filenames = [generate_hdf_from_dummy(num_seqs=3), generate_hdf_from_dummy(num_seqs=4, seq_len=7)]
+  index_cache_dir = tempfile.mkdtemp(prefix="nose-hdf-index")
+  ds_serial = HDFDataset()
+  for fn in filenames:
+    ds_serial.add_file(fn)
+  ds_serial.initialize()
+  for _ in range(2):  # second time, the sidecar index files are used
+    ds_bulk = HDFDataset(index_cache_dir=index_cache_dir, num_meta_workers=2)
+    ds_bulk.add_files(filenames)
+    ds_bulk.initialize()
+    assert_equal(len(os.listdir(index_cache_dir)), 2)
+    assert_equal(ds_bulk.num_seqs, ds_serial.num_seqs)
+    assert_equal(ds_bulk.tags, ds_serial.tags)
+    assert_equal(ds_bulk.num_outputs, ds_serial.num_outputs)
+    assert_equal(ds_bulk._seq_lengths.tolist(), ds_serial._seq_lengths.tolist())
+    assert_equal(ds_bulk._seq_file_offsets.tolist(), ds_serial._seq_file_offsets.tolist())
+  shutil.rmtree(index_cache_dir)
+  for fn in filenames:
+    os.remove(fn)
+
+
+def test_hdf_prefetch_lru_cache():
+  from Log import log
+  log.initialize()
+  filename = generate_hdf_from_dummy(num_seqs=20, seq_len=5)
+  ds_ref = HDFDataset(cache_byte_size=-1)
+  ds_ref.add_file(filename)
+  ds_ref.initialize()
+  ds_ref.init_seq_order(epoch=1)
+  ds_ref.load_seqs(0, ds_ref.num_seqs)
+  # Cache for about 4 seqs, prefetch window of about 3 seqs.
+  seq_bytes = 5 * ds_ref.nbytes
+  for use_mmap, epoch in [(False, 1), (False, 2), (True, 1)]:
+    if epoch == 1:
+      dataset = HDFDataset(cache_byte_size=4 * 3 * seq_bytes, prefetch_byte_size=3 * seq_bytes, use_mmap=use_mmap)
+      dataset.add_file(filename)
+      dataset.initialize()
+    dataset.init_seq_order(epoch=epoch)
+    for seq_idx in range(dataset.num_seqs):
+      dataset.load_seqs(seq_idx, seq_idx + 1)
+      assert_equal(dataset.get_data(seq_idx, "data").tolist(), ds_ref.get_data(seq_idx, "data").tolist())
+      assert_equal(dataset.get_data(seq_idx, "classes").tolist(), ds_ref.get_data(seq_idx, "classes").tolist())
+      # We only keep what fits into the cache (+ prefetch budget), not everything.
+      with dataset.lock:
+        num_cached = len([i for i in range(dataset.num_seqs) if dataset.is_cached(i, i + 1)])
+      assert num_cached <= dataset.num_seqs_cached_at_start + 1 + 3, "cached: %i, mmap %s, epoch %i, seq %i" % (num_cached, use_mmap, epoch, seq_idx)
+    if epoch == 2:
+      assert_equal(sorted(dataset.stall_time_per_epoch.keys()), [1])
+  dataset._stop_prefetch_thread()
+  dataset.close_files()
+  os.remove(filename)
+
+
+def test_hdf_prefetch_thread_does_not_keep_dataset_alive():
+  import gc
+  import time
+  import weakref
+  from Log import log
+  log.initialize()
+  filename = generate_hdf_from_dummy(num_seqs=5, seq_len=5)
+  dataset = HDFDataset(cache_byte_size=1000, prefetch_byte_size=1000)
+  dataset.add_file(filename)
+  dataset.initialize()
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, 1)
+  thread = dataset._prefetch_thread
+  assert thread
+  dataset_ref = weakref.ref(dataset)
+  del dataset
+  for _ in range(100):  # the thread might briefly hold a reference while it loads
+    gc.collect()
+    if dataset_ref() is None:
+      break
+    time.sleep(0.1)
+  assert dataset_ref() is None
+  thread.join(10)
+  assert not thread.is_alive()
+  os.remove(filename)
+
+
+def test_hdf_legacy_classes_zeros():
+  import tempfile
+  import numpy
+  import h5py
+  from Log import log
+  log.initialize()
+  filename = tempfile.mktemp(suffix=".hdf", prefix="nose-hdf-legacy")
+  # The legacy format, without 'targets' group.
+  with h5py.File(filename, "w") as f:
+    f.attrs["inputPattSize"] = 2
+    f.attrs["numLabels"] = 3
+    f.attrs["numSeqs"] = 2
+    f.attrs["numTimesteps"] = 7
+    f.create_dataset("inputs", data=numpy.ones((7, 2), dtype="float32"))
+    f.create_dataset("seqLengths", data=numpy.array([4, 3], dtype="int32"))
+    f.create_dataset("seqTags", data=numpy.array([b"seq-0", b"seq-1"], dtype="S5"))
+    f.create_dataset("labels", data=numpy.array([b"a", b"b", b"c"], dtype="S1"))
+  dataset = HDFDataset()
+  dataset.add_file(filename)
+  dataset.initialize()
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, dataset.num_seqs)
+  assert_equal(dataset.get_targets("classes", 0).tolist(), [0] * 4)
+  assert_equal(dataset.get_targets("classes", 1).tolist(), [0] * 3)
+  os.remove(filename)
+
+
+def test_hdf_bucket_boundaries():
+  sys.path += ["tools"]
+  import tempfile
+  import numpy
+  from hdf_dump import hdf_dataset_init, hdf_dump_from_dataset, hdf_close
+  from GeneratingDataset import StaticDataset
+  from Util import DictAsObj
+  from Log import log
+  log.initialize()
+  rnd = numpy.random.RandomState(42)
+  data = []
+  for _ in range(200):
+    seq_len = rnd.randint(1, 100)
+    data.append({"data": rnd.normal(size=(seq_len, 2)).astype("float32"),
+                 "classes": rnd.randint(0, 3, size=(seq_len,)).astype("int32")})
+  static_dataset = StaticDataset(data=data, output_dim={"data": [2, 2], "classes": [3, 1]})
+  static_dataset.init_seq_order(epoch=1)
+  filename = tempfile.mktemp(suffix=".hdf", prefix="nose-hdf-dataset")
+  hdf_dataset = hdf_dataset_init(filename)
+  hdf_dump_from_dataset(static_dataset, hdf_dataset, DictAsObj({"epoch": 1, "start_seq": 0, "end_seq": float("inf")}))
+  hdf_close(hdf_dataset)
+
+  bucket_boundaries = [20, 40, 70]
+  dataset = HDFDataset(seq_ordering="random", cache_byte_size=-1)  # buckets need a fully cached dataset
+  dataset.add_file(filename)
+  dataset.initialize()
+  assert dataset.is_fully_cached()
+  ds_ref = HDFDataset(seq_ordering="random", cache_byte_size=-1)
+  ds_ref.add_file(filename)
+  ds_ref.initialize()
+  ds_ref.init_seq_order(epoch=1)
+  ds_ref.load_seqs(0, ds_ref.num_seqs)
+  padding_ratios = []
+  for kwargs in [{}, {"bucket_boundaries": bucket_boundaries}]:
+    dataset.init_seq_order(epoch=1)
+    batch_gen = dataset.generate_batches(recurrent_net=True, batch_size=300, max_seqs=10, **kwargs)
+    seq_idxs = []
+    while batch_gen.has_more():
+      batch, = batch_gen.peek_next_n(1)
+      batch_seq_idxs = [seq.seq_idx for seq in batch.seqs]
+      lens = [dataset.get_seq_length(seq_idx)["data"] for seq_idx in batch_seq_idxs]
+      assert len(batch_seq_idxs) <= 10
+      assert len(batch_seq_idxs) == 1 or max(lens) * len(lens) <= 300
+      if kwargs:
+        assert_equal(len(set(numpy.searchsorted(bucket_boundaries, lens))), 1)
+        # Only the seqs of the batch are loaded, not all in between.
+        for start, end in batch.get_seq_ranges():
+          dataset.load_seqs(start, end)
+        num_cached = len([i for i in range(dataset.num_seqs) if dataset.is_cached(i, i + 1)])
+        assert_equal(num_cached, len(seq_idxs) + len(batch_seq_idxs))
+        for seq_idx in batch_seq_idxs:
+          assert_equal(dataset.get_data(seq_idx, "data").tolist(), ds_ref.get_data(seq_idx, "data").tolist())
+      seq_idxs += batch_seq_idxs
+      batch_gen.advance(1)
+      if kwargs:
+        # The buckets jump around in the seq order, thus this counts the seqs.
+        assert_equal(batch_gen.completed_frac(), float(len(seq_idxs)) / dataset.num_seqs)
+    assert_equal(sorted(seq_idxs), list(range(dataset.num_seqs)))
+    padding_ratios.append(batch_gen.get_padding_ratio())
+  print("padding ratios without/with buckets:", padding_ratios)
+  assert 0 < padding_ratios[1] < padding_ratios[0]
+  # Without the full cache, loading non-consecutive seqs would evict the others.
+  dataset = HDFDataset(seq_ordering="random")
+  dataset.add_file(filename)
+  dataset.initialize()
+  assert not dataset.is_fully_cached()
+  dataset.init_seq_order(epoch=1)
+  batch_gen = dataset.generate_batches(
+    recurrent_net=True, batch_size=300, max_seqs=10, bucket_boundaries=bucket_boundaries)
+  try:
+    batch_gen.has_more()
+  except Exception as exc:
+    assert "fully cached" in str(exc)
+  else:
+    assert False, "expected an exception"
+  os.remove(filename)
+
+
+def test_hdf_sort_window():
+  sys.path += ["tools"]
+  import tempfile
+  import numpy
+  from hdf_dump import hdf_dataset_init, hdf_dump_from_dataset, hdf_close
+  from GeneratingDataset import StaticDataset
+  from Util import DictAsObj
+  from Log import log
+  log.initialize()
+  rnd = numpy.random.RandomState(42)
+  data = []
+  for _ in range(100):
+    seq_len = rnd.randint(1, 100)
+    data.append({"data": rnd.normal(size=(seq_len, 2)).astype("float32"),
+                 "classes": rnd.randint(0, 3, size=(seq_len,)).astype("int32")})
+  static_dataset = StaticDataset(data=data, output_dim={"data": [2, 2], "classes": [3, 1]})
+  static_dataset.init_seq_order(epoch=1)
+  filename = tempfile.mktemp(suffix=".hdf", prefix="nose-hdf-dataset")
+  hdf_dataset = hdf_dataset_init(filename)
+  hdf_dump_from_dataset(static_dataset, hdf_dataset, DictAsObj({"epoch": 1, "start_seq": 0, "end_seq": float("inf")}))
+  hdf_close(hdf_dataset)
+
+  sort_window = 30
+  dataset = HDFDataset(cache_byte_size=-1)  # the seqs of a batch are not consecutive, this needs the full cache
+  dataset.add_file(filename)
+  dataset.initialize()
+  padding_ratios = []
+  for kwargs in [{}, {"sort_window": sort_window}]:
+    dataset.init_seq_order(epoch=1)
+    batch_gen = dataset.generate_batches(recurrent_net=True, batch_size=300, max_seqs=10, **kwargs)
+    seq_idxs = []
+    while batch_gen.has_more():
+      batch, = batch_gen.peek_next_n(1)
+      batch_seq_idxs = [seq.seq_idx for seq in batch.seqs]
+      lens = [dataset.get_seq_length(seq_idx)["data"] for seq_idx in batch_seq_idxs]
+      assert len(batch_seq_idxs) <= 10
+      assert len(batch_seq_idxs) == 1 or max(lens) * len(lens) <= 300
+      if kwargs:
+        # All seqs of a batch are from one window, and the windows come in order.
+        assert_equal(len(set([seq_idx // sort_window for seq_idx in batch_seq_idxs])), 1)
+        if seq_idxs:
+          assert seq_idxs[-1] // sort_window <= batch_seq_idxs[0] // sort_window
+        assert_equal(lens, sorted(lens))
+      seq_idxs += batch_seq_idxs
+      batch_gen.advance(1)
+    assert_equal(sorted(seq_idxs), list(range(dataset.num_seqs)))
+    assert_equal(batch_gen.num_seqs_advanced, dataset.num_seqs)
+    padding_ratios.append(batch_gen.get_padding_ratio())
+  print("padding ratios without/with sort window:", padding_ratios)
+  assert 0 < padding_ratios[1] < padding_ratios[0]
+  os.remove(filename)
+
+
+def test_BufferedHDFWriter():
+  import tempfile
+  import numpy
+  from HDFDataset import BufferedHDFWriter
+  from Log import log
+  log.initialize()
+  rnd = numpy.random.RandomState(42)
+  batches = []
+  for _ in range(7):
+    seq_len = rnd.randint(1, 20, size=(3,))
+    inputs = rnd.normal(size=(3, max(seq_len), 4)).astype("float32")
+    batches.append((inputs, seq_len, ["seq-%i" % (len(batches) * 3 + i) for i in range(3)]))
+  for opts in [{"background": False}, {"background": True, "compression": "gzip"}]:
+    filename = tempfile.mktemp(suffix=".hdf", prefix="nose-hdf-writer")
+    # Small blocks and chunks, such that we write and grow multiple times.
+    writer = BufferedHDFWriter(
+      filename=filename, dim=4, input_patt_size=2, num_labels=4, labels=["a", "b", "c", "d"],
+      block_num_frames=20, chunk_num_frames=8, **opts)
+    for inputs, seq_len, seq_tag in batches:
+      writer.insert_batch(inputs=inputs, seq_len=seq_len, seq_tag=seq_tag)
+    writer.close()
+    dataset = HDFDataset()
+    dataset.add_file(filename)
+    dataset.initialize()
+    dataset.init_seq_order(epoch=1)
+    assert_equal(dataset.num_seqs, 7 * 3)
+    assert_equal(dataset.get_num_timesteps(), sum([sum(seq_len) for (_, seq_len, _) in batches]))
+    assert_equal(dataset.num_inputs, 4)
+    assert_equal(dataset.labels["classes"], ["a", "b", "c", "d"])
+    dataset.load_seqs(0, dataset.num_seqs)
+    for seq_idx in range(dataset.num_seqs):
+      inputs, seq_len, seq_tag = batches[seq_idx // 3]
+      assert_equal(dataset.get_tag(seq_idx), seq_tag[seq_idx % 3])
+      assert_equal(dataset.get_data(seq_idx, "data").tolist(), inputs[seq_idx % 3, :seq_len[seq_idx % 3]].tolist())
+    os.remove(filename)
+
+
+def test_hdf_load_seqs_with_gaps():
+  from Log import log
+  log.initialize()
+  filename = generate_hdf_from_dummy(num_seqs=7, seq_len=5)
+  ds_ref = HDFDataset(cache_byte_size=-1)
+  ds_ref.add_file(filename)
+  ds_ref.initialize()
+  ds_ref.init_seq_order(epoch=1)
+  ds_ref.load_seqs(0, ds_ref.num_seqs)
+  dataset = HDFDataset(cache_byte_size=-1)
+  dataset.add_file(filename)
+  dataset.initialize()
+  dataset.init_seq_order(epoch=1)
+  # (1,2) fills the gap between two loaded intervals, (4,5) is directly before a loaded interval.
+  for start, end in [(0, 1), (2, 3), (1, 2), (5, 7), (4, 5)]:
+    dataset.load_seqs(start, end)
+  for seq_idx in [0, 1, 2, 4, 5, 6]:
+    assert dataset.is_cached(seq_idx, seq_idx + 1)
+    assert_equal(dataset.get_data(seq_idx, "data").tolist(), ds_ref.get_data(seq_idx, "data").tolist())
+  os.remove(filename)
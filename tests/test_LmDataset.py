@@ -0,0 +1,179 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+
+from nose.tools import assert_equal, assert_is_instance
+from LmDataset import LmDataset, MmapTxtLines
+import numpy as np
+import tempfile
+import os
+
+
+def _make_char_corpus(lines):
+  """
+  :param list[str] lines:
+  :return: corpus filename, orth symbols filename
+  :rtype: (str, str)
+  """
+  corpus_fn = tempfile.mktemp(suffix=".txt", prefix="nose-lm-corpus")
+  with open(corpus_fn, "w") as f:
+    f.write("\n".join(lines))
+  symbols_fn = tempfile.mktemp(suffix=".txt", prefix="nose-lm-symbols")
+  with open(symbols_fn, "w") as f:
+    f.write("\n".join(["[END]", " "] + sorted(set("".join(lines)) - {" "})))
+  return corpus_fn, symbols_fn
+
+
+def _get_all_seqs(dataset, epoch):
+  """
+  :param LmDataset dataset:
+  :param int epoch:
+  :rtype: list[list[int]]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  seqs = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seqs.append(dataset.get_data(seq_idx, "data").tolist())
+    seq_idx += 1
+  return seqs
+
+
+def test_MmapTxtLines():
+  from Log import log
+  log.initialize()
+  corpus_fn, symbols_fn = _make_char_corpus(["hello world", "", "  ", "foo\r", "bar"])
+  lines = MmapTxtLines([corpus_fn, corpus_fn])
+  assert_equal(len(lines), 6)  # empty and whitespace-only lines are not in the index, like in _iter_txt()
+  assert_equal([lines[i] for i in range(3)], ["hello world", "foo", "bar"])
+  sub_lines = lines[1:4]
+  assert_is_instance(sub_lines, MmapTxtLines)
+  assert_equal([sub_lines[i] for i in range(len(sub_lines))], ["foo", "bar", "hello world"])
+  assert_equal(sub_lines.get_byte_len(0), len("foo\r"))
+  # Lines across chunk boundaries.
+  from LmDataset import read_txt_line_index
+  assert_equal([x.tolist() for x in read_txt_line_index(corpus_fn, chunk_size=3)],
+               [x.tolist() for x in read_txt_line_index(corpus_fn)])
+  os.remove(corpus_fn)
+  os.remove(symbols_fn)
+
+
+def test_LmDataset_streaming():
+  import shutil
+  from Log import log
+  log.initialize()
+  rnd = np.random.RandomState(42)
+  # Also some empty and whitespace-only lines, which are skipped.
+  lines = ["".join(rnd.choice(list("abc d"), size=rnd.randint(0, 20))) for _ in range(50)] + ["  ", "\r", ""]
+  corpus_fn, symbols_fn = _make_char_corpus(lines)
+  index_cache_dir = tempfile.mkdtemp(prefix="nose-lm-index")
+  opts = dict(
+    corpus_file=[corpus_fn, corpus_fn], orth_symbols_file=symbols_fn, partition_epoch=3, seq_ordering="random")
+  dataset = LmDataset(**opts)
+  for _ in range(2):  # second time, the line index cache is used
+    streaming_dataset = LmDataset(streaming=True, index_cache_dir=index_cache_dir, **opts)
+    assert_equal(len(os.listdir(index_cache_dir)), 1)
+    assert_equal(len(streaming_dataset.orths), len(dataset.orths))
+    for epoch in [1, 2, 3]:
+      assert_equal(_get_all_seqs(streaming_dataset, epoch=epoch), _get_all_seqs(dataset, epoch=epoch))
+  shutil.rmtree(index_cache_dir)
+  os.remove(corpus_fn)
+  os.remove(symbols_fn)
+
+
+def _encode_orth_reference(orth, orth_symbols_map, orth_replace_map, unknown_symbol, auto_replace_unknown_symbol):
+  """
+  Encodes one orth symbol by symbol, like LmDataset did it before there was the OrthSymbolsEncoder.
+
+  :rtype: list[int]|None
+  """
+  from Util import parse_orthography
+  orth_syms = parse_orthography(orth)
+  while True:
+    orth_syms = sum([orth_replace_map.get(s, [s]) for s in orth_syms], [])
+    i = 0
+    while i < len(orth_syms) - 1:
+      if orth_syms[i:i+2] == [" ", " "]:
+        orth_syms[i:i+2] = [" "]  # collapse two spaces
+      else:
+        i += 1
+    if auto_replace_unknown_symbol:
+      unknown_syms = [s for s in orth_syms if s not in orth_symbols_map]
+      if unknown_syms:
+        orth_replace_map[unknown_syms[0]] = [unknown_symbol] if unknown_symbol is not None else []
+        continue  # try this seq again with updated orth_replace_map
+    break
+  if any([s not in orth_symbols_map for s in orth_syms]):
+    return None
+  return [orth_symbols_map[s] for s in orth_syms]
+
+
+def test_OrthSymbolsEncoder():
+  from LmDataset import OrthSymbolsEncoder
+  orths = [u"hello  world", u"h\xe4llo (world) [noise] x", u"", u"xyz", u"abc [UNK]", u"z z  z", u"e \u20ac", u"a [[b]] c [d"]
+  symbols = ["[END]", "[UNKNOWN]", "[NOISE]", " "] + list(u"abcdehlorw\xe4")
+  orth_symbols_map = {sym: i for (i, sym) in enumerate(symbols)}
+  for unknown_symbol in ["[UNKNOWN]", None]:
+    for auto_replace_unknown_symbol in [False, True]:
+      orth_replace_map = {u"w": [u"w", u" ", u" "], u"z": [u" "]}
+      ref_orth_replace_map = dict(orth_replace_map)
+      encoder = OrthSymbolsEncoder(
+        orth_symbols_map=orth_symbols_map, orth_replace_map=orth_replace_map, unknown_symbol=unknown_symbol,
+        auto_replace_unknown_symbol=auto_replace_unknown_symbol)
+      res = encoder.encode_batch(orths)
+      assert_equal(len(res), len(orths))
+      for orth, seq in zip(orths, res):
+        ref_seq = _encode_orth_reference(
+          orth, orth_symbols_map=orth_symbols_map, orth_replace_map=ref_orth_replace_map,
+          unknown_symbol=unknown_symbol, auto_replace_unknown_symbol=auto_replace_unknown_symbol)
+        if ref_seq is None:
+          assert not isinstance(seq, np.ndarray), "orth %r: expected to be skipped, got %r" % (orth, seq)
+        else:
+          assert_is_instance(seq, np.ndarray)
+          assert_equal(seq.tolist(), ref_seq, "orth %r" % orth)
+      assert_equal(encoder.encode_batch([orths[0]])[0].tolist(), res[0].tolist())  # cached tables
+      if auto_replace_unknown_symbol:
+        assert_equal(sorted(encoder.auto_replaced_symbols), [u"[D", u"[UNK]", u"[[B]]", u"x", u"y", u"\u20ac"])
+
+
+def test_TranslationDataset_cache():
+  import pickle
+  import shutil
+  import time
+  from LmDataset import TranslationDataset
+  from Log import log
+  log.initialize()
+  path = tempfile.mkdtemp(prefix="nose-translation-dataset")
+  cache_dir = tempfile.mkdtemp(prefix="nose-translation-cache")
+  vocab = {w: i for (i, w) in enumerate(["</S>", "a", "b", "c", "x", "y"])}
+  for prefix, lines in [("source", ["a b c", "c", "b a"]), ("target", ["x", "y y x", "x y"])]:
+    with open("%s/%s.train" % (path, prefix), "w") as f:
+      f.write("\n".join(lines) + "\n")
+    with open("%s/%s.vocab.pkl" % (path, prefix), "wb") as f:
+      pickle.dump(vocab, f)
+  seqs = []
+  for _ in range(2):  # second time, the cache is used
+    dataset = TranslationDataset(path=path, file_postfix="train", target_postfix=" </S>", cache_dir=cache_dir)
+    if dataset._thread:
+      dataset._thread.join()
+    else:
+      assert dataset._cache
+    dataset.init_seq_order(epoch=1)
+    dataset.load_seqs(0, 3)
+    seqs.append([
+      (dataset.get_data(i, "data").tolist(), dataset.get_data(i, "classes").tolist()) for i in range(dataset.num_seqs)])
+    assert_equal(len(os.listdir(cache_dir)), 1)
+  assert_equal(seqs[0], [([1, 2, 3], [4, 0]), ([3], [5, 5, 4, 0]), ([2, 1], [4, 5, 0])])
+  assert_equal(seqs[0], seqs[1])
+  time.sleep(1)  # such that the mtime changes
+  with open("%s/source.train" % path, "a") as f:
+    f.write("a\n")
+  with open("%s/target.train" % path, "a") as f:
+    f.write("y\n")
+  dataset = TranslationDataset(path=path, file_postfix="train", cache_dir=cache_dir)
+  assert dataset._thread  # cache not valid anymore
+  dataset._thread.join()
+  assert_equal(len(os.listdir(cache_dir)), 2)
+  shutil.rmtree(path)
+  shutil.rmtree(cache_dir)
@@ -0,0 +1,173 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+sys.path += ["tests"]
+
+from nose.tools import assert_equal, assert_not_equal
+from MetaDataset import MetaDataset, CombinedDataset
+from test_HDFDataset import generate_hdf_from_dummy
+import tempfile
+import os
+
+
+def _get_all_seqs(dataset, epoch, keys):
+  """
+  :param Dataset.Dataset dataset:
+  :param int epoch:
+  :param list[str] keys:
+  :rtype: list[(str,dict[str,list])]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  seqs = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 2)
+    seqs.append((dataset.get_tag(seq_idx), {key: dataset.get_data(seq_idx, key).tolist() for key in keys}))
+    seq_idx += 1
+  return seqs
+
+
+def test_MetaDataset_parallel_load():
+  from Log import log
+  log.initialize()
+  filenames = [generate_hdf_from_dummy(num_seqs=7, seq_len=5), generate_hdf_from_dummy(num_seqs=7, seq_len=3)]
+  seq_list_file = tempfile.mktemp(suffix=".txt", prefix="nose-meta-seq-list")
+  with open(seq_list_file, "w") as f:
+    f.write("\n".join(["seq-%i" % i for i in range(7)]))
+  results = []
+  for opts in [{}, {"parallel_load": True}, {"parallel_load": True, "load_read_ahead": 3}]:
+    dataset = MetaDataset(
+      seq_list_file=seq_list_file, seq_lens_file=None,
+      datasets={"a": {"class": "HDFDataset", "files": [filenames[0]]},
+                "b": {"class": "HDFDataset", "files": [filenames[1]]}},
+      data_map={"data": ("a", "data"), "classes": ("b", "classes")},
+      data_dims={"data": [2, 2], "classes": [3, 1]},
+      seq_ordering="random", **opts)
+    results.append([_get_all_seqs(dataset, epoch=epoch, keys=["data", "classes"]) for epoch in [1, 2]])
+    assert_equal(sorted(dataset.sub_datasets_loader.load_time.keys()), ["a", "b"])
+    assert dataset.sub_datasets_loader.wait_time > 0
+  assert_equal(len(results[0][0]), 7)
+  assert_equal([len(data["data"]) for (tag, data) in results[0][0]], [5] * 7)
+  assert_equal([len(data["classes"]) for (tag, data) in results[0][0]], [3] * 7)
+  assert_equal(results[0], results[1])
+  assert_equal(results[0], results[2])
+  os.remove(seq_list_file)
+  for fn in filenames:
+    os.remove(fn)
+
+
+def test_CombinedDataset_parallel_load():
+  from Log import log
+  log.initialize()
+  filenames = [generate_hdf_from_dummy(num_seqs=7, seq_len=5), generate_hdf_from_dummy(num_seqs=4, seq_len=3)]
+  results = []
+  for opts in [{}, {"parallel_load": True, "load_read_ahead": 3}]:
+    dataset = CombinedDataset(
+      datasets={"a": {"class": "HDFDataset", "files": [filenames[0]]},
+                "b": {"class": "HDFDataset", "files": [filenames[1]]}},
+      data_map={("a", "data"): "data", ("a", "classes"): "classes", ("b", "data"): "data"},
+      data_dims={"data": [2, 2], "classes": [3, 1]},
+      seq_ordering="in-order", **opts)
+    results.append(_get_all_seqs(dataset, epoch=1, keys=["data", "classes"]))
+    assert dataset.sub_datasets_loader.load_time["b"] > 0
+  assert_equal(len(results[0]), 11)
+  assert_equal([len(data["data"]) for (tag, data) in results[0]], [5] * 7 + [3] * 4)
+  assert_equal(results[0], results[1])
+  for fn in filenames:
+    os.remove(fn)
+
+
+def test_SubDatasetsLoader_threads_do_not_keep_it_alive():
+  import gc
+  import time
+  import weakref
+  from GeneratingDataset import DummyDataset
+  from MetaDataset import SubDatasetsLoader
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=5)
+  dataset.init_seq_order(epoch=1)
+  loader = SubDatasetsLoader({"a": dataset}, parallel=True)
+  loader.load_seqs({"a": (0, 2)})
+  thread = loader._workers["a"].thread
+  loader_ref = weakref.ref(loader)
+  del loader
+  for _ in range(100):  # a thread might briefly hold a reference while it checks for work
+    gc.collect()
+    if loader_ref() is None:
+      break
+    time.sleep(0.1)
+  assert loader_ref() is None
+  thread.join(10)
+  assert not thread.is_alive()
+
+
+def test_MetaDataset_tag_index():
+  from Log import log
+  from HDFDataset import HDFDataset
+  log.initialize()
+  filename = generate_hdf_from_dummy(num_seqs=7, seq_len=5)
+  ds_ref = HDFDataset()
+  ds_ref.add_file(filename)
+  ds_ref.initialize()
+  ds_ref.init_seq_order(epoch=1)
+  ds_ref.load_seqs(0, ds_ref.num_seqs)
+  ref = {ds_ref.get_tag(i): ds_ref.get_data(i, "data").tolist() for i in range(ds_ref.num_seqs)}
+  seq_list_file = tempfile.mktemp(suffix=".txt", prefix="nose-meta-seq-list")
+  tag_index_file = tempfile.mktemp(suffix=".npz", prefix="nose-meta-tag-index")
+  # CachedDataset always covers all its seqs, thus we use different permutations of all seqs.
+  for seq_list in [["seq-%i" % i for i in [5, 2, 6, 0, 1, 4, 3]], ["seq-%i" % i for i in [1, 3, 0, 2, 4, 6, 5]]]:
+    with open(seq_list_file, "w") as f:
+      f.write("\n".join(seq_list))
+    for _ in range(2):  # second time, the tag index is loaded from the file
+      dataset = MetaDataset(
+        seq_list_file=seq_list_file, seq_lens_file=None,
+        datasets={"a": {"class": "HDFDataset", "files": [filename]}},
+        data_map={"data": ("a", "data"), "classes": ("a", "classes")},
+        data_dims={"data": [2, 2], "classes": [3, 1]},
+        seq_ordering="random", tag_index_file=tag_index_file)
+      seqs = [_get_all_seqs(dataset, epoch=epoch, keys=["data"]) for epoch in [1, 2]]
+      assert os.path.exists(tag_index_file)
+      assert_equal(dataset._get_tag_index()["a"].tolist(), [int(tag[len("seq-"):]) for tag in seq_list])
+      for epoch_seqs in seqs:
+        assert_equal(sorted([tag for (tag, data) in epoch_seqs]), sorted(seq_list))
+        for tag, data in epoch_seqs:
+          assert_equal(data["data"], ref[tag])
+  os.remove(seq_list_file)
+  os.remove(tag_index_file)
+  os.remove(filename)
+
+
+def test_ChunkShuffleDataset_chunk_buffer():
+  import numpy
+  import shutil
+  from MetaDataset import ChunkShuffleDataset
+  from Log import log
+  log.initialize()
+  rnd = numpy.random.RandomState(42)
+  data = []
+  for _ in range(20):
+    seq_len = rnd.randint(10, 30)
+    data.append({"data": rnd.normal(size=(seq_len, 2)).astype("float32"),
+                 "classes": rnd.randint(0, 3, size=(seq_len,)).astype("int32")})
+  mmap_dir = tempfile.mkdtemp(prefix="nose-chunk-buffer")
+  results = []
+  datasets = []
+  for opts in [{}, {"chunk_buffer_num_frames": 10000},
+               {"chunk_buffer_num_frames": 50}, {"chunk_buffer_num_frames": 50, "chunk_buffer_mmap_dir": mmap_dir}]:
+    dataset = ChunkShuffleDataset(
+      dataset={"class": "StaticDataset", "data": data, "output_dim": {"data": [2, 2], "classes": [3, 1]},
+               "chunking": "10:5"},
+      chunk_shuffle_cache=20, **opts)
+    results.append([_get_all_seqs(dataset, epoch=epoch, keys=["data", "classes"]) for epoch in [1, 2]])
+    datasets.append(dataset)
+  assert_equal(results[0], results[1])  # buffer never full, so same behavior as without buffer
+  assert_equal(results[2], results[3])
+  assert_equal(datasets[1].chunk_buffer.num_grow, 0)
+  assert_equal(datasets[2].chunk_buffer.num_grow, 0)
+  assert_equal(datasets[2].chunk_buffer.num_frames, 50)  # memory stays bounded
+  assert datasets[2].chunk_buffer.num_compact > 0
+  for epoch in range(2):
+    # All chunks are there in both cases, but the smaller buffer shuffles less.
+    chunks_ref = sorted([data["data"] for (tag, data) in results[0][epoch]])
+    assert_equal(sorted([data["data"] for (tag, data) in results[2][epoch]]), chunks_ref)
+    assert_not_equal([tag for (tag, data) in results[0][epoch]], [tag for (tag, data) in results[2][epoch]])
+  shutil.rmtree(mmap_dir)
@@ -0,0 +1,104 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+
+from nose.tools import assert_equal
+from RawWavDataset import RawWavDataset, _frameTimeSignal, _readWavFile
+import numpy
+import tempfile
+import shutil
+import os
+
+
+def _frame_time_signal_reference(time_signal, frame_length, frame_shift):
+  """
+  The original per-frame loop, with zero padding of the last frame.
+  """
+  nr_of_frames = int(numpy.ceil((float(time_signal.shape[0] - frame_length) / frame_shift) + 1))
+  pad_length = (nr_of_frames - 1) * frame_shift + frame_length - time_signal.shape[0]
+  time_signal_pad = numpy.zeros((time_signal.shape[0] + pad_length,))
+  time_signal_pad[0:time_signal.shape[0]] = time_signal
+  frames = numpy.zeros((nr_of_frames, frame_length), dtype="float32")
+  for i in range(nr_of_frames):
+    frames[i, :] = time_signal_pad[i * frame_shift:(i * frame_shift + frame_length)]
+  return frames
+
+
+def test_frameTimeSignal():
+  time_signal = numpy.arange(23, dtype="float32")
+  for frame_length, frame_shift in [(5, 2), (4, 4), (23, 1), (8, 3)]:
+    frames = _frameTimeSignal(time_signal, frame_length, frame_shift)
+    assert_equal(frames.tolist(), _frame_time_signal_reference(time_signal, frame_length, frame_shift).tolist())
+
+
+def _make_wav_files(tmp_dir, num_files=6):
+  """
+  :param str tmp_dir:
+  :param int num_files:
+  :return: list file
+  :rtype: str
+  """
+  import scipy.io.wavfile
+  rnd = numpy.random.RandomState(42)
+  filenames = []
+  for i in range(num_files):
+    filename = os.path.join(tmp_dir, "%i.wav" % i)
+    signal = rnd.randint(-2 ** 15, 2 ** 15, size=(rnd.randint(200, 1000),)).astype("int16")
+    scipy.io.wavfile.write(filename, 16000, signal)
+    filenames.append(filename)
+  list_file = os.path.join(tmp_dir, "wav-list.txt")
+  with open(list_file, "w") as f:
+    f.write("\n".join(filenames) + "\n")
+  return list_file
+
+
+def _get_all_seqs(dataset, epoch):
+  """
+  :param RawWavDataset dataset:
+  :param int epoch:
+  :rtype: list[list[list[float]]]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  seqs = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seqs.append(dataset.get_data(seq_idx, "data").tolist())
+    seq_idx += 1
+  return seqs
+
+
+def test_RawWavDataset_streaming():
+  from Log import log
+  log.initialize()
+  tmp_dir = tempfile.mkdtemp(prefix="nose-raw-wav")
+  list_file = _make_wav_files(tmp_dir)
+  results = []
+  datasets = []
+  for opts in [{}, {"streaming": True}, {"streaming": True, "numDecodeWorkers": 0},
+               {"streaming": True, "cacheByteSize": 4000}]:
+    dataset = RawWavDataset(listFile=list_file, frameLength=160, frameShift=80, num_outputs=1, **opts)
+    results.append([_get_all_seqs(dataset, epoch=epoch) for epoch in [1, 2]])
+    datasets.append(dataset)
+  assert_equal(len(results[0][0]), 6)
+  for res in results[1:]:
+    assert_equal(res, results[0])
+  assert_equal(len(datasets[1]._decodedCache), 6)
+  # A new epoch after a partial one must not keep the read-ahead of the old seq order.
+  dataset = RawWavDataset(
+    listFile=list_file, frameLength=160, frameShift=80, num_outputs=1, streaming=True, cacheByteSize=0)
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, 1)
+  assert dataset._decodePending
+  dataset.init_seq_order(epoch=2)
+  assert_equal(dataset._decodePending, {})
+  assert_equal(len(dataset._decodedCache), 1)
+  # A failed decode of the read-ahead does not make the next init_seq_order() fail.
+  failed = dataset._decodePool.apply_async(_readWavFile, (os.path.join(tmp_dir, "missing.wav"),))
+  failed.wait()
+  dataset._decodePending[5] = failed
+  dataset.init_seq_order(epoch=3)
+  assert_equal(dataset._decodePending, {})
+  assert datasets[3]._decodedCacheBytes <= 4000 or len(datasets[3]._decodedCache) == 1
+  assert len(datasets[3]._decodedCache) < 6
+  shutil.rmtree(tmp_dir)
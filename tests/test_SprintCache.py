@@ -0,0 +1,164 @@
+
+import sys
+sys.path += ["."]  # Python 3 hack
+
+from nose.tools import assert_equal
+import numpy
+import os
+import tempfile
+from SprintCache import FileArchive, open_file_archive
+import better_exchook
+better_exchook.install()
+
+
+def make_allophone_file(num_allophones=10):
+  """
+  :return: filename of a temporary allophone file
+  :rtype: str
+  """
+  fn = tempfile.mktemp(suffix=".txt", prefix="nose-sprint-allophones")
+  with open(fn, "w") as f:
+    f.write("# allophones\n")
+    for i in range(num_allophones - 1):
+      f.write("a%i{#+#}\n" % i)
+    f.write("si{#+#}@i@f\n")
+  return fn
+
+
+def generate_sprint_cache(feats, mixtures):
+  """
+  :param dict[str,numpy.ndarray] feats: seq name -> (time,dim)
+  :param dict[str,list[int]] mixtures: seq name -> alignment
+  :return: filenames of the feature cache and the alignment cache
+  :rtype: (str, str)
+  """
+  feat_fn = tempfile.mktemp(suffix=".cache", prefix="nose-sprint-feat")
+  archive = FileArchive(feat_fn, must_exists=False)
+  for name, feat in sorted(feats.items()):
+    archive.addFeatureCache(name, feat, [(0.01 * t, 0.01 * (t + 1)) for t in range(len(feat))])
+  archive.finalize()
+  del archive
+  align_fn = tempfile.mktemp(suffix=".cache", prefix="nose-sprint-align")
+  archive = FileArchive(align_fn, must_exists=False)
+  for name, alignment in sorted(mixtures.items()):
+    archive.addAlignmentCache(name, alignment)
+  archive.finalize()
+  del archive
+  return feat_fn, align_fn
+
+
+def test_read_numpy():
+  rnd = numpy.random.RandomState(42)
+  num_allophones = 10
+  feats, mixtures = {}, {}
+  for i, seq_len in enumerate([7, 1, 23, 300]):
+    name = "corpus/seq-%i/1" % i
+    feats[name] = rnd.normal(size=(seq_len, 3)).astype("float32")
+    # Some runs of repeated states, and some single values.
+    alignment = []
+    while len(alignment) < seq_len:
+      mix = rnd.randint(0, num_allophones) + rnd.randint(0, 3) * (1 << 26)
+      alignment += [mix] * rnd.choice([1, 1, 2, 5, 200])
+    mixtures[name] = alignment[:seq_len]
+  allophone_fn = make_allophone_file(num_allophones)
+  feat_fn, align_fn = generate_sprint_cache(feats, mixtures)
+  feat_cache = open_file_archive(feat_fn)
+  align_cache = open_file_archive(align_fn)
+  align_cache.setAllophones(allophone_fn)
+  for name in sorted(feats.keys()):
+    times, feat = feat_cache.read_numpy(name, "feat")
+    ref_times, ref_feat = feat_cache.read(name, "feat")
+    assert_equal(feat.dtype, numpy.float32)
+    assert feat.flags.c_contiguous
+    numpy.testing.assert_equal(feat, feats[name])
+    numpy.testing.assert_equal(feat, numpy.array(ref_feat))
+    numpy.testing.assert_equal(times, numpy.array(ref_times))
+    times, allophones, states = align_cache.read_numpy(name, "align")
+    ref_alignment = align_cache.read(name, "align")
+    assert_equal(list(zip(times.tolist(), allophones.tolist(), states.tolist())), ref_alignment)
+    times, raw_mixtures, states = align_cache.read_numpy(name, "align_raw")
+    assert states is None
+    assert_equal(raw_mixtures.tolist(), mixtures[name])
+    assert_equal(times.tolist(), list(range(len(mixtures[name]))))
+  del feat_cache, align_cache
+  for fn in [allophone_fn, feat_fn, align_fn]:
+    os.remove(fn)
+
+
+def test_bundle_concurrent_read():
+  import shutil
+  from threading import Thread
+  rnd = numpy.random.RandomState(42)
+  tmp_dir = tempfile.mkdtemp(prefix="nose-sprint-bundle")
+  feats = {}
+  bundle_fn = "%s/feat.bundle" % tmp_dir
+  with open(bundle_fn, "w") as bundle_f:
+    for i in range(6):
+      archive_fn = "%s/feat.%i.cache" % (tmp_dir, i)
+      archive = FileArchive(archive_fn, must_exists=False)
+      for j in range(5):
+        name = "corpus/seq-%i-%i/1" % (i, j)
+        feats[name] = rnd.normal(size=(rnd.randint(1, 50), 3)).astype("float32")
+        archive.addFeatureCache(name, feats[name], [(0.01 * t, 0.01 * (t + 1)) for t in range(len(feats[name]))])
+      archive.finalize()
+      del archive
+      bundle_f.write("%s\n" % archive_fn)
+  for use_mmap in [False, True]:
+    bundle = open_file_archive(bundle_fn, use_mmap=use_mmap, max_open_archives=2)
+    assert_equal(bundle.get_num_open_archives(), 0)  # opened on demand
+    errors = []
+
+    def reader(thread_idx):
+      try:
+        names = sorted(feats.keys())
+        numpy.random.RandomState(thread_idx).shuffle(names)
+        for _ in range(3):
+          for name in names:
+            times, feat = bundle.read_numpy(name, "feat")
+            numpy.testing.assert_equal(feat, feats[name])
+            times, feat = bundle.read(name, "feat")
+            numpy.testing.assert_equal(numpy.array(feat), feats[name])
+      except Exception as exc:
+        errors.append(exc)
+        raise
+
+    threads = [Thread(target=reader, args=(i,)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert_equal(errors, [])
+    assert bundle.get_num_open_archives() <= 2 + len(threads)
+  shutil.rmtree(tmp_dir)
+
+
+def test_bundle_index_cache_dir():
+  import shutil
+  tmp_dir = tempfile.mkdtemp(prefix="nose-sprint-bundle")
+  index_cache_dir = "%s/index" % tmp_dir
+  feats = {}
+  bundle_fn = "%s/feat.bundle" % tmp_dir
+  with open(bundle_fn, "w") as bundle_f:
+    for i in range(3):
+      archive_fn = "%s/feat.%i.cache" % (tmp_dir, i)
+      archive = FileArchive(archive_fn, must_exists=False)
+      for j in range(2):
+        name = "corpus/seq-%i-%i/1" % (i, j)
+        feats[name] = numpy.full((j + 2, 3), i * 10 + j, dtype="float32")
+        archive.addFeatureCache(name, feats[name], [(0.01 * t, 0.01 * (t + 1)) for t in range(len(feats[name]))])
+      archive.finalize()
+      del archive
+      bundle_f.write("%s\n" % archive_fn)
+  bundle = open_file_archive(bundle_fn, index_cache_dir=index_cache_dir)
+  assert_equal(len(os.listdir(index_cache_dir)), 1)
+  assert_equal(len(bundle.archives), 3)  # needed to build the index
+  # Now with the index file. No archive is opened initially.
+  bundle = open_file_archive(bundle_fn, index_cache_dir=index_cache_dir)
+  assert_equal(bundle.archives, {})
+  assert_equal(sorted([fn for fn in bundle.file_list() if not fn.endswith(".attribs")]), sorted(feats.keys()))
+  assert bundle.has_entry("corpus/seq-1-0/1")
+  times, feat = bundle.read_numpy("corpus/seq-1-0/1", "feat")
+  numpy.testing.assert_equal(feat, feats["corpus/seq-1-0/1"])
+  assert_equal(list(bundle.archives.keys()), ["%s/feat.1.cache" % tmp_dir])
+  assert_equal(bundle.get_num_open_archives(), 1)
+  shutil.rmtree(tmp_dir)
@@ -119,5 +119,80 @@ def test_window():
     dataset2.exit_handler()
 
 
+def _generate_sprint_cache_dataset_files(num_allophones=10, seq_lens=(5, 8, 2)):
+  """
+  :return: feats, mixtures, phonemes, dataset data opts for SprintCacheDataset, list of temp files
+  """
+  from test_SprintCache import make_allophone_file, generate_sprint_cache
+  import tempfile
+  rnd = np.random.RandomState(42)
+  feats = {"seq-%i" % i: rnd.normal(size=(n, 3)).astype("float32") for (i, n) in enumerate(seq_lens)}
+  mixtures = {
+    name: (rnd.randint(0, num_allophones, size=(len(feat),)) + rnd.randint(0, 3, size=(len(feat),)) * (1 << 26)).tolist()
+    for (name, feat) in sorted(feats.items())}
+  allophone_fn = make_allophone_file(num_allophones)
+  phoneme_fn = tempfile.mktemp(suffix=".txt", prefix="nose-sprint-phonemes")
+  phonemes = ["a%i" % i for i in range(num_allophones - 1)] + ["si"]
+  with open(phoneme_fn, "w") as f:
+    f.write("\n".join(phonemes))
+  feat_fn, align_fn = generate_sprint_cache(feats, mixtures)
+  data = {
+    "data": {"filename": feat_fn},
+    "classes": {"filename": align_fn, "allophone_labeling": {
+      "silence_phone": "si", "allophone_file": allophone_fn, "phoneme_file": phoneme_fn}}}
+  return feats, mixtures, phonemes, data, [allophone_fn, phoneme_fn, feat_fn, align_fn]
+
+
+def test_SprintCacheDataset():
+  from SprintDataset import SprintCacheDataset
+  num_allophones = 10
+  feats, mixtures, phonemes, data, filenames = _generate_sprint_cache_dataset_files(num_allophones=num_allophones)
+  dataset = SprintCacheDataset(data=data)
+  assert_equal(dataset.num_inputs, 3)
+  assert_equal(dataset.num_outputs["classes"], (len(phonemes), 1))
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, dataset.num_seqs)
+  for seq_idx in range(dataset.num_seqs):
+    name = dataset.get_tag(seq_idx)
+    np.testing.assert_equal(dataset.get_data(seq_idx, "data"), feats[name])
+    assert_equal(
+      dataset.get_data(seq_idx, "classes").tolist(),
+      [phonemes.index("si") if m % (1 << 26) == num_allophones - 1 else m % (1 << 26) for m in mixtures[name]])
+  for fn in filenames:
+    os.remove(fn)
+
+
+def test_SprintCachePackedDataset():
+  from SprintDataset import SprintCacheDataset, SprintCachePackedDataset, pack_sprint_cache_dataset
+  import tempfile
+  import shutil
+  feats, mixtures, phonemes, data, filenames = _generate_sprint_cache_dataset_files()
+  orig_dataset = SprintCacheDataset(data=data)
+  packed_dir = tempfile.mkdtemp(prefix="nose-sprint-packed")
+  pack_sprint_cache_dataset(orig_dataset, packed_dir)
+  dataset = SprintCachePackedDataset(path=packed_dir, seq_ordering="sorted")
+  assert_equal(dataset.num_inputs, orig_dataset.num_inputs)
+  assert_equal(dataset.num_outputs, orig_dataset.num_outputs)
+  assert_equal(dataset.get_data_keys(), ["classes", "data"])
+  dataset.init_seq_order(epoch=1)
+  assert_equal(dataset.num_seqs, len(feats))
+  assert_equal(dataset.get_num_timesteps(), sum([len(feat) for feat in feats.values()]))
+  assert_equal([dataset.get_seq_length(i)["data"] for i in range(dataset.num_seqs)], [2, 5, 8])
+  dataset.load_seqs(0, dataset.num_seqs)
+  for seq_idx in range(dataset.num_seqs):
+    name = dataset.get_tag(seq_idx)
+    orig_seq = orig_dataset.get_dataset_seq_for_name(name)
+    for key in ["data", "classes"]:
+      assert_equal(dataset.get_data(seq_idx, key).dtype, orig_seq.get_data(key).dtype)
+      np.testing.assert_equal(dataset.get_data(seq_idx, key), orig_seq.get_data(key))
+  dataset.init_seq_order(epoch=2, seq_list=["seq-1", "seq-0"])
+  assert_equal(dataset.num_seqs, 2)
+  dataset.load_seqs(0, 2)
+  np.testing.assert_equal(dataset.get_data(0, "data"), feats["seq-1"])
+  shutil.rmtree(packed_dir)
+  for fn in filenames:
+    os.remove(fn)
+
+
 if __name__ == "__main__":
   test_assign_dev_data()
@@ -12,7 +12,7 @@ import Util
 import TFUtil
 TFUtil.debugRegisterBetterRepr()
 from Config import Config
-from nose.tools import assert_equal, assert_is_instance
+from nose.tools import assert_equal, assert_is_instance, assert_raises
 import numpy
 import numpy.testing
 import os
@@ -84,6 +84,105 @@ def test_DataProvider():
   assert_equal(classes.tolist(), [[1, 2, 0, 1, 2]])
 
 
+
+def test_DataProvider_buffer_pool():
+  from GeneratingDataset import StaticDataset
+  from TFDataPipeline import FeedDictDataProvider
+  rnd = numpy.random.RandomState(42)
+  seq_lens = [7, 3, 5, 2, 6, 1]
+  dataset = StaticDataset(
+    data=[{"data": rnd.normal(size=(n, 2)).astype("float32"), "classes": rnd.randint(1, 3, size=(n,)).astype("int32")}
+          for n in seq_lens],
+    output_dim={"data": [2, 2], "classes": [3, 1]})
+  dataset.init_seq_order(epoch=1)
+  extern_data = ExternData()
+  extern_data.init_from_dataset(dataset)
+  batches = []
+  for seq_idxs in [[0, 1], [2], [3, 4], [5]]:
+    batch = Batch()
+    for seq_idx in seq_idxs:
+      batch.add_sequence_as_slice(seq_idx=seq_idx, seq_start_frame=0, length=dataset.get_seq_length(seq_idx))
+    batches.append(batch)
+  # Also some chunk with zero padding at the end.
+  batches[-1].add_sequence_as_slice(
+    seq_idx=5, seq_start_frame=NumbersDict({"data": 0, "classes": 0}), length=NumbersDict({"data": 3, "classes": 3}))
+  data_provider = FeedDictDataProvider(
+    tf_session=session, extern_data=extern_data, data_keys=["data", "classes"],
+    dataset=dataset, batches=BatchSetGenerator(dataset, generator=iter(batches), shuffle_batches=False),
+    capacity=1)
+  for batch in batches:
+    dataset.load_seqs(batch.start_seq, batch.end_seq)
+    output = data_provider.get_next_batch()
+    data_provider.batches.advance(1)
+    for key in ["data", "classes"]:
+      value, value_lens = output[key], output["%s_seq_lens" % key]
+      assert value.flags.c_contiguous
+      assert_equal(value_lens.tolist(), [seq.frame_length[key] for seq in batch.seqs])
+      assert_equal(value.shape[:2], (len(batch.seqs), max(value_lens)))
+      for seq in batch.seqs:
+        seq_data = dataset.get_data(seq.seq_idx, key)
+        seq_len = min(seq.frame_length[key], seq_data.shape[0])
+        numpy.testing.assert_equal(value[seq.batch_slice, :seq_len], seq_data[:seq_len])
+        assert not value[seq.batch_slice, seq_len:].any()  # zero padded, also when the buffer was reused
+
+
+def test_MultiProcessDataProvider():
+  from Dataset import init_dataset
+  from TFDataPipeline import FeedDictDataProvider, MultiProcessDataProvider
+  rnd = numpy.random.RandomState(42)
+  # The workers create the dataset again from these options.
+  dataset = init_dataset({
+    "class": "StaticDataset",
+    "data": [
+      {"data": rnd.normal(size=(n, 2)).astype("float32"), "classes": rnd.randint(1, 3, size=(n,)).astype("int32")}
+      for n in rnd.randint(1, 20, size=(50,))],
+    "output_dim": {"data": [2, 2], "classes": [3, 1]}})
+  extern_data = ExternData()
+  extern_data.init_from_dataset(dataset)
+  outputs = []
+  for num_workers in [0, 3]:
+    dataset.init_seq_order(epoch=1)
+    kwargs = dict(
+      tf_session=session, extern_data=extern_data, data_keys=["data", "classes"],
+      dataset=dataset, batches=dataset.generate_batches(recurrent_net=True, batch_size=40, max_seqs=4), capacity=2)
+    if num_workers:
+      data_provider = MultiProcessDataProvider(num_workers=num_workers, **kwargs)
+    else:
+      data_provider = FeedDictDataProvider(**kwargs)
+    data_provider.start_threads()
+    feed_dicts = []
+    while data_provider.have_more_data(session):
+      feed_dict = data_provider.get_feed_dict()
+      feed_dicts.append({k: numpy.array(v) for (k, v) in feed_dict.items()})  # copy, the buffers get reused
+    assert data_provider.have_reached_end()
+    data_provider.stop_threads()
+    outputs.append(feed_dicts)
+  assert_equal(len(outputs[0]), len(outputs[1]))
+  assert len(outputs[0]) > 5
+  for feed_dict_ref, feed_dict in zip(*outputs):
+    assert_equal(set(feed_dict_ref.keys()), set(feed_dict.keys()))
+    for k, v in feed_dict_ref.items():
+      numpy.testing.assert_equal(feed_dict[k], v)
+
+
+def test_MultiProcessDataProvider_unsupported_datasets():
+  from GeneratingDataset import StaticDataset
+  from CachedDataset2 import CachedDataset2
+  from TFDataPipeline import MultiProcessDataProvider
+  static_dataset = StaticDataset(data=[{"data": numpy.zeros((3, 2), dtype="float32")}], output_dim={"data": [2, 2]})
+  extern_data = ExternData()
+  extern_data.init_from_dataset(static_dataset)
+  for dataset, err_msg in [(static_dataset, "init_dataset"), (CachedDataset2(), "CachedDataset2")]:
+    try:
+      MultiProcessDataProvider(
+        num_workers=2, tf_session=session, extern_data=extern_data, data_keys=["data"],
+        dataset=dataset, batches=None)
+    except Exception as exc:
+      assert err_msg in str(exc)
+    else:
+      assert False, "expected an exception for %r" % dataset
+
+
 def test_engine_train():
   from GeneratingDataset import DummyDataset
   seq_len = 5
@@ -108,6 +207,97 @@ def test_engine_train():
   engine.train()
 
 
+def test_engine_train_staging():
+  from GeneratingDataset import DummyDataset
+  seq_len = 5
+  n_data_dim = 2
+  n_classes_dim = 3
+  outputs = []
+  for data_provider in ["feed_dict", "staging"]:
+    train_data = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=20, seq_len=seq_len)
+    train_data.init_seq_order(epoch=1)
+    cv_data = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=2, seq_len=seq_len)
+    cv_data.init_seq_order(epoch=1)
+    config = Config()
+    config.update({
+      "model": "/tmp/model",
+      "num_outputs": n_classes_dim,
+      "num_inputs": n_data_dim,
+      "network": {"output": {"class": "softmax", "loss": "ce"}},
+      "data_provider": data_provider,
+      "max_seqs": 2,
+      "start_epoch": 1,
+      "num_epochs": 2
+    })
+    engine = Engine(config=config)
+    engine.init_train_from_config(config=config, train_data=train_data, dev_data=cv_data, eval_data=None)
+    engine.train()
+    if data_provider == "staging":
+      # All staged batches were consumed.
+      assert_equal(engine.tf_session.run(engine.data_stage.staging_size), 0)
+      # An extra session.run() with a fetch which depends on the network inputs must not silently take
+      # a staged batch. It must use the feed dict of the data provider.
+      from TFDataPipeline import StagingDataProvider
+      train_data.init_seq_order(epoch=1)
+      provider = StagingDataProvider(
+        stage=engine.data_stage, tf_session=engine.tf_session, extern_data=engine.network.extern_data,
+        data_keys=engine.network.used_data_keys, dataset=train_data,
+        batches=train_data.generate_batches(recurrent_net=engine.network.recurrent, batch_size=100, max_seqs=2))
+      provider.start_threads()
+      assert provider.have_more_data(session=engine.tf_session)
+      extra_fetch = engine.network.get_default_output_layer().output.placeholder
+      assert_raises(tf.errors.InvalidArgumentError, engine.tf_session.run, extra_fetch)
+      assert_equal(engine.tf_session.run(extra_fetch, feed_dict=provider.get_feed_dict()).shape[-1], n_classes_dim)
+      provider.stop_threads()
+    # With the staging area, this feeds the stage output directly.
+    cv_data.init_seq_order(epoch=1)
+    outputs.append(engine.forward_single(dataset=cv_data, seq_idx=0))
+    engine.finalize()
+  assert_equal(outputs[0].shape, (seq_len, n_classes_dim))
+  numpy.testing.assert_allclose(outputs[1], outputs[0], rtol=1e-5)
+
+
+def test_engine_network_cache():
+  from GeneratingDataset import DummyDataset
+  import tempfile
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=2, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  net_dict1 = {"output": {"class": "softmax", "loss": "ce"}}
+  net_dict2 = {"output": {"class": "softmax", "loss": "ce", "dropout": 0.1}}
+  config = Config()
+  config.update({
+    "model": "/tmp/model",
+    "num_outputs": 3,
+    "num_inputs": 2,
+    "network": net_dict1,
+    "tf_network_cache_size": 2,
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=dataset, dev_data=None, eval_data=None)
+  network1 = engine.network
+  engine.maybe_init_new_network(net_dict2)
+  network2 = engine.network
+  assert network2 is not network1
+  assert tf.get_default_graph() is engine.tf_session.graph
+  new_value = numpy.arange(6, dtype="float32").reshape((2, 3))
+  engine.network.get_var_assigner(network2.layers["output"].params["W"]).assign(new_value, session=engine.tf_session)
+
+  # Switch back and forth. The networks are reused, and the params are copied.
+  for net_dict, network in [(net_dict1, network1), (net_dict2, network2)]:
+    engine.maybe_init_new_network(net_dict)
+    assert engine.network is network
+    assert tf.get_default_graph() is engine.tf_session.graph
+    assert_equal(len(engine._network_cache), 1)
+    numpy.testing.assert_array_equal(
+      engine.tf_session.run(network.layers["output"].params["W"]), new_value)
+    output_file = tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward")
+    dataset.init_seq_order(epoch=1)
+    engine.forward_to_hdf(data=dataset, output_file=output_file, batch_size=5)
+    os.remove(output_file)
+  engine.finalize()
+  assert_equal(len(engine._network_cache), 0)
+
+
 def test_engine_analyze():
   from GeneratingDataset import DummyDataset
   seq_len = 5
@@ -199,6 +389,125 @@ def test_engine_forward_to_hdf():
   os.remove(output_file)
 
 
+def test_engine_forward_to_hdf_sharded():
+  from GeneratingDataset import DummyDataset
+  from HDFDataset import HDFDataset, merge_hdf_files
+  import tempfile
+  n_data_dim = 2
+  n_classes_dim = 3
+  num_seqs = 20
+  dataset = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=num_seqs, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  config = Config()
+  config.update({
+    "model": "/tmp/model",
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=dataset, dev_data=None, eval_data=None)
+  output_file = tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward")
+  engine.forward_to_hdf(data=dataset, output_file=output_file, batch_size=5)
+
+  # This is what each sub process does in rnn.forwardSharded().
+  num_shards = 3
+  shard_files = []
+  config.set("forward_num_shards", num_shards)
+  for shard_index in range(num_shards):
+    config.set("forward_shard_index", shard_index)
+    shard_files.append(tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward-shard"))
+    dataset.init_seq_order(epoch=1)
+    engine.forward_to_hdf(data=dataset, output_file=shard_files[-1], batch_size=5)
+  merged_file = tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward-merged")
+  merge_hdf_files(filenames=shard_files, output_file=merged_file)
+
+  datasets = []
+  for fn in [output_file, merged_file]:
+    ds = HDFDataset()
+    ds.add_file(fn)
+    ds.initialize()
+    ds.init_seq_order(epoch=1)
+    ds.load_seqs(0, ds.num_seqs)
+    datasets.append([(ds.get_tag(i), ds.get_data(i, "data").tolist()) for i in range(ds.num_seqs)])
+  assert_equal(len(datasets[0]), num_seqs)
+  assert_equal([tag for (tag, _) in datasets[0]], ["seq-%i" % i for i in range(num_seqs)])
+  assert_equal(datasets[0], datasets[1])  # same seq order
+  for fn in [output_file, merged_file] + shard_files:
+    os.remove(fn)
+
+
+def test_engine_forward_to_hdf_sort_window():
+  sys.path += ["tools"]
+  from GeneratingDataset import StaticDataset
+  from HDFDataset import HDFDataset
+  from hdf_dump import hdf_dataset_init, hdf_dump_from_dataset, hdf_close
+  from Util import DictAsObj
+  import tempfile
+  n_data_dim = 2
+  n_classes_dim = 3
+  rnd = numpy.random.RandomState(42)
+  data = []
+  for _ in range(20):
+    seq_len = rnd.randint(1, 15)
+    data.append({"data": rnd.normal(size=(seq_len, n_data_dim)).astype("float32"),
+                 "classes": rnd.randint(0, n_classes_dim, size=(seq_len,)).astype("int32")})
+  static_dataset = StaticDataset(data=data, output_dim={"data": [n_data_dim, 2], "classes": [n_classes_dim, 1]})
+  static_dataset.init_seq_order(epoch=1)
+  input_file = tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward-input")
+  hdf_dataset = hdf_dataset_init(input_file)
+  hdf_dump_from_dataset(static_dataset, hdf_dataset, DictAsObj({"epoch": 1, "start_seq": 0, "end_seq": float("inf")}))
+  hdf_close(hdf_dataset)
+  dataset = HDFDataset(cache_byte_size=-1)  # inference_sort_window needs a fully cached dataset
+  dataset.add_file(input_file)
+  dataset.initialize()
+
+  config = Config()
+  config.update({
+    "model": "/tmp/model",
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "network": {
+      "lstm": {"class": "rec", "unit": "LSTMBlock", "n_out": 4, "from": ["data"]},
+      "output": {"class": "softmax", "loss": "ce", "from": ["lstm"]}},
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=dataset, dev_data=None, eval_data=None)
+  assert engine.network.recurrent
+  output_files = []
+  for sort_window in [0, 7]:
+    config.set("inference_sort_window", sort_window)
+    output_files.append(tempfile.mktemp(suffix=".hdf", prefix="nose-tf-forward"))
+    dataset.init_seq_order(epoch=1)
+    engine.forward_to_hdf(data=dataset, output_file=output_files[-1], batch_size=30)
+  not_fully_cached_dataset = HDFDataset()
+  not_fully_cached_dataset.add_file(input_file)
+  not_fully_cached_dataset.initialize()
+  not_fully_cached_dataset.init_seq_order(epoch=1)
+  assert_raises(Exception, engine.forward_to_hdf, data=not_fully_cached_dataset, output_file=output_files[-1] + ".2")
+  assert not os.path.exists(output_files[-1] + ".2")
+
+  datasets = []
+  for fn in output_files:
+    ds = HDFDataset()
+    ds.add_file(fn)
+    ds.initialize()
+    ds.init_seq_order(epoch=1)
+    ds.load_seqs(0, ds.num_seqs)
+    datasets.append(ds)
+  ds_ref, ds_sorted = datasets
+  assert_equal(ds_sorted.num_seqs, len(data))
+  for seq_idx in range(len(data)):
+    # Written in the original order.
+    assert_equal(ds_sorted.get_tag(seq_idx), dataset.get_tag(seq_idx))
+    assert_equal(ds_ref.get_tag(seq_idx), dataset.get_tag(seq_idx))
+    numpy.testing.assert_allclose(
+      ds_sorted.get_data(seq_idx, "data"), ds_ref.get_data(seq_idx, "data"), rtol=1e-5, atol=1e-6)
+  for fn in output_files + [input_file]:
+    os.remove(fn)
+  engine.finalize()
+
+
 def test_engine_rec_subnet_count():
   from GeneratingDataset import DummyDataset
   seq_len = 5
@@ -273,6 +582,68 @@ def test_engine_search():
   engine.finalize()
 
 
+def test_engine_search_output_file():
+  from GeneratingDataset import DummyDataset
+  import tempfile
+  import json
+  n_data_dim = 2
+  n_classes_dim = 3
+  beam_size = 4
+  dataset = DummyDataset(input_dim=n_data_dim, output_dim=n_classes_dim, num_seqs=3, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  config = Config()
+  config.update({
+    "model": "/tmp/model",
+    "batch_size": 5000,
+    "max_seqs": 2,
+    "num_outputs": n_classes_dim,
+    "num_inputs": n_data_dim,
+    "search_output_file_format": "jsonl",
+    "search_output_nbest": 2,
+    "network": {
+      "output": {"class": "rec", "from": [], "max_seq_len": 10, "target": "classes", "unit": {
+        "prob": {"class": "softmax", "from": ["prev:output"], "loss": "ce", "target": "classes"},
+        "output": {"class": "choice", "beam_size": beam_size, "from": ["prob"], "target": "classes",
+                   "initial_output": 0},
+        "end": {"class": "compare", "from": ["output"], "value": 0}
+      }},
+      "decision": {"class": "decide", "from": ["output"], "loss": "edit_distance"}
+    }
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=dataset, dev_data=None, eval_data=None)
+  output_file = tempfile.mktemp(suffix=".jsonl", prefix="nose-tf-search")
+  engine.search(dataset=dataset, output_layer_name="output", output_file=output_file)
+  with open(output_file) as f:
+    lines = [json.loads(line) for line in f.read().splitlines()]
+  assert_equal(sorted([line["seq_tag"] for line in lines]), ["seq-0", "seq-1", "seq-2"])
+  for line in lines:
+    assert_equal(len(line["hyps"]), 2)
+    scores = [hyp["score"] for hyp in line["hyps"]]
+    assert_equal(scores, sorted(scores, reverse=True))
+    for hyp in line["hyps"]:
+      assert isinstance(hyp["output"], list)
+  os.remove(output_file)
+  engine.finalize()
+
+
+def test_SearchOutputWriter_txt():
+  from GeneratingDataset import DummyDataset
+  import tempfile
+  import io
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=2, seq_len=5)
+  dataset.labels["classes"] = [u"a", u"\xe4", u"b"]
+  output_file = tempfile.mktemp(suffix=".txt", prefix="nose-tf-search")
+  writer = SearchOutputWriter(
+    dataset=dataset, target_key="classes", output_file=output_file, output_format="txt", background=False)
+  writer.add_batch(
+    seq_idx=[0, 1], seq_tag=["seq-0", "seq-1"], output=[numpy.array([0, 1]), numpy.array([2])])
+  writer.close()
+  with io.open(output_file, encoding="utf8") as f:
+    assert_equal(f.read(), u"a \xe4\nb\n")
+  os.remove(output_file)
+
+
 def test_engine_search_attention():
   from GeneratingDataset import DummyDataset
   seq_len = 5
@@ -892,3 +892,18 @@ def test_VariableAssigner_ResourceVariable():
   assigner = VariableAssigner(v)
   assigner.assign(value=2., session=session)
   assert_equal(session.run(v), 2.)
+
+
+def test_set_global_default_graph():
+  check_set_global_default_graph_supported()
+  old_graph = tf.get_default_graph()
+  graph = tf.Graph()
+  try:
+    set_global_default_graph(graph)
+    assert_is(tf.get_default_graph(), graph)
+    with tf.Graph().as_default() as other_graph:
+      assert_is(tf.get_default_graph(), other_graph)
+    assert_is(tf.get_default_graph(), graph)
+  finally:
+    set_global_default_graph(old_graph)
+  assert_is(tf.get_default_graph(), old_graph)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Converts a SprintCacheDataset (features + alignments mapped via AllophoneLabeling) once
+into the packed memory-mappable corpus format, which can then be read via SprintCachePackedDataset.
+
+Usage example:
+
+  tools/sprint-cache-pack.py "{'class': 'SprintCacheDataset', 'data': {...}}" /path/to/packed-corpus
+
+And then in the config:
+
+  train = {"class": "SprintCachePackedDataset", "path": "/path/to/packed-corpus", "seq_ordering": "random"}
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.append(returnn_dir)
+
+import argparse
+import rnn
+from Log import log
+from Dataset import init_dataset
+from SprintDataset import SprintCacheDataset, pack_sprint_cache_dataset
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Pack a SprintCacheDataset into a memory-mappable corpus.")
+  parser.add_argument("dataset", help="dataset dict, e.g. \"{'class': 'SprintCacheDataset', ...}\", or init string")
+  parser.add_argument("output_dir", help="directory of the packed corpus, will be created")
+  parser.add_argument("--verbosity", type=int, default=4)
+  args = parser.parse_args(argv[1:])
+  rnn.initBetterExchook()
+  log.initialize(verbosity=[args.verbosity])
+  if args.dataset.startswith("{"):
+    dataset = init_dataset(eval(args.dataset))
+  else:
+    dataset = init_dataset(args.dataset)
+  assert isinstance(dataset, SprintCacheDataset), "expected SprintCacheDataset, got %r" % dataset
+  print("Source dataset:", dataset.len_info(), file=log.v3)
+  pack_sprint_cache_dataset(dataset, args.output_dir)
+
+
+if __name__ == '__main__':
+  main(sys.argv)